@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+'''
+Times the main run.py commands against a simulated fleet and fails if any of
+them got slower than the stored baseline.
+
+A scratch copy of the project is set up with its own settings, compose file,
+image repos and docker-machine configs, and fake_command.py is put on PATH
+as docker, docker-compose, docker-machine, ssh and rsync. Machines are given
+loopback addresses and a listener stands in for their Docker daemons, so
+nothing leaves this host.
+'''
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(BENCH_PATH)
+FAKE_COMMANDS = ['docker', 'docker-compose', 'docker-machine', 'ssh', 'rsync']
+BASELINES_PATH = os.path.join(BENCH_PATH, 'baselines.json')
+REGISTRY_ADDRESS = 'registry.bench.local'
+MASTER_ADDRESS = '127.0.0.1'
+
+# Name, run.py arguments and whether to time a second run after an untimed
+# one, to measure the path where caches are already warm
+OPERATIONS = [
+    ('view-machines',       ['stats'],                                      False),
+    ('poll-stats',          ['poll-stats', '--once'],                       False),
+    ('initialize',          ['init', '--all'],                              False),
+    ('initialize-warm',     ['init', '--all'],                              True),
+    ('build-all',           ['build', '--all'],                             False),
+    ('build-all-warm',      ['build', '--all'],                             True),
+    ('deploy',              ['deploy', '{node}'],                           False),
+    ('rollout',             ['rollout'],                                    False),
+    ('sync-volumes',        ['sync-volumes', 'master', '{node}', '--all'],  False),
+    ('sync-volumes-warm',   ['sync-volumes', 'master', '{node}', '--all'],  True),
+    ('sync-databases',      ['sync-db', '{node}', '--all'],                 False),
+    ('dump-databases',      ['dump-db', '{node}', '--all'],                 False),
+]
+
+
+def get_machine_names(count):
+    return ['node-{:03d}'.format(n) for n in range(1, count + 1)]
+
+
+def get_machine_ip(n):
+    return '127.0.{}.{}'.format(1 + (n - 1) // 250, 1 + (n - 1) % 250)
+
+
+def get_profile(args):
+    '''
+    Identifies the simulated fleet so results are only compared with
+    baselines taken from the same one.
+    '''
+    keys = ['machines', 'images', 'volumes', 'databases', 'files', 'tables', 'latency', 'build_seconds', 'push_seconds', 'pull_seconds', 'rsync_seconds', 'restore_seconds']
+    return ' '.join('{}={}'.format(key, getattr(args, key)) for key in keys)
+
+
+def write_json(path, data):
+    with open(path, 'w') as json_file:
+        json.dump(data, json_file, indent=2, sort_keys=True)
+
+
+def create_project(root, args, docker_port):
+    '''
+    Lays out the scratch project and the fake fleet under `root`, returning
+    the environment to run it with.
+    '''
+    app_path = os.path.join(root, 'app')
+    home_path = os.path.join(root, 'home')
+    repos_path = os.path.join(root, 'repos')
+    bin_path = os.path.join(root, 'bin')
+    machine_config_path = os.path.join(home_path, '.docker', 'machine')
+
+    shutil.copytree(PROJECT_PATH, app_path, ignore=shutil.ignore_patterns('.git', '__pycache__', 'bench', 'settings.py', 'docker-compose*.yml', 'fleet.yml'))
+
+    os.makedirs(os.path.join(home_path, '.ssh'))
+    with open(os.path.join(home_path, '.ssh', 'id_rsa.pub'), 'w') as key_file:
+        key_file.write('ssh-rsa AAAAbenchlocalkey bench@local\n')
+
+    for n, name in enumerate(get_machine_names(args.machines), 1):
+        machine_path = os.path.join(machine_config_path, 'machines', name)
+        os.makedirs(machine_path)
+        write_json(os.path.join(machine_path, 'config.json'), {'Name': name, 'DriverName': 'generic', 'Driver': {'IPAddress': get_machine_ip(n)}})
+        open(os.path.join(machine_path, 'id_rsa'), 'w').close()
+
+    # The first image is a base that every fifth image builds on
+    services = {}
+    compose_services = {}
+    for n in range(1, args.images + 1):
+        image = 'image-{:03d}'.format(n)
+        os.makedirs(os.path.join(repos_path, image))
+        base_image = '{}/image-001'.format(REGISTRY_ADDRESS) if n > 1 and n % 5 == 0 else 'python:3.6'
+        with open(os.path.join(repos_path, image, 'Dockerfile'), 'w') as dockerfile:
+            dockerfile.write('FROM {}\nCOPY . /srv\n'.format(base_image))
+        with open(os.path.join(repos_path, image, 'app.py'), 'w') as app_file:
+            app_file.write('print("{}")\n'.format(image))
+
+        service = 'service-{:03d}'.format(n)
+        services[service] = '{}/{}:latest'.format(REGISTRY_ADDRESS, image)
+        compose_services[service] = {'image': '{}/{}'.format(REGISTRY_ADDRESS, image), 'restart': 'always', 'volumes': []}
+
+    service_names = sorted(compose_services)
+    for n in range(1, args.volumes + 1):
+        service = service_names[(n - 1) % len(service_names)]
+        compose_services[service]['volumes'].append('/volumes/volume-{:03d}:/data/{}'.format(n, n))
+
+    services['mysql'] = 'mysql:5.7'
+    compose_services['mysql'] = {'image': 'mysql:5.7', 'volumes': ['/volumes/mysql:/var/lib/mysql']}
+    for n in range(1, args.databases + 1):
+        service = 'database-{:03d}'.format(n)
+        services[service] = 'python:3.6'
+        compose_services[service] = {'image': 'python:3.6', 'links': ['mysql']}
+
+    # YAML is a superset of JSON
+    write_json(os.path.join(app_path, 'docker-compose.yml'), {'version': '2', 'services': compose_services})
+
+    settings = {
+        'MASTER_ADDRESS':               MASTER_ADDRESS,
+        'MASTER_VOLUMES_PATH':          '/root/backups/media',
+        'MASTER_DATABASES_PATH':        '/root/backups/databases',
+        'MASTER_PUBLIC_KEY':            'ssh-rsa AAAAbenchmasterkey root@master',
+        'NON_BACKED_UP_VOLUMES':        ['mysql'],
+        'REGISTRY_ADDRESS':             REGISTRY_ADDRESS,
+        'REGISTRY_USER':                'bench',
+        'REGISTRY_PASSWORD':            'bench',
+        'DIGITALOCEAN_TOKEN':           '',
+        'SCALEWAY_TOKEN':               '',
+        'SCALEWAY_ACCESS_KEY':          '',
+        'DOCKER_MACHINE_CONFIG_PATH':   machine_config_path,
+        'LOCAL_REPOS_PATH':             repos_path,
+        'LOCAL_VOLUMES_PATH':           os.path.join(root, 'volumes'),
+        'DOCKER_PORT':                  docker_port,
+        'INVENTORY_PROBE_TIMEOUT':      1,
+        'DEPLOY_HEALTH_TIMEOUT':        10,
+    }
+    with open(os.path.join(app_path, 'settings.py'), 'w') as settings_file:
+        for name, value in sorted(settings.items()):
+            settings_file.write('{} = {!r}\n'.format(name, value))
+
+    fleet_path = os.path.join(root, 'fleet.json')
+    write_json(fleet_path, {
+        'master_address':       MASTER_ADDRESS,
+        'machine_config_path':  machine_config_path,
+        'services':             services,
+        'files':                args.files,
+        'tables':               args.tables,
+        'latency':              args.latency,
+        'build_seconds':        args.build_seconds,
+        'push_seconds':         args.push_seconds,
+        'pull_seconds':         args.pull_seconds,
+        'rsync_seconds':        args.rsync_seconds,
+        'restore_seconds':      args.restore_seconds,
+    })
+
+    os.makedirs(bin_path)
+    for name in FAKE_COMMANDS:
+        path = os.path.join(bin_path, name)
+        with open(path, 'w') as shim:
+            shim.write('#!/bin/sh\nexec "{}" "{}" "{}" {} "$@"\n'.format(sys.executable, os.path.join(BENCH_PATH, 'fake_command.py'), fleet_path, name))
+        os.chmod(path, 0o755)
+
+    env = dict(os.environ)
+    env['HOME'] = home_path
+    env['PATH'] = '{}{}{}'.format(bin_path, os.pathsep, env.get('PATH', os.defpath))
+    env.pop('DOCKER_HOST', None)
+    return app_path, env
+
+
+def reset_state(env):
+    '''
+    Removes the caches and state punk-deploy keeps between runs.
+    '''
+    shutil.rmtree(os.path.join(env['HOME'], '.punk-deploy'), ignore_errors=True)
+
+
+def start_docker_listener():
+    '''
+    Accepts connections on every loopback address so the machines look like
+    they are running. Returns the port.
+    '''
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', 0))
+    listener.listen(1024)
+
+    def accept():
+        while True:
+            connection, address = listener.accept()
+            connection.close()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def run_operation(app_path, env, arguments, verbose=False):
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, 'run.py'] + arguments, cwd=app_path, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=None if verbose else subprocess.PIPE)
+    seconds = time.perf_counter() - started
+    if process.returncode != 0:
+        raise RuntimeError('run.py {} exited with {}: {}'.format(' '.join(arguments), process.returncode, process.stdout.decode('utf-8').strip()[-500:]))
+    return seconds
+
+
+def time_operation(app_path, env, arguments, warm, repeat, verbose=False):
+    '''
+    Returns the median of `repeat` timed runs. Each run starts from empty
+    state, and for warm operations an untimed run fills the caches first.
+    '''
+    timings = []
+    for i in range(repeat):
+        reset_state(env)
+        if warm:
+            run_operation(app_path, env, arguments, verbose)
+        timings.append(run_operation(app_path, env, arguments, verbose))
+    return sorted(timings)[len(timings) // 2]
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baselines_file:
+        return json.load(baselines_file)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Time run.py commands against a simulated fleet and compare them with stored baselines.')
+    parser.add_argument('operations', nargs='*', help='operations to run, defaults to all of: {}'.format(', '.join(name for name, arguments, warm in OPERATIONS)))
+    parser.add_argument('--machines', type=int, default=20, help='number of machines (1-200)')
+    parser.add_argument('--images', type=int, default=10, help='number of private images (1-100)')
+    parser.add_argument('--volumes', type=int, default=5, help='number of volumes (1-50)')
+    parser.add_argument('--databases', type=int, default=3, help='number of databases')
+    parser.add_argument('--files', type=int, default=500, help='files in each volume')
+    parser.add_argument('--tables', type=int, default=20, help='tables in each database')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every fake command')
+    parser.add_argument('--build-seconds', type=float, default=0.05, help='seconds each docker build takes')
+    parser.add_argument('--push-seconds', type=float, default=0.05, help='seconds each docker push takes')
+    parser.add_argument('--pull-seconds', type=float, default=0.05, help='seconds each docker-compose pull takes')
+    parser.add_argument('--rsync-seconds', type=float, default=0.05, help='seconds each rsync takes')
+    parser.add_argument('--restore-seconds', type=float, default=0.1, help='seconds each database dump takes to stream and load')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each operation, the median is used')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='fraction slower than the baseline that counts as a regression')
+    parser.add_argument('--baselines', default=BASELINES_PATH, help='baselines file, defaults to bench/baselines.json')
+    parser.add_argument('--save-baselines', action='store_true', help='store these timings as the baselines for this fleet')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch project for inspection')
+    parser.add_argument('--verbose', action='store_true', help='show the output of run.py')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if not 1 <= args.machines <= 200 or not 1 <= args.images <= 100 or not 1 <= args.volumes <= 50:
+        get_parser().error('The fleet can have 1-200 machines, 1-100 images and 1-50 volumes')
+    unknown = set(args.operations) - set(name for name, arguments, warm in OPERATIONS)
+    if unknown:
+        get_parser().error('Unknown operations: {}'.format(', '.join(sorted(unknown))))
+
+    profile = get_profile(args)
+    baselines = load_baselines(args.baselines)
+    profile_baselines = baselines.get(profile, {})
+
+    root = tempfile.mkdtemp(prefix='punk-bench-')
+    app_path, env = create_project(root, args, start_docker_listener())
+    print(profile)
+    print('{:<20}  {:>9}  {:>9}  {:>8}  {}'.format('Operation', 'Seconds', 'Baseline', 'Change', 'Status'))
+
+    timings = {}
+    failed = False
+    try:
+        for name, arguments, warm in OPERATIONS:
+            if args.operations and name not in args.operations:
+                continue
+            arguments = [argument.format(node=get_machine_names(1)[0]) for argument in arguments]
+            try:
+                seconds = time_operation(app_path, env, arguments, warm, args.repeat, args.verbose)
+            except RuntimeError as e:
+                print('{:<20}  {:>9}  {:>9}  {:>8}  error: {}'.format(name, '-', '-', '-', e))
+                failed = True
+                continue
+            timings[name] = round(seconds, 3)
+
+            baseline = profile_baselines.get(name)
+            if baseline is None:
+                print('{:<20}  {:>9.3f}  {:>9}  {:>8}  no baseline'.format(name, seconds, '-', '-'))
+                continue
+            change = seconds / baseline - 1
+            status = 'ok'
+            if change > args.tolerance:
+                status = 'REGRESSED'
+                failed = failed or not args.save_baselines
+            print('{:<20}  {:>9.3f}  {:>9.3f}  {:>+7.1f}%  {}'.format(name, seconds, baseline, change * 100, status))
+    finally:
+        if args.keep:
+            print('Scratch project kept in {}'.format(root))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.save_baselines:
+        profile_baselines.update(timings)
+        baselines[profile] = profile_baselines
+        write_json(args.baselines, baselines)
+        print('Saved baselines to {}'.format(args.baselines))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+Stands in for docker, docker-compose, docker-machine, ssh and rsync while
+benchmarking. benchmark.py writes a shim for each one that runs:
+
+    fake_command.py FLEET_JSON NAME ARGS...
+
+The fleet JSON describes the machines, services, volumes and databases to
+pretend exist, and how long each kind of call should take.
+'''
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+
+def digest(*values):
+    return 'sha256:{}'.format(hashlib.sha256(':'.join(values).encode('utf-8')).hexdigest())
+
+
+def read_input():
+    if sys.stdin.isatty():
+        return ''
+    return sys.stdin.read()
+
+
+def fake_docker(fleet, args):
+    if args[:2] == ['image', 'inspect']:
+        return digest('base', args[-1])
+
+    if args[0] == 'build':
+        time.sleep(fleet['build_seconds'])
+        if os.environ.get('DOCKER_BUILDKIT') == '1':
+            # The COPY step is reused when there's an image to take cache from
+            copy = '#3 CACHED' if '--cache-from' in args else '#3 DONE 0.1s'
+            return '#1 [internal] load build definition from Dockerfile\n#2 [1/2] FROM scratch\n#3 [2/2] COPY . /app\n{}\n#4 exporting to image\n#4 writing image {} done\n#4 naming to {} done'.format(copy, digest('build', args[2]), args[2])
+        return 'Step 1/1 : FROM scratch\nSuccessfully built {}\nSuccessfully tagged {}'.format(digest('build', args[2])[7:19], args[2])
+
+    if args[0] == 'push':
+        time.sleep(fleet['push_seconds'])
+        return 'latest: digest: {} size: 1234'.format(digest('push', args[1]))
+
+    if args[0] == 'images':
+        return '\n'.join('{} {}'.format(image, digest('image', image)) for image in sorted(set(fleet['services'].values())))
+
+    if args[0] == 'inspect':
+        template, container_ids = args[2], args[3:]
+        if 'State.Health' in template:
+            return 'running 0 healthy'
+        lines = []
+        for i, container_id in enumerate(container_ids):
+            service = container_id[len('c-'):]
+            image = fleet['services'][service]
+            # Every other service runs an outdated image so deploys have work to do
+            image_id = digest('image', image) if i % 2 == 0 else digest('outdated', image)
+            lines.append('{}\t{}\t{}\ttrue'.format(service, image_id, digest('config', service)[7:]))
+        return '\n'.join(lines)
+
+    return ''
+
+
+def fake_docker_compose(fleet, args):
+    while args and args[0] == '-f':
+        args = args[2:]
+
+    if args[0] == 'config':
+        return '\n'.join('{} {}'.format(service, digest('config', service)[7:]) for service in sorted(fleet['services']))
+
+    if args[0] == 'ps':
+        services = [arg for arg in args[1:] if not arg.startswith('-')] or sorted(fleet['services'])
+        return '\n'.join('c-{}'.format(service) for service in services)
+
+    if args[0] == 'pull':
+        time.sleep(fleet['pull_seconds'])
+
+    return ''
+
+
+def fake_docker_machine(fleet, args):
+    machines_path = os.path.join(fleet['machine_config_path'], 'machines')
+
+    if args[0] == 'ls':
+        return '\n'.join(sorted(os.listdir(machines_path)))
+
+    if args[0] == 'create':
+        name = args[-1]
+        os.makedirs(os.path.join(machines_path, name), exist_ok=True)
+        ip = args[args.index('--generic-ip-address') + 1] if '--generic-ip-address' in args else '127.0.0.2'
+        with open(os.path.join(machines_path, name, 'config.json'), 'w') as config_file:
+            json.dump({'Name': name, 'DriverName': args[args.index('-d') + 1], 'Driver': {'IPAddress': ip}}, config_file)
+
+    if args[0] == 'rm':
+        shutil.rmtree(os.path.join(machines_path, args[-1]), ignore_errors=True)
+
+    return ''
+
+
+def get_manifest(fleet, host, volume):
+    '''
+    Lists the files of a volume. Nodes hold an older copy of every other file
+    so there is always something to sync from master.
+    '''
+    on_master = host == fleet['master_address']
+    lines = []
+    for i in range(fleet['files']):
+        mtime = 1500000000 + (0 if on_master else i % 2)
+        lines.append('{}\t{}.0000000000\t{}-{:05d}.dat\0'.format(1000 + i, mtime, volume, i))
+    return ''.join(sorted(lines))
+
+
+def fake_remote_command(fleet, host, command, stdin):
+    if 'cat /proc/uptime /proc/loadavg' in command:
+        # CPU counters grow with the clock so consecutive samples differ
+        ticks = int(time.time() * 100)
+        return '\n'.join([
+            '1036800.25 2000000.50',
+            '0.10 0.20 0.30 1/123 4567',
+            'MemTotal:        2048000 kB',
+            'MemAvailable:    1024000 kB',
+            'cpu  {} 0 {} {} 0 0 0 0 0 0'.format(ticks // 4, ticks // 4, ticks // 2),
+            'statvfs 10485760 7864320 4096',
+            'cpus 2',
+        ])
+
+    if command.startswith('cat /etc/ssh/'):
+        return 'ssh-rsa AAAAfakehostkey'
+
+    if 'host-key:' in command:
+        lines = ['host-key:ssh-rsa AAAAfakehostkey']
+        lines += ['{}:todo'.format(i) for i in re.findall(r'echo "(\d+):todo"', command)]
+        return '\n'.join(lines)
+
+    if re.search(r'echo "\d+:ok"', command):
+        return '\n'.join('{}:ok'.format(i) for i in re.findall(r'echo "(\d+):ok"', command))
+
+    if 'find . -type f -printf' in command:
+        volume = os.path.basename(re.search(r'cd (\S+) 2>', command).group(1))
+        manifest = get_manifest(fleet, host, volume)
+        known = re.search(r'= "([0-9a-f]*)" \]', command).group(1)
+        if known == hashlib.md5(manifest.encode('utf-8')).hexdigest():
+            return 'delta\n'
+        return 'full\n' + manifest
+
+    if command.startswith('rsync '):
+        time.sleep(fleet['rsync_seconds'])
+        return 'sent {} bytes  received 35 bytes'.format(len(stdin) * 100)
+
+    if '| md5sum' in command:
+        # Checksum of a database's dump files on master
+        return '{}  -\n'.format(digest(command)[7:39])
+
+    if command.startswith('docker exec') and 'mysqldump' in command:
+        # Views, triggers and routines of a shadow database
+        return ''
+
+    if 'mysqldump' in command:
+        # Master pulling per-table dumps from a node then listing them
+        time.sleep(fleet['restore_seconds'])
+        return '\n'.join('table_{:03d}.sql.gz'.format(i) for i in range(fleet['tables']))
+
+    if 'gzip -c' in command:
+        time.sleep(fleet['restore_seconds'])
+        return ''
+
+    if 'information_schema.triggers' in stdin:
+        schemas = re.search(r"table_schema in \(([^)]*)\)", stdin).group(1).replace("'", '').split(', ')
+        return '\n'.join('BASE TABLE\t{}\ttable_{:03d}'.format(schema, i) for schema in schemas for i in range(fleet['tables']))
+
+    match = re.search(r"table_schema = '([^']+)'", stdin)
+    if match:
+        return '\n'.join('table_{:03d}'.format(i) for i in range(fleet['tables']))
+
+    return ''
+
+
+def fake_ssh(fleet, args):
+    options_with_values = ['-o', '-i', '-O', '-p', '-l', '-e']
+    while args and args[0].startswith('-'):
+        args = args[2:] if args[0] in options_with_values else args[1:]
+    host = args[0].split('@')[-1]
+    command = ' '.join(args[1:])
+    return fake_remote_command(fleet, host, command, read_input())
+
+
+def fake_rsync(fleet, args):
+    stdin = read_input() if '--files-from=-' in args else ''
+    time.sleep(fleet['rsync_seconds'])
+    return 'sent {} bytes  received 35 bytes'.format(len(stdin) * 100)
+
+
+FAKES = {
+    'docker':           fake_docker,
+    'docker-compose':   fake_docker_compose,
+    'docker-machine':   fake_docker_machine,
+    'ssh':              fake_ssh,
+    'rsync':            fake_rsync,
+}
+
+
+def main():
+    with open(sys.argv[1]) as fleet_file:
+        fleet = json.load(fleet_file)
+    name, args = sys.argv[2], sys.argv[3:]
+
+    time.sleep(fleet['latency'])
+    output = FAKES[name](fleet, args)
+    if output:
+        sys.stdout.write(output if output.endswith('\n') else output + '\n')
+
+
+if __name__ == '__main__':
+    main()
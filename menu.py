@@ -0,0 +1,542 @@
+from time import sleep
+
+from clint.textui import columns, prompt, puts, colored, validators, progress
+
+from utils.backups import BACKUP_KEEP_SNAPSHOTS, backup_volumes, list_snapshots, prune_snapshots, restore_volume
+from utils.build_cache import get_layer_cache_report
+from utils.databases import get_databases, dump_databases, restore_database, restore_databases
+from utils.docker_compose import launch_docker_compose, get_containers, rollout
+from utils.docker_images import get_private_images, build_image_if_changed, push_and_record_image, build_and_push_images
+from utils.docker_machine import DRIVERS, get_machines, create_machine, provision_machine, destroy_machine, get_drivers
+from utils.fleet import FLEET_TEMPLATE_PATH, load_fleet_template, get_fleet_specs, provision_fleet
+from utils.initialize import get_initialize_steps, initialize_machine_batch, initialize_machines
+from utils.journal import close_journal, open_journal
+from utils.placement import deploy_placement, get_placement_plan
+from utils.runner import format_progress
+from utils.stats import get_fleet_stats, get_fleet_history, format_summary
+from utils.volumes import get_volumes, sync_volume, sync_volumes_concurrently
+
+
+def select_machine(message=None, master=False, local=False, fleet=False):
+    machines = get_machines()
+    machine_options = []
+    for i, machine in enumerate(sorted([k for k, v in machines.items() if v['running']])):
+        machine_options.append({'selector': str(i + 1), 'prompt': machine, 'return': machine})
+    if master:
+        i += 1
+        machine_options.append({'selector': str(i + 1), 'prompt': 'master', 'return': 'master'})
+    if local:
+        i += 1
+        machine_options.append({'selector': str(i + 1), 'prompt': 'local', 'return': 'local'})
+    if fleet:
+        i += 1
+        machine_options.append({'selector': str(i + 1), 'prompt': '* ALL MACHINES *', 'return': 'all'})
+
+    if not message:
+        message = 'Which machine?'
+    return prompt.options(colored.yellow('\n{}'.format(message)), machine_options)
+
+
+def view_machines_prompt():
+    machines = get_machines()
+    running = [name for name, properties in machines.items() if properties['running']]
+    history = get_fleet_history(running)
+    puts('')
+    if any(history.values()):
+        puts(colored.cyan('Current values with the trend and range over the last hour, from the samples taken by poll-stats'))
+    puts(columns([(colored.cyan('Name', bold=True)), 15], [(colored.cyan('Driver')), 12], [(colored.cyan('IP')), 16], [(colored.cyan('Running')), 8], [(colored.cyan('Active')), 8], [(colored.cyan('Uptime')), 15], [(colored.cyan('Load')), 30], [(colored.cyan('CPU')), 26], [(colored.cyan('Memory')), 26], [(colored.cyan('Disk')), 26]))
+
+    def show_row(name, machine_stats):
+        properties = machines[name]
+        machine_stats = machine_stats or {}
+        puts(columns(
+            [name, 15],
+            [properties['driver'], 12],
+            [properties.get('ip', ''), 16],
+            [str(properties['running']), 8],
+            [str(properties['active']), 8],
+            [machine_stats.get('uptime', '-'), 15],
+            [machine_stats.get('load', '-'), 30],
+            [machine_stats.get('cpu', '-'), 26],
+            [machine_stats.get('memory', '-'), 26],
+            [machine_stats.get('disk', '-'), 26],
+        ))
+
+    for name, properties in machines.items():
+        if not properties['running']:
+            show_row(name, None)
+        elif history[name]:
+            show_row(name, format_summary(history[name]))
+    # Only machines the poller hasn't sampled recently are contacted
+    for name, machine_stats in get_fleet_stats([name for name in running if not history[name]]):
+        show_row(name, machine_stats)
+    puts('')
+
+
+def create_machine_prompt():
+    driver_options = []
+    for i, driver in enumerate(get_drivers()):
+        driver_options.append({'selector': str(i + 1), 'prompt': driver, 'return': driver})
+    driver_options.append({'selector': str(len(driver_options) + 1), 'prompt': 'Existing machine', 'return': 'existing'})
+
+    driver = prompt.options(colored.yellow('\nWhich provider?'), driver_options)
+
+    if driver != 'existing':
+        driver_config = DRIVERS[driver]
+
+        region = None
+        if 'regions' in driver_config:
+            region_options = []
+            for i, region in enumerate(driver_config['regions']):
+                region_options.append({'selector': str(i + 1), 'prompt': '{} - {}'.format(region[0], region[1]), 'return': region[0]})
+            region = prompt.options(colored.yellow('\nWhich region?'), region_options)
+
+        size = None
+        if 'sizes' in driver_config:
+            size_options = []
+            for i, size in enumerate(driver_config['sizes']):
+                size_options.append({'selector': str(i + 1), 'prompt': '{} - {}'.format(size[0], size[1]), 'return': size[0]})
+            size = prompt.options(colored.yellow('\nWhich machine size?'), size_options)
+
+        image = None
+        if 'images' in driver_config:
+            image_options = []
+            for i, image in enumerate(driver_config['images']):
+                image_options.append({'selector': str(i + 1), 'prompt': '{} - {}'.format(image[0], image[1]), 'return': image[0]})
+            image = prompt.options(colored.yellow('\nWhich machine image?'), image_options)
+
+    name = prompt.query('\nMachine name:', default='', validators=[validators.RegexValidator(r'^[a-z0-9-]{3,20}$', message='3-20 characters, lowercase with hyphens')])
+
+    if driver == 'existing':
+        ip = prompt.query('\nIP address:', default='', validators=[validators.RegexValidator(r'^\d{1,3}(\.\d{1,3}){3}$', message='An IPv4 address')])
+
+    machines = get_machines(check_running=False)
+    if name in machines:
+        puts(colored.red('\nMachine {} already exists!\n'.format(name)))
+    else:
+        if driver == 'existing':
+            puts(colored.cyan('\nProvisioning existing machine {}'.format(name)))
+            provision_machine(name, ip)
+        else:
+            puts(colored.cyan('\nCreating new machine {}'.format(name)))
+            create_machine(name, driver, region, size, image)
+        puts(colored.green('Done!\n'))
+
+
+def create_fleet_prompt():
+    path = prompt.query('\nFleet template:', default=FLEET_TEMPLATE_PATH)
+    specs = get_fleet_specs(load_fleet_template(path))
+    puts(colored.cyan('\nCreating and initializing {} machines\n'.format(len(specs))))
+    with progress.Bar(label='{0: <12} '.format(''), expected_size=len(specs), filled_char=colored.cyan('▮')) as bar:
+        finished = []
+
+        def update_bar(name, stage, error):
+            if stage == 'initialized' or error:
+                finished.append(name)
+            bar.label = colored.cyan('{0: <12} '.format(name[:12]))
+            bar.show(len(finished))
+
+        bar.show(0)
+        results = provision_fleet(specs, callback=update_bar)
+        bar.label = colored.green('{0: <12} '.format('Done!'))
+        bar.show(len(finished))
+    puts('')
+    for name, result in results.items():
+        if result['error']:
+            puts(colored.red('{}: {}'.format(name, result['error'])))
+        elif result['status'] == 'exists':
+            puts(colored.cyan('{}: already exists, initialized'.format(name)))
+    puts('')
+
+
+def destroy_machine_prompt():
+    machine = select_machine()
+    sure = prompt.query('\nAre you sure you want to destroy {}? [y/n]:'.format(machine), default='n', validators=[validators.RegexValidator(r'^[yn]$', message='Enter \'y\' or \'n\'')])
+    if sure == 'y':
+        puts('')
+        with progress.Bar(label=colored.cyan('Destroying in... '), expected_size=10, filled_char=colored.red('▮')) as bar:
+            for val in sorted(range(11), reverse=True):
+                bar.show(val)
+                sleep(1)
+        puts(colored.cyan('\nDestroying machine {}\n'.format(machine)))
+        destroy_machine(machine)
+        puts(colored.green('Done!\n'))
+
+
+def initialize_machine_prompt():
+    machine = select_machine(fleet=True)
+    verify = prompt.query('\nRe-check steps that were already applied? [y/n]:', default='n', validators=[validators.RegexValidator(r'^[yn]$', message='Enter \'y\' or \'n\'')]) == 'y'
+    puts('')
+
+    if machine == 'all':
+        machines = [name for name, properties in get_machines().items() if properties['running']]
+        with progress.Bar(label='{0: <12} '.format(''), expected_size=len(machines), filled_char=colored.cyan('▮')) as bar:
+            finished = []
+
+            def update_fleet_bar(name, results, error):
+                finished.append(name)
+                bar.label = colored.cyan('{0: <12} '.format(name[:12]))
+                bar.show(len(finished))
+
+            bar.show(0)
+            fleet_results = initialize_machines(machines, verify=verify, callback=update_fleet_bar)
+            bar.label = colored.green('{0: <12} '.format('Done!'))
+            bar.show(len(finished))
+        puts('')
+        for name, results in sorted(fleet_results.items()):
+            if isinstance(results, Exception):
+                puts(colored.red('{}: {}'.format(name, results)))
+            else:
+                for step, status, output in results:
+                    if status == 'failed':
+                        puts(colored.red('{}: failed {}'.format(name, step)))
+                        if output:
+                            puts(output)
+        puts('')
+        return
+
+    with progress.Bar(label='{0: <12} '.format('probing'), expected_size=len(get_initialize_steps()), filled_char=colored.cyan('▮')) as bar:
+        completed = []
+
+        def update_bar(name, status):
+            completed.append(name)
+            if status == 'failed':
+                bar.label = colored.red('{0: <12} '.format(name[:12]))
+            else:
+                bar.label = colored.cyan('{0: <12} '.format(name[:12]))
+            bar.show(len(completed))
+
+        bar.show(0)
+        results = initialize_machine_batch(machine, callback=update_bar, verify=verify)
+        bar.label = colored.green('{0: <12} '.format('Done!'))
+        bar.show(len(completed))
+    puts('')
+    for name, status, output in results:
+        if status == 'failed':
+            puts(colored.red('Failed: {}'.format(name)))
+            if output:
+                puts(output)
+    puts('')
+
+
+def build_docker_images():
+    images = get_private_images()
+    image_options = []
+    for i, image in enumerate(images):
+        image_options.append({'selector': str(i + 1), 'prompt': image, 'return': image})
+    image_options.append({'selector': len(image_options) + 1, 'prompt': '* ALL IMAGES *', 'return': 'all'})
+    image = prompt.options(colored.yellow('\nWhich image?'), image_options)
+
+    if image == 'all':
+        journal = open_journal('build')
+        puts(colored.cyan('\n{} building and pushing {} images\n'.format('Resuming' if journal['resumed'] else 'Started', len(images))))
+        errors = []
+        with progress.Bar(label='{0: <12} '.format(''), expected_size=len(images), filled_char=colored.cyan('▮')) as bar:
+            finished = []
+
+            def update_bar(image, status, error):
+                if status in ['pushed', 'cached', 'failed', 'cancelled']:
+                    finished.append(image)
+                if error:
+                    errors.append(error)
+                bar.label = colored.cyan('{0: <12} '.format(image[:12]))
+                bar.show(len(finished))
+
+            statuses = build_and_push_images(images, callback=update_bar, journal=journal)
+            bar.label = colored.green('{0: <12} '.format('Done!'))
+            bar.show(len(finished))
+        close_journal(journal, not errors and 'cancelled' not in statuses.values())
+        puts('')
+        for image, reason in sorted(journal['skipped'].items()):
+            puts(colored.cyan('Skipped {}: {}'.format(image, reason)))
+        pushed = [image for image in images if statuses[image] == 'pushed']
+        for image, report in sorted(get_layer_cache_report(pushed).items()):
+            puts(colored.cyan('{}: {} of {} steps cached'.format(image, report['cached'], report['steps'])))
+        for error in errors:
+            puts(colored.red('{}'.format(error)))
+        for image in images:
+            if statuses[image] == 'cancelled':
+                puts(colored.red('Skipped {} as an image it depends on failed'.format(image)))
+        puts('')
+    else:
+        puts(colored.cyan('\nBuilding {} image'.format(image)))
+        try:
+            fingerprint, cache = build_image_if_changed(image)
+        except Exception as e:
+            puts(colored.red('\n{}\n'.format(e)))
+            exit(1)
+        if not cache:
+            puts(colored.green('Unchanged since last push, skipping!\n'))
+            return
+        puts(colored.green('Done! {} of {} steps cached'.format(cache['cached'], cache['steps'])))
+        puts(colored.cyan('\nPushing {} image'.format(image)))
+        push_and_record_image(image, fingerprint, cache)
+        puts(colored.green('Done!\n'))
+
+
+def initialize_docker_containers():
+    machine = select_machine(fleet=True)
+
+    containers = get_containers()
+    container_options = []
+    for i, container in enumerate(containers):
+        container_options.append({'selector': str(i + 1), 'prompt': container, 'return': container})
+    container_options.append({'selector': len(container_options) + 1, 'prompt': '* ALL CONTAINERS *', 'return': 'all'})
+    container = prompt.options(colored.yellow('\nWhich container?'), container_options)
+    puts('')
+
+    if container == 'all':
+        container = None
+
+    if machine == 'all':
+        machines = [name for name, properties in get_machines().items() if properties['running']]
+        summary = rollout(machines, container)
+        puts('')
+        puts(columns([(colored.cyan('Name', bold=True)), 15], [(colored.cyan('Status')), 10], [(colored.cyan('Prefetch')), 10], [(colored.cyan('Deploy')), 10], [(colored.cyan('Recreated')), 30], [(colored.cyan('Error')), 40]))
+        for name, result in summary.items():
+            status = colored.green(result['status']) if result['status'] == 'deployed' else colored.red(result['status'])
+            puts(columns(
+                [name, 15],
+                [status, 10],
+                ['{:.1f}s'.format(result['prefetch_seconds']) if result['prefetch_seconds'] is not None else '-', 10],
+                ['{:.1f}s'.format(result['deploy_seconds']) if result['deploy_seconds'] is not None else '-', 10],
+                [', '.join([service for service, reason in result['recreated']]) or '-', 30],
+                [result['error'] or '', 40],
+            ))
+    else:
+        launch_docker_compose(machine, container)
+    puts('')
+
+
+def sync_volumes():
+    src_machine = select_machine(message='Which source machine to sync volumes from?', master=True)
+    dst_machine = select_machine(message='Which destination machine to sync volumes to?', master=True, local=True)
+
+    if dst_machine == 'local':
+        volumes = get_volumes(show_un_backed_up=True)
+    else:
+        volumes = get_volumes()
+    volume_options = []
+    for i, volume in enumerate(volumes):
+        volume_options.append({'selector': str(i + 1), 'prompt': volume, 'return': volume})
+    volume_options.append({'selector': len(volume_options) + 1, 'prompt': '* ALL VOLUMES *', 'return': 'all'})
+    volume = prompt.options(colored.yellow('\nWhich volume?'), volume_options)
+
+    if volume == 'all':
+        journal = open_journal('sync-volumes', src_machine, dst_machine)
+        puts(colored.cyan('\n{} synchronizing {} volumes from {} to {}\n'.format('Resuming' if journal['resumed'] else 'Started', len(volumes), src_machine, dst_machine)))
+        with progress.Bar(label='{0: <12} '.format(''), expected_size=len(volumes), filled_char=colored.cyan('▮')) as bar:
+            finished = []
+
+            def update_bar(volume, error):
+                finished.append(volume)
+                bar.label = colored.cyan('{0: <12} '.format(volume[:12]))
+                bar.show(len(finished))
+
+            bar.show(0)
+            errors = sync_volumes_concurrently(volumes, src_machine, dst_machine, callback=update_bar, journal=journal)
+            bar.label = colored.green('{0: <12} '.format('Done!'))
+            bar.show(len(finished))
+        close_journal(journal, not errors)
+        puts('')
+        for volume, reason in sorted(journal['skipped'].items()):
+            puts(colored.cyan('Skipped {}: {}'.format(volume, reason)))
+        for volume, error in sorted(errors.items()):
+            puts(colored.red('Failed to sync {}: {}'.format(volume, error)))
+        if errors:
+            puts('')
+    else:
+        puts(colored.cyan('\nSynchronizing {} volume from {} to {}\n'.format(volume, src_machine, dst_machine)))
+        with progress.Bar(label='{0: <12} '.format(''), expected_size=100, filled_char=colored.cyan('▮')) as bar:
+
+            def update_bar(value):
+                bar.label = colored.cyan('{0: <24} '.format(format_progress(value)[:24]))
+                bar.show(int(value['percent'] or 0))
+
+            bar.show(0)
+            sync_volume(volume, src_machine, dst_machine, progress=update_bar)
+            bar.label = colored.green('{0: <24} '.format('Done!'))
+            bar.show(100)
+        puts('')
+
+
+def backup_volumes_prompt():
+    machine_selection = select_machine(message='Which machine to back up volumes from?')
+
+    volumes = get_volumes()
+    volume_options = []
+    for i, volume in enumerate(volumes):
+        volume_options.append({'selector': str(i + 1), 'prompt': volume, 'return': volume})
+    volume_options.append({'selector': len(volume_options) + 1, 'prompt': '* ALL VOLUMES *', 'return': 'all'})
+    volume = prompt.options(colored.yellow('\nWhich volume?'), volume_options)
+    if volume != 'all':
+        volumes = [volume]
+
+    puts(colored.cyan('\nBacking up {} volumes from {} to master\n'.format(len(volumes), machine_selection)))
+
+    def show_result(volume, result, error):
+        if error:
+            puts(colored.red('{0: <20} failed: {1}'.format(volume, error)))
+        else:
+            puts('{0: <20} {1}, {2} files, {3} new chunks ({4:.1f}MB)'.format(volume, result['snapshot'], result['files'], result['new_chunks'], result['new_bytes'] / 1048576.0))
+
+    results, errors = backup_volumes(volumes, machine_selection, callback=show_result)
+    prune = not errors and prompt.query('\nDelete all but the newest {} snapshots of each volume? [y/n]:'.format(BACKUP_KEEP_SNAPSHOTS), default='n', validators=[validators.RegexValidator(r'^[yn]$', message='Enter \'y\' or \'n\'')]) == 'y'
+    if prune:
+        pruned = prune_snapshots()
+        puts(colored.cyan('\nPruned {} old snapshots and {} chunks ({:.1f}MB)'.format(pruned['snapshots'], pruned['chunks'], pruned['bytes'] / 1048576.0)))
+    puts(colored.green('Done!\n'))
+
+
+def restore_volume_prompt():
+    volumes = get_volumes()
+    volume_options = []
+    for i, volume in enumerate(volumes):
+        volume_options.append({'selector': str(i + 1), 'prompt': volume, 'return': volume})
+    volume = prompt.options(colored.yellow('\nWhich volume?'), volume_options)
+
+    snapshots = list_snapshots(volume)
+    if not snapshots:
+        puts(colored.red('\nThere are no snapshots of {}\n'.format(volume)))
+        return
+    snapshot_options = []
+    for i, snapshot in enumerate(reversed(snapshots)):
+        snapshot_options.append({'selector': str(i + 1), 'prompt': snapshot, 'return': snapshot})
+    snapshot = prompt.options(colored.yellow('\nWhich snapshot?'), snapshot_options)
+
+    machine_selection = select_machine(message='Which machine to restore it to?')
+    puts(colored.cyan('\nRestoring {} from snapshot {} to {}'.format(volume, snapshot, machine_selection)))
+    restore_volume(volume, machine_selection, snapshot)
+    puts(colored.green('Done!\n'))
+
+
+def sync_databases_from_master():
+    databases = get_databases()
+    database_options = []
+    for i, database in enumerate(databases):
+        database_options.append({'selector': str(i + 1), 'prompt': database, 'return': database})
+    database_options.append({'selector': len(database_options) + 1, 'prompt': '* ALL DATABASES *', 'return': 'all'})
+    database = prompt.options(colored.yellow('\nWhich database?'), database_options)
+
+    machine_selection = select_machine()
+
+    if database == 'all':
+        journal = open_journal('sync-db', machine_selection)
+        puts(colored.cyan('\n{} synchronizing {} databases from master to {}\n'.format('Resuming' if journal['resumed'] else 'Started', len(databases), machine_selection)))
+        with progress.Bar(label='{0: <12} '.format(''), expected_size=len(databases), filled_char=colored.cyan('▮')) as bar:
+            finished = []
+
+            def update_bar(database, error):
+                finished.append(database)
+                bar.label = colored.cyan('{0: <12} '.format(database[:12]))
+                bar.show(len(finished))
+
+            bar.show(0)
+            errors = restore_databases(databases, machine_selection, callback=update_bar, journal=journal)
+            bar.label = colored.green('{0: <12} '.format('Done!'))
+            bar.show(len(finished))
+        close_journal(journal, not errors)
+        puts('')
+        for database, reason in sorted(journal['skipped'].items()):
+            puts(colored.cyan('Skipped {}: {}'.format(database, reason)))
+        for database, error in sorted(errors.items()):
+            puts(colored.red('Failed to sync {}: {}'.format(database, error)))
+        if errors:
+            puts('')
+    else:
+        puts(colored.cyan('\nSynchronizing {} database from master to {}'.format(database, machine_selection)))
+        restore_database(database, machine_selection)
+        puts(colored.green('Done!\n'))
+
+
+def dump_databases_to_master():
+    machine_selection = select_machine(message='Which machine to dump databases from?')
+
+    databases = get_databases()
+    database_options = []
+    for i, database in enumerate(databases):
+        database_options.append({'selector': str(i + 1), 'prompt': database, 'return': database})
+    database_options.append({'selector': len(database_options) + 1, 'prompt': '* ALL DATABASES *', 'return': 'all'})
+    database = prompt.options(colored.yellow('\nWhich database?'), database_options)
+    if database != 'all':
+        databases = [database]
+
+    puts(colored.cyan('\nDumping {} database{} from {} to master\n'.format(len(databases), '' if len(databases) == 1 else 's', machine_selection)))
+    with progress.Bar(label='{0: <12} '.format(''), expected_size=len(databases), filled_char=colored.cyan('▮')) as bar:
+        finished = []
+
+        def update_bar(database, error):
+            finished.append(database)
+            bar.label = colored.cyan('{0: <12} '.format(database[:12]))
+            bar.show(len(finished))
+
+        bar.show(0)
+        errors = dump_databases(databases, machine_selection, callback=update_bar)
+        bar.label = colored.green('{0: <12} '.format('Done!'))
+        bar.show(len(finished))
+    puts('')
+    for database, error in sorted(errors.items()):
+        puts(colored.red('Failed to dump {}: {}'.format(database, error)))
+    if errors:
+        puts('')
+
+
+def place_services_prompt():
+    puts(colored.cyan('\nPlanning services across running machines from their free memory and CPUs\n'))
+    plan = get_placement_plan()
+    puts(columns([(colored.cyan('Name', bold=True)), 15], [(colored.cyan('Memory')), 20], [(colored.cyan('CPUs')), 14], [(colored.cyan('Services')), 60]))
+    for name, machine in sorted(plan['machines'].items()):
+        puts(columns(
+            [name, 15],
+            ['{:.0f}/{:.0f}MB'.format(machine['memory'] / 1024 ** 2, machine['memory_capacity'] / 1024 ** 2), 20],
+            ['{:.2f}/{:.2f}'.format(machine['cpus'], machine['cpus_capacity']), 14],
+            [', '.join(machine['services']) or '-', 60],
+        ))
+    puts('')
+    for name in plan['unreachable']:
+        puts(colored.red('Could not reach {}, left out of the plan'.format(name)))
+    for service, reason in sorted(plan['unplaced'].items()):
+        puts(colored.red('Nowhere to put {}: {}'.format(service, reason)))
+    if plan['unreachable'] or plan['unplaced']:
+        puts('')
+
+    deploy = prompt.query('Deploy this plan? [y/n]:', default='n', validators=[validators.RegexValidator(r'^[yn]$', message='Enter \'y\' or \'n\'')]) == 'y'
+    if not deploy:
+        return
+
+    def show_result(name, stage, error):
+        if stage == 'deployed':
+            puts(colored.red('Failed to deploy to {}: {}'.format(name, error)) if error else colored.green('Deployed to {}'.format(name)))
+        else:
+            puts(colored.red('Failed to stop moved services on {}: {}'.format(name, error)) if error else colored.green('Stopped moved services on {}'.format(name)))
+
+    errors, kept = deploy_placement(plan, callback=show_result)
+    for service, reason in sorted(kept.items()):
+        puts(colored.yellow('Left {} where it is: {}'.format(service, reason)))
+    for name in plan['unreachable']:
+        puts(colored.red('Could not reach {}, services moved off it may still be running there'.format(name)))
+    puts(colored.green('Done!\n') if not errors else '')
+
+
+def main_menu():
+    main_options = [
+        {'selector': '1', 'prompt': 'View machines', 'return': view_machines_prompt},
+        {'selector': '2', 'prompt': 'Create new machine', 'return': create_machine_prompt},
+        {'selector': '3', 'prompt': 'Initialize machine', 'return': initialize_machine_prompt},
+        {'selector': '4', 'prompt': 'Build and push docker images', 'return': build_docker_images},
+        {'selector': '5', 'prompt': 'Initialize/recreate docker containers', 'return': initialize_docker_containers},
+        {'selector': '6', 'prompt': 'Sync volumes', 'return': sync_volumes},
+        {'selector': '7', 'prompt': 'Sync databases from master to node', 'return': sync_databases_from_master},
+        {'selector': '8', 'prompt': 'Destroy machine', 'return': destroy_machine_prompt},
+        {'selector': '9', 'prompt': 'Create machines from fleet template', 'return': create_fleet_prompt},
+        {'selector': '10', 'prompt': 'Back up volumes to master', 'return': backup_volumes_prompt},
+        {'selector': '11', 'prompt': 'Restore volume from a backup', 'return': restore_volume_prompt},
+        {'selector': '12', 'prompt': 'Dump databases from node to master', 'return': dump_databases_to_master},
+        {'selector': '13', 'prompt': 'Plan service placement', 'return': place_services_prompt},
+    ]
+    try:
+        selection = prompt.options(colored.yellow('\nWhat do you want to do?'), main_options)
+        selection()
+    except KeyboardInterrupt:
+        puts('\n')
+
@@ -1,264 +1,360 @@
 #!/usr/bin/env python
+import time
+started = time.perf_counter()
+
+import argparse
+from contextlib import redirect_stdout
+import json
 import logging
-from time import sleep
+import sys
 
-from clint.textui import columns, prompt, puts, colored, validators, progress
 
-from utils.databases import get_databases, sync_database_dump, load_database_dump
-from utils.docker_compose import launch_docker_compose, get_containers
-from utils.docker_images import get_private_images, build_image, push_image
-from utils.docker_machine import DRIVERS, get_machines, create_machine, provision_machine, destroy_machine, get_drivers
-from utils.initialize import initialize_ssh_keys, initialize_swap, initialize_automatic_updates, initialize_default_apt_packages, initialize_docker_authentication, initialize_volumes
-from utils.stats import get_machine_stats
-from utils.volumes import get_volumes, sync_volume
+LOG_LEVEL = logging.ERROR
+# Seconds from start until a subcommand has imported what it needs
+STARTUP_BUDGET = 0.3
+
+startup_seconds = None
+
+
+def startup_complete():
+    '''
+    Called by each subcommand once its imports are done and it is about to
+    start real work.
+    '''
+    global startup_seconds
+    startup_seconds = time.perf_counter() - started
+    if startup_seconds > STARTUP_BUDGET:
+        sys.stderr.write('Startup took {:.3f}s, over the {:.3f}s budget\n'.format(startup_seconds, STARTUP_BUDGET))
+
+
+def select_items(requested, available, everything, kind):
+    if everything:
+        return available
+    unknown = [item for item in requested if item not in available]
+    if unknown:
+        raise KeyError('Unknown {}: {}'.format(kind, ', '.join(unknown)))
+    if not requested:
+        raise ValueError('Name at least one {} or pass --all'.format(kind))
+    return requested
+
+
+def format_errors(errors):
+    return {key: str(error) for key, error in sorted(errors.items())}
+
+
+def format_init_results(results):
+    '''
+    Returns the status of each init step under `steps` and the end of the
+    output of each step that failed under `errors`.
+    '''
+    return {
+        'steps': {name: status for name, status, output in results},
+        'errors': {name: output for name, status, output in results if status == 'failed'},
+    }
+
+
+def get_progress_printer(enabled, interval=1.0):
+    '''
+    Returns a `progress(item, progress)` callback that writes progress to
+    stderr, at most once every `interval` seconds for each item, so stdout
+    stays JSON. Returns None when `enabled` is false.
+    '''
+    if not enabled:
+        return None
+    from utils.runner import format_progress
+    printed = {}
+
+    def progress(item, value):
+        now = time.time()
+        if now - printed.get(item, 0) >= interval:
+            printed[item] = now
+            sys.stderr.write('{}: {}\n'.format(item, format_progress(value)))
+    return progress
+
+
+def command_stats(args):
+    from utils.docker_machine import get_machines
+    from utils.stats import STATS_WINDOWS, get_fleet_stats, get_fleet_history
+    startup_complete()
 
+    machines = get_machines()
+    result = {name: dict(properties, stats=None) for name, properties in machines.items()}
+    running = [name for name, properties in machines.items() if properties['running']]
+    if args.history:
+        for name, summary in get_fleet_history(running, STATS_WINDOWS[args.history]).items():
+            result[name]['stats'] = summary
+    else:
+        for name, machine_stats in get_fleet_stats(running):
+            result[name]['stats'] = machine_stats
+    return result, True
 
-LOG_LEVEL = logging.ERROR
 
+def command_poll_stats(args):
+    from utils.stats import STATS_INTERVAL, poll_stats
+    startup_complete()
 
-def select_machine(message=None, master=False, local=False):
-    machines = get_machines()
-    machine_options = []
-    for i, machine in enumerate(sorted([k for k, v in machines.items() if v['running']])):
-        machine_options.append({'selector': str(i + 1), 'prompt': machine, 'return': machine})
-    if master:
-        i += 1
-        machine_options.append({'selector': str(i + 1), 'prompt': 'master', 'return': 'master'})
-    if local:
-        i += 1
-        machine_options.append({'selector': str(i + 1), 'prompt': 'local', 'return': 'local'})
-
-    if not message:
-        message = 'Which machine?'
-    return prompt.options(colored.yellow('\n{}'.format(message)), machine_options)
-
-
-def view_machines_prompt():
-    machines = get_machines()
-    puts('')
-    puts(columns([(colored.cyan('Name', bold=True)), 15], [(colored.cyan('Driver')), 15], [(colored.cyan('IP')), 20], [(colored.cyan('Running')), 10], [(colored.cyan('Active')), 10], [(colored.cyan('Uptime')), 15], [(colored.cyan('Load')), 20], [(colored.cyan('Disk')), 25]))
-    for name, properties in machines.items():
-        machine_stats = get_machine_stats(name)
-        puts(columns(
-            [name, 15],
-            [properties['driver'], 15],
-            [properties['ip'], 20],
-            [str(properties['running']), 10],
-            [str(properties['active']), 10],
-            [machine_stats['uptime'], 15],
-            [machine_stats['load'], 20],
-            [machine_stats['disk'], 25],
-        ))
-    puts('')
-
-
-def create_machine_prompt():
-    driver_options = []
-    for i, driver in enumerate(get_drivers()):
-        driver_options.append({'selector': str(i + 1), 'prompt': driver, 'return': driver})
-    driver_options.append({'selector': str(len(driver_options) + 1), 'prompt': 'Existing machine', 'return': 'existing'})
-
-    driver = prompt.options(colored.yellow('\nWhich provider?'), driver_options)
-
-    if driver != 'existing':
-        driver_config = DRIVERS[driver]
-
-        region = None
-        if 'regions' in driver_config:
-            region_options = []
-            for i, region in enumerate(driver_config['regions']):
-                region_options.append({'selector': str(i + 1), 'prompt': '{} - {}'.format(region[0], region[1]), 'return': region[0]})
-            region = prompt.options(colored.yellow('\nWhich region?'), region_options)
-
-        size = None
-        if 'sizes' in driver_config:
-            size_options = []
-            for i, size in enumerate(driver_config['sizes']):
-                size_options.append({'selector': str(i + 1), 'prompt': '{} - {}'.format(size[0], size[1]), 'return': size[0]})
-            size = prompt.options(colored.yellow('\nWhich machine size?'), size_options)
-
-        image = None
-        if 'images' in driver_config:
-            image_options = []
-            for i, image in enumerate(driver_config['images']):
-                image_options.append({'selector': str(i + 1), 'prompt': '{} - {}'.format(image[0], image[1]), 'return': image[0]})
-            image = prompt.options(colored.yellow('\nWhich machine image?'), image_options)
-
-    name = prompt.query('\nMachine name:', default='', validators=[validators.RegexValidator(r'^[a-z0-9-]{3,20}$', message='3-20 characters, lowercase with hyphens')])
+    counts = {}
 
-    machines = get_machines()
-    if name in machines:
-        puts(colored.red('\nMachine {} already exists!\n'.format(name)))
-    else:
-        if driver == 'existing':
-            puts(colored.cyan('\nProvisioning existing machine {}'.format(name)))
-            provision_machine(name)
-        else:
-            puts(colored.cyan('\nCreating new machine {}'.format(name)))
-            create_machine(name, driver, region, size, image)
-        puts(colored.green('Done!\n'))
-
-
-def destroy_machine_prompt():
-    machine = select_machine()
-    sure = prompt.query('\nAre you sure you want to destroy {}? [y/n]:'.format(machine), default='n', validators=[validators.RegexValidator(r'^[yn]$', message='Enter \'y\' or \'n\'')])
-    if sure == 'y':
-        puts('')
-        with progress.Bar(label=colored.cyan('Destroying in... '), expected_size=10, filled_char=colored.red('▮')) as bar:
-            for val in sorted(range(11), reverse=True):
-                bar.show(val)
-                sleep(1)
-        puts(colored.cyan('\nDestroying machine {}\n'.format(machine)))
-        destroy_machine(machine)
-        puts(colored.green('Done!\n'))
-
-
-def initialize_machine_prompt():
-    machine = select_machine()
-    tasks = [
-        ('ssh keys',        initialize_ssh_keys),
-        ('swap',            initialize_swap),
-        ('auto update',     initialize_automatic_updates),
-        ('apt packages',    initialize_default_apt_packages),
-        ('docker auth',     initialize_docker_authentication),
-        ('volumes',         initialize_volumes),
-    ]
-    puts('')
-    with progress.Bar(label='{0: <12} '.format(''), expected_size=len(tasks), filled_char=colored.cyan('▮')) as bar:
-        for i, (name, function) in enumerate(tasks):
-            bar.label = colored.cyan('{0: <12} '.format(name[:12]))
-            bar.show(i)
-            function(machine)
-            bar.show(i)
-        bar.label = colored.green('{0: <12} '.format('Done!'))
-        bar.show(i)
-    puts('')
-
-
-def build_docker_images():
-    images = get_private_images()
-    image_options = []
-    for i, image in enumerate(images):
-        image_options.append({'selector': str(i + 1), 'prompt': image, 'return': image})
-    image_options.append({'selector': len(image_options) + 1, 'prompt': '* ALL IMAGES *', 'return': 'all'})
-    image = prompt.options(colored.yellow('\nWhich image?'), image_options)
-
-    if image == 'all':
-        puts(colored.cyan('\nBuilding {} images\n'.format(len(images))))
-        with progress.Bar(label='{0: <12} '.format(''), expected_size=len(images), filled_char=colored.cyan('▮')) as bar:
-            val = 0
-            for image in images:
-                bar.label = colored.cyan('{0: <12} '.format(image[:12]))
-                bar.show(val)
-                try:
-                    build_image(image)
-                except Exception as e:
-                    puts(colored.red('\n{}\n'.format(e)))
-                    exit(1)
-                val += 1
-                bar.show(val)
-            bar.label = colored.green('{0: <12} '.format('Done!'))
-            bar.show(val)
-
-        puts(colored.cyan('\nPushing {} images\n'.format(len(images))))
-        with progress.Bar(label='{0: <12} '.format(''), expected_size=len(images), filled_char=colored.cyan('▮')) as bar:
-            val = 0
-            for image in images:
-                bar.label = colored.cyan('{0: <12} '.format(image[:12]))
-                bar.show(val)
-                push_image(image)
-                val += 1
-                bar.show(val)
-            bar.label = colored.green('{0: <12} '.format('Done!'))
-            bar.show(val)
-        puts('')
-    else:
-        puts(colored.cyan('\nBuilding {} image'.format(image)))
-        try:
-            build_image(image)
-        except Exception as e:
-            puts(colored.red('\n{}\n'.format(e)))
-            exit(1)
-        puts(colored.green('Done!'))
-        puts(colored.cyan('\nPushing {} image'.format(image)))
-        push_image(image)
-        puts(colored.green('Done!\n'))
-
-
-def initialize_docker_containers():
-    machine = select_machine()
-
-    containers = get_containers()
-    container_options = []
-    for i, container in enumerate(containers):
-        container_options.append({'selector': str(i + 1), 'prompt': container, 'return': container})
-    container_options.append({'selector': len(container_options) + 1, 'prompt': '* ALL CONTAINERS *', 'return': 'all'})
-    container = prompt.options(colored.yellow('\nWhich container?'), container_options)
-    puts('')
-
-    if container == 'all':
-        launch_docker_compose(machine)
-    else:
-        launch_docker_compose(machine, container)
-    puts('')
+    def callback(name, sample):
+        counts.setdefault(name, {'sampled': 0, 'unreachable': 0})['sampled' if sample else 'unreachable'] += 1
+        if not sample:
+            sys.stderr.write('Could not sample {}\n'.format(name))
 
+    poll_stats(args.interval or STATS_INTERVAL, iterations=1 if args.once else None, callback=callback)
+    return counts, all(not count['unreachable'] for count in counts.values())
 
-def sync_volumes():
-    src_machine = select_machine(message='Which source machine to sync volumes from?', master=True)
-    dst_machine = select_machine(message='Which destination machine to sync volumes to?', master=True, local=True)
 
-    if dst_machine == 'local':
-        volumes = get_volumes(show_un_backed_up=True)
-    else:
-        volumes = get_volumes()
-    volume_options = []
-    for i, volume in enumerate(volumes):
-        volume_options.append({'selector': str(i + 1), 'prompt': volume, 'return': volume})
-    volume_options.append({'selector': len(volume_options) + 1, 'prompt': '* ALL VOLUMES *', 'return': 'all'})
-    volume = prompt.options(colored.yellow('\nWhich volume?'), volume_options)
-
-    if volume == 'all':
-        puts(colored.cyan('\nSynchronizing {} volumes from {} to {}\n'.format(len(volumes), src_machine, dst_machine)))
-        with progress.Bar(label='{0: <12} '.format(''), expected_size=len(volumes), filled_char=colored.cyan('▮')) as bar:
-            for i, volume in enumerate(volumes):
-                bar.label = colored.cyan('{0: <12} '.format(volume[:12]))
-                bar.show(i)
-                sync_volume(volume, src_machine, dst_machine)
-            bar.label = colored.green('{0: <12} '.format('Done!'))
-            bar.show(i + 1)
-        puts('')
-    else:
-        puts(colored.cyan('\nSynchronizing {} volume from {} to {}'.format(volume, src_machine, dst_machine)))
-        sync_volume(volume, src_machine, dst_machine)
-        puts(colored.green('Done!\n'))
-
-
-def sync_databases_from_master():
-    databases = get_databases()
-    database_options = []
-    for i, database in enumerate(databases):
-        database_options.append({'selector': str(i + 1), 'prompt': database, 'return': database})
-    database_options.append({'selector': len(database_options) + 1, 'prompt': '* ALL DATABASES *', 'return': 'all'})
-    database = prompt.options(colored.yellow('\nWhich database?'), database_options)
-
-    machine_selection = select_machine()
-
-    if database == 'all':
-        puts(colored.cyan('\nSynchronizing {} databases from master to {}\n'.format(len(databases), machine_selection)))
-        with progress.Bar(label='{0: <12} '.format(''), expected_size=len(databases), filled_char=colored.cyan('▮')) as bar:
-            for i, database in enumerate(databases):
-                bar.label = colored.cyan('{0: <12} '.format(database[:12]))
-                bar.show(i)
-                sync_database_dump(database, 'master', machine_selection)
-                load_database_dump(database, machine_selection)
-            bar.label = colored.green('{0: <12} '.format('Done!'))
-            bar.show(i + 1)
-        puts('')
-    else:
-        puts(colored.cyan('\nSynchronizing {} database from master to {}'.format(database, machine_selection)))
-        sync_database_dump(database, 'master', machine_selection)
-        load_database_dump(database, machine_selection)
-        puts(colored.green('Done!\n'))
+def command_init(args):
+    from utils.docker_machine import get_machines
+    from utils.initialize import initialize_machines
+    startup_complete()
+
+    machines = select_items(args.machines, [name for name, properties in get_machines().items() if properties['running']], args.all, 'machine')
+    results = initialize_machines(machines, verify=args.verify)
+    output = {}
+    ok = True
+    for name, machine_results in results.items():
+        if isinstance(machine_results, Exception):
+            output[name] = {'error': str(machine_results)}
+            ok = False
+        else:
+            output[name] = format_init_results(machine_results)
+            ok = ok and not output[name]['errors']
+    return output, ok
+
+
+def command_fleet(args):
+    from utils.fleet import FLEET_TEMPLATE_PATH, load_fleet_template, get_fleet_specs, provision_fleet
+    startup_complete()
+
+    results = provision_fleet(get_fleet_specs(load_fleet_template(args.template or FLEET_TEMPLATE_PATH)))
+    for result in results.values():
+        if result['initialized']:
+            result['initialized'] = format_init_results(result['initialized'])
+    return results, all(not result['error'] and not result['initialized']['errors'] for result in results.values())
+
+
+def command_build(args):
+    from utils.build_cache import get_layer_cache_report
+    from utils.docker_images import get_private_images, build_and_push_images
+    from utils.journal import close_journal, open_journal
+    startup_complete()
+
+    images = select_items(args.images, get_private_images(), args.all, 'image')
+    errors = {}
+    journal = open_journal('build', resume=not args.restart)
+    statuses = build_and_push_images(images, callback=lambda image, status, error: errors.update({image: error}) if error else None, progress=get_progress_printer(args.progress), journal=journal)
+    ok = not errors and 'cancelled' not in statuses.values()
+    close_journal(journal, ok)
+    layer_cache = get_layer_cache_report([image for image, status in statuses.items() if status == 'pushed'])
+    return {'statuses': statuses, 'layer_cache': layer_cache, 'skipped': journal['skipped'], 'errors': format_errors(errors)}, ok
+
+
+def command_deploy(args):
+    from utils.docker_compose import launch_docker_compose
+    startup_complete()
+
+    plan = launch_docker_compose(args.machine, args.service)
+    return {'machine': args.machine, 'recreated': [{'service': service, 'reason': reason} for service, reason in plan]}, True
+
+
+def command_rollout(args):
+    from utils.docker_machine import get_machines
+    from utils.docker_compose import rollout
+    startup_complete()
+
+    machines = args.machines or [name for name, properties in get_machines().items() if properties['running']]
+    options = {}
+    if args.concurrency is not None:
+        options['concurrency'] = args.concurrency
+    if args.max_failures is not None:
+        options['max_failures'] = args.max_failures
+    summary = rollout(machines, args.service, **options)
+    return summary, all(result['status'] == 'deployed' for result in summary.values())
+
+
+def command_place(args):
+    from utils.placement import PLACEMENT_STRATEGY, deploy_placement, get_placement_plan
+    startup_complete()
+
+    plan = get_placement_plan(args.machines or None, args.strategy or PLACEMENT_STRATEGY)
+    if not args.deploy:
+        return plan, not plan['unplaced']
+    errors, plan['kept'] = deploy_placement(plan)
+    plan['errors'] = format_errors(errors)
+    return plan, not plan['unplaced'] and not plan['errors']
+
+
+def command_sync_volumes(args):
+    from utils.journal import close_journal, open_journal
+    from utils.volumes import get_volumes, sync_volumes_concurrently
+    startup_complete()
+
+    volumes = select_items(args.volumes, get_volumes(show_un_backed_up=args.dst == 'local'), args.all, 'volume')
+    journal = open_journal('sync-volumes', args.src, args.dst, resume=not args.restart)
+    errors = sync_volumes_concurrently(volumes, args.src, args.dst, verify=args.verify, progress=get_progress_printer(args.progress), journal=journal)
+    close_journal(journal, not errors)
+    return {'volumes': volumes, 'skipped': journal['skipped'], 'errors': format_errors(errors)}, not errors
+
+
+def command_backup(args):
+    from utils.backups import backup_volumes, prune_snapshots
+    from utils.volumes import get_volumes
+    startup_complete()
+
+    volumes = select_items(args.volumes, get_volumes(), args.all, 'volume')
+    results, errors = backup_volumes(volumes, args.machine)
+    output = {'snapshots': results, 'errors': format_errors(errors)}
+    if args.prune and not errors:
+        output['pruned'] = prune_snapshots()
+    return output, not errors
+
+
+def command_restore_volume(args):
+    from utils.backups import restore_volume
+    from utils.volumes import get_volumes
+    startup_complete()
+
+    volumes = select_items(args.volumes, get_volumes(), args.all, 'volume')
+    restored = {}
+    errors = {}
+    for volume in volumes:
+        try:
+            restored[volume] = restore_volume(volume, args.machine, args.snapshot)
+        except Exception as e:
+            errors[volume] = e
+    return {'snapshots': restored, 'errors': format_errors(errors)}, not errors
+
+
+def command_snapshots(args):
+    from utils.backups import list_snapshots
+    from utils.volumes import get_volumes
+    startup_complete()
+
+    return {volume: list_snapshots(volume) for volume in args.volumes or get_volumes()}, True
+
+
+def command_sync_db(args):
+    from utils.databases import get_databases, restore_databases
+    from utils.journal import close_journal, open_journal
+    startup_complete()
+
+    databases = select_items(args.databases, get_databases(), args.all, 'database')
+    journal = open_journal('sync-db', args.machine, resume=not args.restart)
+    errors = restore_databases(databases, args.machine, journal=journal)
+    close_journal(journal, not errors)
+    return {'databases': databases, 'skipped': journal['skipped'], 'errors': format_errors(errors)}, not errors
+
+
+def command_dump_db(args):
+    from utils.databases import get_databases, dump_databases
+    startup_complete()
+
+    databases = select_items(args.databases, get_databases(), args.all, 'database')
+    errors = dump_databases(databases, args.machine)
+    return {'databases': databases, 'errors': format_errors(errors)}, not errors
+
+
+def finish_tracing(args):
+    from utils.tracing import export_traces, get_summary, TRACE_PATH, CHROME_TRACE_PATH
+    export_traces(args.trace or TRACE_PATH, args.chrome_trace or CHROME_TRACE_PATH)
+    if args.trace_summary:
+        sys.stderr.write('\n'.join(get_summary()) + '\n')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Build, deploy, back up and move Docker Compose environments. Runs the interactive menu when no command is given.')
+    parser.add_argument('--trace', metavar='PATH', help='write a JSON trace of every operation and external command')
+    parser.add_argument('--chrome-trace', metavar='PATH', help='write the trace in Chrome trace event format for chrome://tracing or Perfetto')
+    parser.add_argument('--trace-summary', action='store_true', help='print the slowest operations to stderr when finished')
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparser = subparsers.add_parser('stats', help='show every machine with its uptime, load and disk usage')
+    subparser.add_argument('--history', choices=['hour', 'day'], help='summarize the samples stored by poll-stats instead of contacting the machines')
+    subparser.set_defaults(func=command_stats)
+
+    subparser = subparsers.add_parser('poll-stats', help='keep sampling every running machine and store the history')
+    subparser.add_argument('--interval', type=int, help='seconds between samples')
+    subparser.add_argument('--once', action='store_true', help='take one sample of each machine and exit, for running from cron')
+    subparser.set_defaults(func=command_poll_stats)
+
+    subparser = subparsers.add_parser('init', help='initialize machines')
+    subparser.add_argument('machines', nargs='*')
+    subparser.add_argument('--all', action='store_true', help='every running machine')
+    subparser.add_argument('--verify', action='store_true', help='re-check steps that were already applied')
+    subparser.set_defaults(func=command_init)
+
+    subparser = subparsers.add_parser('fleet', help='create and initialize the machines in a fleet template')
+    subparser.add_argument('template', nargs='?', help='defaults to fleet.yml')
+    subparser.set_defaults(func=command_fleet)
+
+    subparser = subparsers.add_parser('build', help='build and push docker images')
+    subparser.add_argument('images', nargs='*')
+    subparser.add_argument('--all', action='store_true', help='every private image')
+    subparser.add_argument('--progress', action='store_true', help='report build and push progress on stderr')
+    subparser.add_argument('--restart', action='store_true', help='ignore what an unfinished earlier run got done')
+    subparser.set_defaults(func=command_build)
+
+    subparser = subparsers.add_parser('deploy', help='initialize or recreate docker containers on a machine')
+    subparser.add_argument('machine')
+    subparser.add_argument('service', nargs='?')
+    subparser.set_defaults(func=command_deploy)
+
+    subparser = subparsers.add_parser('rollout', help='prefetch images on several machines then deploy to them')
+    subparser.add_argument('machines', nargs='*', help='defaults to every running machine')
+    subparser.add_argument('--service', help='only deploy this service')
+    subparser.add_argument('--concurrency', type=int, default=None, help='machines to deploy at once')
+    subparser.add_argument('--max-failures', type=int, default=None, help='how many machines may fail to deploy before no more deploys are started')
+    subparser.set_defaults(func=command_rollout)
+
+    subparser = subparsers.add_parser('place', help='plan which machines to run each service on from their free memory and CPUs')
+    subparser.add_argument('machines', nargs='*', help='defaults to every running machine')
+    subparser.add_argument('--strategy', choices=['spread', 'pack'], default=None, help='leave every machine room, or fill machines up in turn')
+    subparser.add_argument('--deploy', action='store_true', help='then bring up each machine\'s services')
+    subparser.set_defaults(func=command_place)
+
+    subparser = subparsers.add_parser('sync-volumes', help='sync volumes between machines')
+    subparser.add_argument('src')
+    subparser.add_argument('dst')
+    subparser.add_argument('volumes', nargs='*')
+    subparser.add_argument('--all', action='store_true', help='every volume')
+    subparser.add_argument('--verify', action='store_true', help='rescan and checksum whole volumes')
+    subparser.add_argument('--progress', action='store_true', help='report bytes transferred on stderr')
+    subparser.add_argument('--restart', action='store_true', help='ignore what an unfinished earlier run got done')
+    subparser.set_defaults(func=command_sync_volumes)
+
+    subparser = subparsers.add_parser('backup', help='snapshot volumes from a machine into the deduplicated store on master')
+    subparser.add_argument('machine')
+    subparser.add_argument('volumes', nargs='*')
+    subparser.add_argument('--all', action='store_true', help='every backed up volume')
+    subparser.add_argument('--prune', action='store_true', help='then delete snapshots beyond BACKUP_KEEP_SNAPSHOTS')
+    subparser.set_defaults(func=command_backup)
+
+    subparser = subparsers.add_parser('restore-volume', help='restore volumes on a machine from snapshots on master')
+    subparser.add_argument('machine')
+    subparser.add_argument('volumes', nargs='*')
+    subparser.add_argument('--all', action='store_true', help='every backed up volume')
+    subparser.add_argument('--snapshot', help='snapshot name, defaults to the latest')
+    subparser.set_defaults(func=command_restore_volume)
+
+    subparser = subparsers.add_parser('snapshots', help='list the snapshots of volumes on master')
+    subparser.add_argument('volumes', nargs='*', help='defaults to every backed up volume')
+    subparser.set_defaults(func=command_snapshots)
+
+    subparser = subparsers.add_parser('sync-db', help='restore databases from master to a machine')
+    subparser.add_argument('machine')
+    subparser.add_argument('databases', nargs='*')
+    subparser.add_argument('--all', action='store_true', help='every database')
+    subparser.add_argument('--restart', action='store_true', help='ignore what an unfinished earlier run got done')
+    subparser.set_defaults(func=command_sync_db)
+
+    subparser = subparsers.add_parser('dump-db', help='dump databases from a machine to master, one file per table')
+    subparser.add_argument('machine')
+    subparser.add_argument('databases', nargs='*')
+    subparser.add_argument('--all', action='store_true', help='every database')
+    subparser.set_defaults(func=command_dump_db)
+
+    return parser
 
 
 def main():
@@ -269,21 +365,29 @@ def main():
     log.setLevel(LOG_LEVEL)
     log.addHandler(stream)
 
-    main_options = [
-        {'selector': '1', 'prompt': 'View machines', 'return': view_machines_prompt},
-        {'selector': '2', 'prompt': 'Create new machine', 'return': create_machine_prompt},
-        {'selector': '3', 'prompt': 'Initialize machine', 'return': initialize_machine_prompt},
-        {'selector': '4', 'prompt': 'Build and push docker images', 'return': build_docker_images},
-        {'selector': '5', 'prompt': 'Initialize/recreate docker containers', 'return': initialize_docker_containers},
-        {'selector': '6', 'prompt': 'Sync volumes', 'return': sync_volumes},
-        {'selector': '7', 'prompt': 'Sync databases from master to node', 'return': sync_databases_from_master},
-        {'selector': '8', 'prompt': 'Destroy machine', 'return': destroy_machine_prompt},
-    ]
+    args = get_parser().parse_args()
+
+    if not args.command:
+        from menu import main_menu
+        main_menu()
+        finish_tracing(args)
+        return
+
+    output = {'command': args.command}
     try:
-        selection = prompt.options(colored.yellow('\nWhat do you want to do?'), main_options)
-        selection()
-    except KeyboardInterrupt:
-        puts('\n')
+        # Keep stdout for the JSON by moving progress output to stderr
+        with redirect_stdout(sys.stderr):
+            output['result'], output['ok'] = args.func(args)
+    except Exception as e:
+        output['ok'] = False
+        output['error'] = str(e)
+    output['startup_seconds'] = startup_seconds
+    output['duration_seconds'] = time.perf_counter() - started
+    finish_tracing(args)
+
+    print(json.dumps(output, indent=2, sort_keys=True))
+    if not output['ok']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+from shlex import quote
+import threading
+import time
+
+import settings
+from utils.ssh import pin_host_key, run_command
+from utils.tracing import traced
+from utils.volumes import NODE_RSYNC_SHELL, VOLUME_SYNC_WORKERS, get_volume_path, sync_volume
+
+
+MASTER_BACKUPS_PATH = getattr(settings, 'MASTER_BACKUPS_PATH', '/root/backups/store')
+BACKUP_KEEP_SNAPSHOTS = getattr(settings, 'BACKUP_KEEP_SNAPSHOTS', 30)
+REMOTE_AGENT_PATH = '/var/lib/punk-deploy/chunk_store.py'
+REMOTE_CHUNK_CACHE_PATH = '/var/lib/punk-deploy/chunks'
+AGENT_PATH = os.path.join(os.path.dirname(__file__), 'chunk_store.py')
+
+installed_agents = set()
+agent_lock = threading.Lock()
+
+
+def install_agent(machine_name):
+    '''
+    Uploads chunk_store.py to a machine, once per run.
+    '''
+    with agent_lock:
+        if machine_name in installed_agents:
+            return
+        with open(AGENT_PATH) as agent_file:
+            source = agent_file.read()
+        cmd = 'mkdir -p {0} && cat > {1}.tmp && mv {1}.tmp {1}'.format(os.path.dirname(REMOTE_AGENT_PATH), REMOTE_AGENT_PATH)
+        run_command(machine_name, cmd, input=source, silent=True)
+        installed_agents.add(machine_name)
+
+
+def get_agent_command(mode, *args):
+    return 'python3 {} {} {}'.format(REMOTE_AGENT_PATH, mode, ' '.join(quote(str(arg)) for arg in args))
+
+
+@traced('backup_volume', 'volume', 'machine_name')
+def backup_volume(volume, machine_name):
+    '''
+    Takes a snapshot of a volume on a node and stores it on master. The node
+    splits its files into content-defined chunks, only re-reading files that
+    changed since its last scan, and then sends master just the chunks
+    master doesn't have yet, compressed and straight over SSH. Returns the
+    snapshot name with its file and byte counts and how many new chunks and
+    compressed bytes were stored.
+    '''
+    install_agent(machine_name)
+    install_agent('master')
+
+    volume_path = get_volume_path(machine_name, volume)
+    cache_path = '{}/{}.json'.format(REMOTE_CHUNK_CACHE_PATH, volume)
+    snapshot = json.loads(run_command(machine_name, get_agent_command('scan', volume_path, cache_path), silent=True))
+
+    hashes = sorted(set(chunk_hash for entry in snapshot['files'] for chunk_hash, length in entry.get('chunks', [])))
+    missing = run_command('master', get_agent_command('missing', MASTER_BACKUPS_PATH), input='\n'.join(hashes) + '\n', silent=True).split()
+
+    stored = {'chunks': 0, 'bytes': 0}
+    if missing:
+        pin_host_key(machine_name, 'master')
+        # The node connects to master with the forwarded agent. pipefail
+        # makes a failed pack fail the command rather than leave a snapshot
+        # with chunks missing.
+        cmd = 'set -o pipefail; {} | {} root@{} {}'.format(
+            get_agent_command('pack', volume_path, cache_path),
+            NODE_RSYNC_SHELL,
+            settings.MASTER_ADDRESS,
+            quote(get_agent_command('unpack', MASTER_BACKUPS_PATH)),
+        )
+        stored = json.loads(run_command(machine_name, cmd, forward_agent=True, input='\n'.join(missing) + '\n', silent=True))
+
+    name = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    run_command('master', get_agent_command('save-snapshot', MASTER_BACKUPS_PATH, volume, name), input=json.dumps(snapshot), silent=True)
+
+    return {
+        'snapshot':     name,
+        'files':        len(snapshot['files']),
+        'bytes':        sum(entry.get('size', 0) for entry in snapshot['files']),
+        'new_chunks':   stored['chunks'],
+        'new_bytes':    stored['bytes'],
+    }
+
+
+def backup_volumes(volumes, machine_name, workers=VOLUME_SYNC_WORKERS, callback=None):
+    '''
+    Backs up several volumes from a node at once, `workers` at a time.
+    `callback(volume, result, error)` is called as each volume finishes.
+    Returns `(results, errors)` dicts keyed by volume.
+    '''
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(backup_volume, volume, machine_name): volume for volume in volumes}
+        for future in as_completed(futures):
+            volume = futures[future]
+            error = future.exception()
+            if error:
+                errors[volume] = error
+            else:
+                results[volume] = future.result()
+            if callback:
+                callback(volume, results.get(volume), error)
+    return results, errors
+
+
+def list_snapshots(volume):
+    '''
+    Returns the names of a volume's snapshots on master, oldest first.
+    '''
+    cmd = 'ls {}/snapshots/{} 2>/dev/null || true'.format(MASTER_BACKUPS_PATH, volume)
+    return sorted(name[:-len('.json.gz')] for name in run_command('master', cmd, silent=True).split() if name.endswith('.json.gz'))
+
+
+def prune_snapshots(keep=BACKUP_KEEP_SNAPSHOTS):
+    '''
+    Keeps the newest `keep` snapshots of each volume on master and deletes the
+    chunks only older snapshots used. Returns how many snapshots, chunks and
+    bytes were removed.
+    '''
+    install_agent('master')
+    return json.loads(run_command('master', get_agent_command('prune', MASTER_BACKUPS_PATH, keep), silent=True))
+
+
+@traced('restore_volume', 'volume', 'dst', 'snapshot')
+def restore_volume(volume, dst, snapshot=None):
+    '''
+    Restores a volume on a node from a snapshot, the latest if `snapshot`
+    isn't given. Master rebuilds the snapshot into a scratch directory under
+    MASTER_BACKUPS_PATH, which is then synced to `dst` and removed. Master's
+    own copy under MASTER_VOLUMES_PATH is never touched, as every other sync
+    from master reads it. Returns the snapshot name.
+    '''
+    if dst == 'master':
+        raise ValueError('Restore {} to a node, master\'s copy is the source of every sync'.format(volume))
+    snapshot = snapshot or (list_snapshots(volume) or [None])[-1]
+    if not snapshot:
+        raise KeyError('No snapshots of {}'.format(volume))
+
+    install_agent('master')
+    restore_path = '{}/restores/{}'.format(MASTER_BACKUPS_PATH, volume)
+    try:
+        run_command('master', get_agent_command('restore', MASTER_BACKUPS_PATH, volume, snapshot, restore_path), silent=True)
+        # The scratch directory has no manifest, so rsync compares both trees
+        sync_volume(volume, 'master', dst, verify=True, src_path=restore_path)
+    finally:
+        run_command('master', 'rm -rf {}'.format(quote(restore_path)), silent=True)
+    return snapshot
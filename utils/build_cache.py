@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+
+import settings
+from utils.tracing import check_output
+
+
+BUILD_CACHE_PATH = getattr(settings, 'BUILD_CACHE_PATH', '~/.punk-deploy/build-cache.json')
+
+cache_lock = threading.Lock()
+
+
+def load_build_cache():
+    path = os.path.expanduser(BUILD_CACHE_PATH)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as cache_file:
+        return json.load(cache_file)
+
+
+def record_build(image, fingerprint, digest, layer_cache=None):
+    '''
+    Stores the digest that was pushed for a build context fingerprint, along
+    with how many of the build's steps came from the layer cache.
+    '''
+    with cache_lock:
+        cache = load_build_cache()
+        cache[image] = {'fingerprint': fingerprint, 'digest': digest}
+        if layer_cache:
+            cache[image]['layer_cache'] = layer_cache
+        path = os.path.expanduser(BUILD_CACHE_PATH)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open('{}.tmp'.format(path), 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2, sort_keys=True)
+        os.replace('{}.tmp'.format(path), path)
+
+
+def get_cached_digest(image, fingerprint):
+    '''
+    Returns the digest last pushed for `image` if it was built from the same
+    fingerprint, otherwise None.
+    '''
+    entry = load_build_cache().get(image)
+    if entry and entry['fingerprint'] == fingerprint:
+        return entry['digest']
+    return None
+
+
+def get_layer_cache_report(images):
+    '''
+    Returns the steps, cached steps and cache hit ratio of each image's last
+    recorded build. Images never built with a record of this are left out.
+    '''
+    cache = load_build_cache()
+    report = {}
+    for image in images:
+        layer_cache = cache.get(image, {}).get('layer_cache')
+        if layer_cache:
+            ratio = float(layer_cache['cached']) / layer_cache['steps'] if layer_cache['steps'] else 1.0
+            report[image] = dict(layer_cache, ratio=round(ratio, 2))
+    return report
+
+
+def get_dockerignore_patterns(context_path):
+    '''
+    Returns `(regex, exclude)` tuples for the rules in a build context's
+    .dockerignore. Rules are applied in order and the last match wins, as in
+    Docker.
+    '''
+    patterns = []
+    path = os.path.join(context_path, '.dockerignore')
+    if not os.path.exists(path):
+        return patterns
+
+    with open(path) as dockerignore:
+        for line in dockerignore:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            exclude = True
+            if line.startswith('!'):
+                exclude = False
+                line = line[1:].strip()
+            line = os.path.normpath(line).lstrip('/')
+
+            regex = ''
+            i = 0
+            while i < len(line):
+                if line[i:i + 3] == '**/':
+                    regex += '(.*/)?'
+                    i += 3
+                elif line[i:i + 2] == '**':
+                    regex += '.*'
+                    i += 2
+                elif line[i] == '*':
+                    regex += '[^/]*'
+                    i += 1
+                elif line[i] == '?':
+                    regex += '[^/]'
+                    i += 1
+                else:
+                    regex += re.escape(line[i])
+                    i += 1
+            patterns.append((re.compile('^{}(/.*)?$'.format(regex)), exclude))
+
+    return patterns
+
+
+def is_ignored(relative_path, patterns):
+    ignored = False
+    for regex, exclude in patterns:
+        if regex.match(relative_path):
+            ignored = exclude
+    return ignored
+
+
+def get_context_fingerprint(context_path):
+    '''
+    Hashes the path, mode and contents of every file that would be sent to
+    the Docker daemon as the build context.
+    '''
+    patterns = get_dockerignore_patterns(context_path)
+    digest = hashlib.sha256()
+
+    for root, dirs, files in os.walk(context_path):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, context_path)
+            # Docker always sends these, even if they are ignored
+            if is_ignored(relative_path, patterns) and relative_path not in ['Dockerfile', '.dockerignore']:
+                continue
+            digest.update(relative_path.encode('utf-8'))
+            digest.update(str(os.lstat(path).st_mode).encode('utf-8'))
+            if os.path.islink(path):
+                digest.update(os.readlink(path).encode('utf-8'))
+            else:
+                with open(path, 'rb') as context_file:
+                    for block in iter(lambda: context_file.read(65536), b''):
+                        digest.update(block)
+
+    return digest.hexdigest()
+
+
+def get_base_image_digest(base_image):
+    '''
+    Returns the digest a base image resolves to. Images from our own registry
+    use the digest we last pushed so the fingerprint is the same on any host.
+    Anything else uses the local image ID, as that is what `docker build`
+    will use.
+    '''
+    prefix = '{}/'.format(settings.REGISTRY_ADDRESS)
+    if base_image.startswith(prefix):
+        entry = load_build_cache().get(base_image[len(prefix):].split('@')[0].split(':')[0])
+        if entry:
+            return entry['digest']
+    try:
+        return check_output(['docker', 'image', 'inspect', '--format', '{{.Id}}', base_image], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def get_build_fingerprint(context_path, base_images):
+    digest = hashlib.sha256()
+    digest.update(get_context_fingerprint(context_path).encode('utf-8'))
+    for base_image in base_images:
+        digest.update('{}={}'.format(base_image, get_base_image_digest(base_image)).encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+'''
+Content-defined chunking and a compressed, content-addressed chunk store for
+volume backups. utils.backups uploads this file to nodes and master and runs
+it there, so it only uses the standard library and runs on Python 3.5.
+
+    chunk_store.py scan VOLUME_PATH CACHE_PATH
+    chunk_store.py pack VOLUME_PATH CACHE_PATH < hashes
+    chunk_store.py missing STORE_PATH < hashes
+    chunk_store.py unpack STORE_PATH < packed chunks
+    chunk_store.py save-snapshot STORE_PATH VOLUME NAME < snapshot
+    chunk_store.py restore STORE_PATH VOLUME NAME DESTINATION
+    chunk_store.py prune STORE_PATH KEEP
+
+The store holds each chunk once, zlib-compressed, at
+`chunks/<first two hex digits>/<sha256>`, and each snapshot as a gzipped
+JSON list of files and their chunks at `snapshots/<volume>/<name>.json.gz`.
+`save-snapshot` and `prune` hold `lock` in the store while they run.
+'''
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import stat
+import struct
+import sys
+import time
+import zlib
+
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# A chunk ends where the top 20 bits of the rolling hash are zero, which gives
+# chunks of around 1MB beyond the minimum
+BOUNDARY_MASK = 0xFFFFF000
+READ_SIZE = 16 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+# Chunks younger than this are kept by prune as they may belong to a backup
+# whose snapshot hasn't been saved yet
+PRUNE_GRACE_SECONDS = 86400
+PACK_HEADER = struct.Struct('>64sI')
+
+# Random but fixed, so every host cuts the same content at the same places
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+
+
+def find_boundary(data, start, end):
+    '''
+    Returns where the chunk beginning at `start` ends, using a gear rolling
+    hash over `data[start:end]`. Only bytes past MIN_CHUNK_SIZE are hashed.
+    '''
+    limit = min(end, start + MAX_CHUNK_SIZE)
+    if start + MIN_CHUNK_SIZE >= limit:
+        return limit
+    gear = GEAR
+    h = 0
+    for position in range(start + MIN_CHUNK_SIZE, limit):
+        h = ((h << 1) + gear[data[position]]) & 0xFFFFFFFF
+        if not h & BOUNDARY_MASK:
+            return position + 1
+    return limit
+
+
+def chunk_file(path):
+    '''
+    Returns `[hash, length]` for each chunk of a file, in order.
+    '''
+    chunks = []
+    with open(path, 'rb') as chunk_file:
+        data = chunk_file.read(READ_SIZE)
+        eof = len(data) < READ_SIZE
+        start = 0
+        while start < len(data):
+            if not eof and len(data) - start < MAX_CHUNK_SIZE:
+                more = chunk_file.read(READ_SIZE)
+                eof = len(more) < READ_SIZE
+                data = data[start:] + more
+                start = 0
+                continue
+            end = find_boundary(data, start, len(data))
+            chunks.append([hashlib.sha256(data[start:end]).hexdigest(), end - start])
+            start = end
+    return chunks
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as json_file:
+        return json.load(json_file)
+
+
+def write_atomically(path, data):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open('{}.tmp'.format(path), 'wb') as output_file:
+        output_file.write(data)
+    os.replace('{}.tmp'.format(path), path)
+
+
+def get_chunk_path(store_path, chunk_hash):
+    return os.path.join(store_path, 'chunks', chunk_hash[:2], chunk_hash)
+
+
+def get_snapshot_path(store_path, volume, name):
+    return os.path.join(store_path, 'snapshots', volume, '{}.json.gz'.format(name))
+
+
+def lock_store(store_path):
+    '''
+    Takes the store's lock, which is released when the returned file is
+    closed.
+    '''
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+    lock_file = open(os.path.join(store_path, 'lock'), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def read_lines():
+    return [line for line in sys.stdin.read().split('\n') if line]
+
+
+def scan(volume_path, cache_path):
+    '''
+    Prints a snapshot of the volume: every file with its mode, mtime, size and
+    chunks. Files whose size, mtime and inode match the cache from the
+    previous scan are not read again.
+    '''
+    cache = load_json(cache_path, {})
+    new_cache = {}
+    files = []
+
+    for root, dirs, names in os.walk(volume_path):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, volume_path)
+            file_stat = os.lstat(path)
+            entry = {'path': relative_path, 'mode': stat.S_IMODE(file_stat.st_mode), 'mtime': file_stat.st_mtime}
+
+            if stat.S_ISLNK(file_stat.st_mode):
+                entry['link'] = os.readlink(path)
+            elif stat.S_ISREG(file_stat.st_mode):
+                key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+                cached = cache.get(relative_path)
+                chunks = cached['chunks'] if cached and cached['key'] == key else chunk_file(path)
+                new_cache[relative_path] = {'key': key, 'chunks': chunks}
+                entry['size'] = file_stat.st_size
+                entry['chunks'] = chunks
+            else:
+                continue
+            files.append(entry)
+
+    write_atomically(cache_path, json.dumps(new_cache).encode('utf-8'))
+    json.dump({'files': files}, sys.stdout)
+
+
+def pack(volume_path, cache_path):
+    '''
+    Writes the chunks named on stdin to stdout, compressed and each preceded
+    by its hash and compressed length. Reads the files in the order they were
+    scanned and fails if a chunk has changed since.
+    '''
+    wanted = set(read_lines())
+    output = sys.stdout.buffer
+    cache = load_json(cache_path, {})
+
+    for relative_path in sorted(cache):
+        offset = 0
+        chunk_file = None
+        for chunk_hash, length in cache[relative_path]['chunks']:
+            if chunk_hash in wanted:
+                if not chunk_file:
+                    chunk_file = open(os.path.join(volume_path, relative_path), 'rb')
+                chunk_file.seek(offset)
+                data = chunk_file.read(length)
+                if hashlib.sha256(data).hexdigest() != chunk_hash:
+                    sys.exit('{} changed during the backup'.format(relative_path))
+                compressed = zlib.compress(data, COMPRESSION_LEVEL)
+                output.write(PACK_HEADER.pack(chunk_hash.encode('ascii'), len(compressed)))
+                output.write(compressed)
+                wanted.discard(chunk_hash)
+            offset += length
+        if chunk_file:
+            chunk_file.close()
+
+    if wanted:
+        sys.exit('{} chunks are no longer in the volume'.format(len(wanted)))
+
+
+def missing(store_path):
+    for chunk_hash in read_lines():
+        if not os.path.exists(get_chunk_path(store_path, chunk_hash)):
+            print(chunk_hash)
+
+
+def unpack(store_path):
+    '''
+    Stores the chunks written by `pack`, checking each one's hash, and prints
+    how many chunks and compressed bytes were added.
+    '''
+    stream = sys.stdin.buffer
+    chunks = 0
+    stored_bytes = 0
+    while True:
+        header = stream.read(PACK_HEADER.size)
+        if not header:
+            break
+        if len(header) != PACK_HEADER.size:
+            sys.exit('Packed chunks ended early')
+        chunk_hash, length = PACK_HEADER.unpack(header)
+        chunk_hash = chunk_hash.decode('ascii')
+        compressed = stream.read(length)
+        if len(compressed) != length or hashlib.sha256(zlib.decompress(compressed)).hexdigest() != chunk_hash:
+            sys.exit('Chunk {} arrived corrupted'.format(chunk_hash))
+        write_atomically(get_chunk_path(store_path, chunk_hash), compressed)
+        chunks += 1
+        stored_bytes += length
+    json.dump({'chunks': chunks, 'bytes': stored_bytes}, sys.stdout)
+
+
+def save_snapshot(store_path, volume, name):
+    '''
+    Saves a snapshot once every chunk it refers to is in the store. A chunk
+    `missing` reported as present can be pruned before the snapshot is
+    saved, so this is checked under the lock `prune` takes.
+    '''
+    data = sys.stdin.buffer.read()
+    snapshot = json.loads(data.decode('utf-8'))
+    with lock_store(store_path):
+        hashes = set(chunk_hash for entry in snapshot['files'] for chunk_hash, length in entry.get('chunks', []))
+        pruned = [chunk_hash for chunk_hash in hashes if not os.path.exists(get_chunk_path(store_path, chunk_hash))]
+        if pruned:
+            sys.exit('{} chunks of {} were pruned while it was backed up, back it up again'.format(len(pruned), volume))
+        write_atomically(get_snapshot_path(store_path, volume, name), gzip.compress(data))
+
+
+def restore(store_path, volume, name, destination):
+    '''
+    Makes `destination` match a snapshot. Files that already have the right
+    size and mtime are left alone and files not in the snapshot are removed.
+    '''
+    snapshot = load_json(get_snapshot_path(store_path, volume, name), None)
+    if snapshot is None:
+        sys.exit('No snapshot {} of {}'.format(name, volume))
+
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    paths = set()
+    for entry in snapshot['files']:
+        path = os.path.join(destination, entry['path'])
+        paths.add(entry['path'])
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if 'link' in entry:
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(entry['link'], path)
+            continue
+
+        if os.path.isfile(path) and not os.path.islink(path):
+            file_stat = os.stat(path)
+            if file_stat.st_size == entry['size'] and int(file_stat.st_mtime) == int(entry['mtime']):
+                continue
+
+        with open('{}.tmp'.format(path), 'wb') as output_file:
+            for chunk_hash, length in entry['chunks']:
+                with open(get_chunk_path(store_path, chunk_hash), 'rb') as chunk_file:
+                    output_file.write(zlib.decompress(chunk_file.read()))
+        os.chmod('{}.tmp'.format(path), entry['mode'])
+        os.utime('{}.tmp'.format(path), (entry['mtime'], entry['mtime']))
+        os.replace('{}.tmp'.format(path), path)
+
+    for root, dirs, names in os.walk(destination):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.relpath(path, destination) not in paths:
+                os.remove(path)
+
+
+def prune(store_path, keep):
+    '''
+    Deletes all but the newest `keep` snapshots of each volume, then the
+    chunks no remaining snapshot refers to. Prints what was removed.
+    '''
+    with lock_store(store_path):
+        removed = prune_locked(store_path, keep)
+    json.dump(removed, sys.stdout)
+
+
+def prune_locked(store_path, keep):
+    snapshots_path = os.path.join(store_path, 'snapshots')
+    removed_snapshots = 0
+    referenced = set()
+    for volume in sorted(os.listdir(snapshots_path)) if os.path.isdir(snapshots_path) else []:
+        names = sorted(name for name in os.listdir(os.path.join(snapshots_path, volume)) if name.endswith('.json.gz'))
+        for name in names[:-keep] if keep else names:
+            os.remove(os.path.join(snapshots_path, volume, name))
+            removed_snapshots += 1
+        for name in names[-keep:] if keep else []:
+            for entry in load_json(os.path.join(snapshots_path, volume, name), {'files': []})['files']:
+                referenced.update(chunk_hash for chunk_hash, length in entry.get('chunks', []))
+
+    removed_chunks = 0
+    removed_bytes = 0
+    cutoff = time.time() - PRUNE_GRACE_SECONDS
+    for root, dirs, names in os.walk(os.path.join(store_path, 'chunks')):
+        for name in names:
+            path = os.path.join(root, name)
+            file_stat = os.stat(path)
+            if name not in referenced and file_stat.st_mtime < cutoff:
+                os.remove(path)
+                removed_chunks += 1
+                removed_bytes += file_stat.st_size
+    return {'snapshots': removed_snapshots, 'chunks': removed_chunks, 'bytes': removed_bytes}
+
+
+COMMANDS = {
+    'scan':             scan,
+    'pack':             pack,
+    'missing':          missing,
+    'unpack':           unpack,
+    'save-snapshot':    save_snapshot,
+    'restore':          restore,
+    'prune':            lambda store_path, keep: prune(store_path, int(keep)),
+}
+
+
+if __name__ == '__main__':
+    COMMANDS[sys.argv[1]](*sys.argv[2:])
@@ -1,37 +1,320 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from shlex import quote
+
 import settings
-from utils.docker_compose import get_docker_compose_data
+from utils.docker_compose import get_compose_model
 from utils.docker_machine import get_machines
+from utils.journal import describe_entry, get_entry, is_done, record_item, skip_item
 from utils.ssh import run_command
+from utils.tracing import traced
+
+
+DATABASE_RESTORE_JOBS = getattr(settings, 'DATABASE_RESTORE_JOBS', 4)
+DATABASE_RESTORE_WORKERS = getattr(settings, 'DATABASE_RESTORE_WORKERS', 2)
+DATABASE_DUMP_JOBS = getattr(settings, 'DATABASE_DUMP_JOBS', 4)
+DATABASE_DUMP_WORKERS = getattr(settings, 'DATABASE_DUMP_WORKERS', 2)
+# Dump every table of a database from one snapshot with a single, serial
+# mysqldump, rather than exporting `DATABASE_DUMP_JOBS` tables at once from
+# separate snapshots
+DATABASE_DUMP_CONSISTENT = getattr(settings, 'DATABASE_DUMP_CONSISTENT', True)
+
+# Session settings prepended to every table's import
+BULK_LOAD_SETTINGS = '''SET SESSION foreign_key_checks = 0;
+SET SESSION unique_checks = 0;
+SET SESSION autocommit = 0;
+SET SESSION bulk_insert_buffer_size = 268435456;
+'''
+
+# Runs on the node. Splits the dump arriving on stdin into one gzipped file
+# per table at mysqldump's "Table structure" comments, then loads the tables
+# into the shadow database in parallel, each after the dump's header
+# statements. Views and routines, which can refer to any table, go in their
+# own file that is loaded once every table has been. Parallel loads need the
+# whole dump at hand, so it is staged on the node's disk, compressed, rather
+# than piped straight into mysql.
+RESTORE_SCRIPT = '''set -e -o pipefail
+dir=$(mktemp -d)
+trap 'rm -rf $dir' EXIT
+printf '%s' {bulk_load_settings} > $dir/prelude.sql
+gunzip -c | awk -v dir=$dir '
+    /^-- Table structure for table / {{ if (out) close(out); n++; out = sprintf("gzip -1 > %s/%05d.sql.gz", dir, n) }}
+    /^-- (Temporary (view|table) structure for view|Final view structure for view|Dumping routines for database) / {{ if (out) close(out); out = "gzip -1 >> " dir "/post.sql.gz" }}
+    {{ if (out) print | out; else print > (dir "/header.sql") }}'
+cat > $dir/load.sh <<'EOF'
+(cat "$1/prelude.sql" "$1/header.sql"; gunzip -c "$2"; echo "COMMIT;") | {mysql}
+EOF
+echo "drop database if exists {shadow}; create database {shadow};" | {mysql_root}
+ls $dir | grep '^[0-9]*\.sql\.gz$' | sed "s|^|$dir/|" | xargs -P {jobs} -n 1 sh $dir/load.sh $dir
+if [ -f $dir/post.sql.gz ]; then (cat $dir/header.sql; gunzip -c $dir/post.sql.gz) | {mysql}; fi
+'''
+
+# Runs on the node. Loads the per-table dumps written by `dump_database`,
+# arriving on stdin as a tar, into the shadow database in parallel, then the
+# views and routines once every table is in.
+RESTORE_TABLES_SCRIPT = '''set -e -o pipefail
+dir=$(mktemp -d)
+trap 'rm -rf $dir' EXIT
+printf '%s' {bulk_load_settings} > $dir/prelude.sql
+tar -xf - -C $dir
+cat > $dir/load.sh <<'EOF'
+(cat "$1/prelude.sql"; gunzip -c "$2"; echo "COMMIT;") | {mysql}
+EOF
+echo "drop database if exists {shadow}; create database {shadow};" | {mysql_root}
+ls $dir | grep '\.sql\.gz$' | sed "s|^|$dir/|" | xargs -P {jobs} -n 1 sh $dir/load.sh $dir
+if [ -f $dir/views-and-routines.gz ]; then gunzip -c $dir/views-and-routines.gz | {mysql}; fi
+'''
+
+# Runs on the node. Writes each table to its own gzipped file, which loads on
+# its own, and the views and routines to views-and-routines.gz, then sends
+# them all to stdout as a tar.
+DUMP_SCRIPT = '''set -e -o pipefail
+dir=$(mktemp -d)
+trap 'rm -rf $dir' EXIT
+cd $dir
+{dump}
+tar -cf - *.gz
+'''
+
+# One serial dump with --single-transaction so every table comes from the
+# same snapshot, split at mysqldump's "Table structure" comments. Only the
+# compression of the split files runs in parallel. Each table's file starts
+# with the dump's header statements. Views and routines, which can refer to
+# any table, are split out into one file of their own.
+CONSISTENT_DUMP = '''{mysqldump} | awk -v post=views-and-routines '
+    /^-- Table structure for table / {{ if (out && out != post) close(out); name = $NF; gsub("`", "", name); out = name ".sql"; printf "%s", header > out }}
+    /^-- (Temporary (view|table) structure for view|Final view structure for view|Dumping routines for database) / {{ if (out && out != post) close(out); if (!started) printf "%s", header > post; started = 1; out = post }}
+    {{ if (out) print > out; else header = header $0 "\\n" }}'
+ls | grep -e '\.sql$' -e '^views-and-routines$' | xargs -P {jobs} -n 1 gzip'''
+
+# A mysqldump for each table, `jobs` at once, then one of the views and
+# routines. Each table is consistent on its own but different tables can
+# come from different moments.
+PARALLEL_DUMP = '''cat > dump.sh <<'EOF'
+set -o pipefail
+{mysqldump} | gzip > "$1.sql.gz"
+EOF
+printf '%s\\n' {tables} | xargs -P {jobs} -n 1 bash dump.sh
+{{ {post_dump}; }} | gzip > views-and-routines.gz'''
 
 
 def get_databases():
     '''
-    Returns the volumes that are mouted in the docker-compose.yml file. Used
-    for determining what needs to be synced between machines.
+    Returns the databases to dump and sync. Each service linked to mysql in
+    the compose files has a database named after it.
     '''
-    databases = set()
+    return list(get_compose_model()['mysql_services'])
+
 
-    for item, properties in get_docker_compose_data()['services'].items():
-        if 'mysql' in properties.get('links', []):
-            databases.add(item)
+def get_mysql_command(database='', options=''):
+    return 'docker exec -i mysql bash -c \'MYSQL_PWD=$MYSQL_ROOT_PASSWORD mysql -u root {} {}\''.format(options, database)
 
-    return sorted(list(databases))
+
+def get_mysqldump_command(database, tables=None, options='--routines --triggers'):
+    '''
+    Returns a mysqldump of a database, or of just `tables`, a string of shell
+    words such as quoted names or "$1".
+    '''
+    cmd = 'docker exec mysql bash -c \'MYSQL_PWD=$MYSQL_ROOT_PASSWORD mysqldump -u root --single-transaction --quick --max_allowed_packet=1G {} {} "$@"\' mysqldump'.format(options, database)
+    if tables:
+        cmd += ' {}'.format(tables)
+    return cmd
 
 
-def sync_database_dump(database, src, dst):
-    machines = get_machines()
-    if src == 'master':
-        if dst not in machines:
-            raise KeyError('No machine called {}'.format(dst))
-        machine = machines[dst]
-        run_command('master', 'rsync -avz {} root@{}:/tmp/'.format(settings.MASTER_DATABASE_PATH, machine['ip']), silent=True)
+def get_dump_path(database):
+    '''
+    Returns the directory on master holding a database's per-table dumps.
+    '''
+    return '{}/{}'.format(settings.MASTER_DATABASES_PATH, database)
+
+
+@traced('dump_db', 'database', 'src')
+def dump_database(database, src, jobs=DATABASE_DUMP_JOBS, consistent=DATABASE_DUMP_CONSISTENT):
+    '''
+    Dumps a database from a node's mysql container to master as one gzipped
+    file per table under MASTER_DATABASES_PATH/<database>/, which
+    `restore_database` loads in parallel. Master pulls the dump over SSH and
+    only replaces the previous one once it has all arrived.
+
+    With `consistent`, every table comes from a single --single-transaction
+    snapshot. The export itself is then serial and only the compression of
+    the tables, `jobs` at once, runs in parallel. Otherwise `jobs` tables
+    are exported at once, each from its own snapshot, which is faster for
+    big databases but not consistent across tables. Returns the tables
+    dumped.
+    '''
+    machines = get_machines(check_running=False)
+    if src not in machines:
+        raise KeyError('No machine called {}'.format(src))
+    machine = machines[src]
+
+    if consistent:
+        dump = CONSISTENT_DUMP.format(mysqldump=get_mysqldump_command(database), jobs=jobs)
     else:
-        raise NotImplementedError()
+        tables = get_tables(src, database)
+        if not tables:
+            raise KeyError('No tables in {} on {}'.format(database, src))
+        post_dump = get_mysqldump_command(database, options='--no-create-info --no-data --routines --skip-triggers')
+        views = get_tables(src, database, 'VIEW')
+        if views:
+            post_dump += ' && {}'.format(get_mysqldump_command(database, ' '.join(quote(view) for view in views), options='--no-data --skip-routines --skip-triggers'))
+        dump = PARALLEL_DUMP.format(
+            mysqldump=get_mysqldump_command(database, '"$1"', options='--skip-routines --triggers'),
+            tables=' '.join(quote(table) for table in tables),
+            jobs=jobs,
+            post_dump=post_dump,
+        )
+
+    path = get_dump_path(database)
+    cmd = 'set -o pipefail; rm -rf {0}.tmp {0}.old && mkdir -p {0}.tmp && ssh root@{1} {2} | tar -xf - -C {0}.tmp && ([ ! -d {0} ] || mv {0} {0}.old) && mv {0}.tmp {0} && rm -rf {0}.old && ls {0}'.format(
+        path,
+        machine['ip'],
+        quote(DUMP_SCRIPT.format(dump=dump)),
+    )
+    output = run_command('master', cmd, silent=True)
+    return sorted(name[:-len('.sql.gz')] for name in output.split() if name.endswith('.sql.gz'))
+
+
+def dump_databases(databases, src, workers=DATABASE_DUMP_WORKERS, callback=None):
+    '''
+    Dumps several databases from a node to master at once, `workers` at a
+    time. `callback(database, error)` is called as each database finishes.
+    Returns a dict mapping each failed database to its exception.
+    '''
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(dump_database, database, src): database for database in databases}
+        for future in as_completed(futures):
+            database = futures[future]
+            error = future.exception()
+            if error:
+                errors[database] = error
+            if callback:
+                callback(database, error)
+    return errors
+
+
+def get_dump_checksum(database):
+    '''
+    Hashes the names, sizes and mtimes of a database's dump files on master,
+    so a restore can tell whether the dump has changed since.
+    '''
+    cmd = 'find {} {}/{}.sql -type f -printf \'%P %s %T@\\n\' 2>/dev/null | LC_ALL=C sort | md5sum'.format(get_dump_path(database), settings.MASTER_DATABASES_PATH, database)
+    return run_command('master', cmd, silent=True).split()[0]
+
+
+def get_tables(machine_name, database, table_type='BASE TABLE'):
+    '''
+    Returns the names of a database's tables, or its views with
+    `table_type='VIEW'`.
+    '''
+    sql = 'select table_name from information_schema.tables where table_schema = \'{}\' and table_type = \'{}\';'.format(database, table_type)
+    return run_command(machine_name, get_mysql_command(options='-N'), input=sql, silent=True).split()
+
+
+def get_schema_objects(machine_name, databases):
+    '''
+    Returns `(type, database, name)` for every table, view, trigger and
+    routine in `databases`, where type is "BASE TABLE", "VIEW", "TRIGGER",
+    "PROCEDURE" or "FUNCTION".
+    '''
+    schemas = ', '.join('\'{}\''.format(database) for database in databases)
+    sql = 'select table_type, table_schema, table_name from information_schema.tables where table_schema in ({0}) union all select \'TRIGGER\', trigger_schema, trigger_name from information_schema.triggers where trigger_schema in ({0}) union all select routine_type, routine_schema, routine_name from information_schema.routines where routine_schema in ({0});'.format(schemas)
+    output = run_command(machine_name, get_mysql_command(options='-N'), input=sql, silent=True)
+    return [tuple(line.split('\t')) for line in output.split('\n') if line.count('\t') == 2]
 
 
-def load_database_dump(database, dst):
-    machines = get_machines()
+@traced('restore_db', 'database', 'dst')
+def restore_database(database, dst, jobs=DATABASE_RESTORE_JOBS):
+    '''
+    Restores a database on a node from its dump on master while the live
+    database keeps serving. The dump is streamed into a shadow database with
+    `jobs` tables loading at once and bulk-load session settings. The
+    shadow's tables then replace the live ones in a single atomic
+    `RENAME TABLE`, after which its views, triggers and routines are
+    recreated in the live database.
+    '''
+    machines = get_machines(check_running=False)
     if dst not in machines:
         raise KeyError('No machine called {}'.format(dst))
-    run_command(dst, 'docker exec mysql bash -c \'MYSQL_PWD=$MYSQL_ROOT_PASSWORD mysql -u root -e "drop database if exists {0}; create database {0}"\''.format(database), silent=True)
-    run_command(dst, 'cat /tmp/databases/{0}.sql | docker exec -i mysql bash -c \'MYSQL_PWD=$MYSQL_ROOT_PASSWORD mysql -u root {0}\''.format(database), silent=True)
+    machine = machines[dst]
+
+    shadow = '{}__shadow'.format(database)
+    old = '{}__old'.format(database)
+
+    script_settings = {
+        'bulk_load_settings':   quote(BULK_LOAD_SETTINGS),
+        'mysql':                get_mysql_command(shadow, options='--max_allowed_packet=1G'),
+        'mysql_root':           get_mysql_command(),
+        'shadow':               shadow,
+        'jobs':                 jobs,
+    }
+    # Per-table dumps from `dump_database` are preferred over a single dump.
+    # Nothing is touched on the node when there is neither.
+    dump_path = '{}/{}.sql'.format(settings.MASTER_DATABASES_PATH, database)
+    cmd = 'set -o pipefail; if [ -d {0} ]; then tar -cf - -C {0} . | ssh root@{1} {2}; elif [ -f {3} ]; then gzip -c {3} | ssh root@{1} {4}; else echo no-dump; fi'.format(
+        get_dump_path(database),
+        machine['ip'],
+        quote(RESTORE_TABLES_SCRIPT.format(**script_settings)),
+        dump_path,
+        quote(RESTORE_SCRIPT.format(**script_settings)),
+    )
+    if run_command('master', cmd, silent=True).strip() == 'no-dump':
+        raise KeyError('No dump of {} on master'.format(database))
+
+    # Views and tables with triggers can't be renamed into another database,
+    # so the shadow's views, triggers and routines are dumped, dropped along
+    # with the live ones and recreated once the tables are swapped
+    objects = get_schema_objects(dst, [database, shadow])
+    definitions = ''
+    if any(object_type != 'BASE TABLE' for object_type, schema, name in objects if schema == shadow):
+        views = [name for object_type, schema, name in objects if object_type == 'VIEW' and schema == shadow]
+        cmd = get_mysqldump_command(shadow, options='--no-create-info --no-data --routines --triggers')
+        if views:
+            cmd += ' && {}'.format(get_mysqldump_command(shadow, ' '.join(quote(view) for view in views), options='--no-data --skip-routines --skip-triggers'))
+        definitions = run_command(dst, cmd, silent=True)
+
+    drops = ['drop {} `{}`.`{}`;'.format(object_type.lower(), schema, name) for object_type, schema, name in objects if object_type == 'TRIGGER' or (object_type == 'VIEW' and schema == database)]
+    renames = ['`{0}`.`{2}` to `{1}`.`{2}`'.format(database, old, name) for object_type, schema, name in objects if object_type == 'BASE TABLE' and schema == database]
+    renames += ['`{0}`.`{2}` to `{1}`.`{2}`'.format(shadow, database, name) for object_type, schema, name in objects if object_type == 'BASE TABLE' and schema == shadow]
+    sql = 'create database if not exists {0}; drop database if exists {1}; create database {1};'.format(database, old)
+    if drops:
+        sql += ' {}'.format(' '.join(drops))
+    if renames:
+        sql += ' rename table {};'.format(', '.join(renames))
+    sql += ' drop database {}; drop database {};\nuse {};\n{}'.format(old, shadow, database, definitions)
+    run_command(dst, get_mysql_command(options='--max_allowed_packet=1G'), input=sql, silent=True)
+
+
+def restore_databases(databases, dst, workers=DATABASE_RESTORE_WORKERS, callback=None, journal=None):
+    '''
+    Restores several databases at once, `workers` at a time.
+    `callback(database, error)` is called as each database finishes. Returns a
+    dict mapping each failed database to its exception.
+
+    With a `journal` (see `utils.journal`), a database an earlier run already
+    restored is skipped if its dump on master hasn't changed since and it
+    still has tables on `dst`.
+    '''
+    def restore(database):
+        if journal is None:
+            return restore_database(database, dst)
+        checksum = get_dump_checksum(database)
+        if is_done(journal, database, checksum) and get_tables(dst, database):
+            skip_item(journal, database, '{} from the same dump on master'.format(describe_entry(get_entry(journal, database))))
+            return
+        record_item(journal, database, 'started', checksum)
+        restore_database(database, dst)
+        record_item(journal, database, 'done', checksum)
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(restore, database): database for database in databases}
+        for future in as_completed(futures):
+            database = futures[future]
+            error = future.exception()
+            if error:
+                errors[database] = error
+                record_item(journal, database, 'failed', error=str(error))
+            if callback:
+                callback(database, error)
+    return errors
@@ -1,51 +1,417 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import os
 import subprocess
+import threading
+import time
 
 import yaml
 
 import settings
 from utils.docker_machine import get_machine
+from utils.tracing import check_output, traced
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 file_path = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'docker-compose.yml'))
+override_file_paths = [os.path.normpath(os.path.join(os.path.dirname(__file__), '..', path)) for path in getattr(settings, 'COMPOSE_OVERRIDE_FILES', ['docker-compose.override.yml'])]
 
+DEPLOY_HEALTH_TIMEOUT = getattr(settings, 'DEPLOY_HEALTH_TIMEOUT', 120)
+# Options whose lists docker-compose combines across files rather than replaces
+MERGED_LIST_KEYS = ['ports', 'expose', 'external_links', 'dns', 'dns_search', 'tmpfs', 'environment', 'labels', 'volumes', 'devices']
+ROLLOUT_CONCURRENCY = getattr(settings, 'ROLLOUT_CONCURRENCY', 2)
+# How many machines may fail to deploy before a rollout starts no more
+ROLLOUT_MAX_FAILURES = getattr(settings, 'ROLLOUT_MAX_FAILURES', 0)
+ROLLOUT_PREFETCH_WORKERS = getattr(settings, 'ROLLOUT_PREFETCH_WORKERS', 8)
 
-def get_docker_compose_data():
-    with open(file_path) as dc:
-        data = dc.read()
+compose_model = None
+compose_model_key = None
+compose_model_lock = threading.Lock()
+
+
+def get_compose_files():
+    '''
+    Returns docker-compose.yml followed by whichever override files exist, in
+    the order they are applied.
+    '''
+    return [file_path] + [path for path in override_file_paths if os.path.exists(path)]
+
+
+def get_compose_file_args():
+    args = []
+    for path in get_compose_files():
+        args += ['-f', path]
+    return args
+
+
+def get_merge_key(key, item):
+    '''
+    Returns what identifies an entry of one of compose's multi-value options,
+    so an override's entry replaces the base entry it shares it with: the
+    variable or label name, or the path a volume or device is mounted at.
+    '''
+    if isinstance(item, dict):
+        return item.get('target', str(item))
+    if key in ['environment', 'labels']:
+        return item.split('=', 1)[0]
+    if key in ['volumes', 'devices']:
+        return item.split(':')[1] if ':' in item else item
+    return item
+
+
+def merge_compose_data(base, override):
+    '''
+    Merges an override file into the data from the files before it, the way
+    docker-compose does. Mappings are merged key by key. The lists of
+    multi-value options such as ports, volumes and environment are combined,
+    with the override's entries replacing matching ones. Anything else,
+    including lists such as `command` and `entrypoint`, is replaced.
+    '''
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_compose_data(base[key], value)
+        elif key in MERGED_LIST_KEYS and isinstance(value, list) and isinstance(base.get(key), list):
+            keys = set(get_merge_key(key, item) for item in value)
+            base[key] = [item for item in base[key] if get_merge_key(key, item) not in keys] + value
+        else:
+            base[key] = value
+    return base
+
+
+def get_image_registry(image):
+    '''
+    Returns the registry host an image is pulled from, or an empty string for
+    Docker Hub.
+    '''
+    if '/' in image:
+        host = image.split('/')[0]
+        if '.' in host or ':' in host or host == 'localhost':
+            return host
+    return ''
+
+
+def get_volume_name(volume_str):
+    volume = volume_str.split(':')[0]
+    volume = volume.replace('/volumes/', '')
+    return volume.split('/')[0]
+
+
+def get_compose_model():
+    '''
+    Returns the parsed compose files along with indexes of their services. The
+    files are only parsed again when one of their mtimes changes.
 
-    return yaml.load(data)
+    * `data` - the merged compose data
+    * `services_by_registry` - service names keyed by their image's registry
+    * `volumes_by_service` - volume names keyed by the service mounting them
+    * `mysql_services` - names of the services linked to mysql
+    '''
+    global compose_model, compose_model_key
+
+    with compose_model_lock:
+        files = get_compose_files()
+        key = tuple((path, os.stat(path).st_mtime) for path in files)
+        if key == compose_model_key:
+            return compose_model
+
+        data = {}
+        for path in files:
+            with open(path) as dc:
+                merge_compose_data(data, yaml.load(dc, Loader=SafeLoader) or {})
+        data.setdefault('services', {})
+
+        services_by_registry = {}
+        volumes_by_service = {}
+        mysql_services = []
+        for service, properties in sorted(data['services'].items()):
+            services_by_registry.setdefault(get_image_registry(properties.get('image', '')), []).append(service)
+            volumes_by_service[service] = sorted(set(get_volume_name(volume_str) for volume_str in properties.get('volumes', [])))
+            if 'mysql' in properties.get('links', []):
+                mysql_services.append(service)
+
+        compose_model = {
+            'data': data,
+            'services_by_registry': services_by_registry,
+            'volumes_by_service': volumes_by_service,
+            'mysql_services': mysql_services,
+        }
+        compose_model_key = key
+        return compose_model
+
+
+def get_docker_compose_data():
+    return get_compose_model()['data']
 
 
 def get_containers():
     return sorted(get_docker_compose_data()['services'].keys())
 
 
-def launch_docker_compose(machine_name, container=None):
+def get_docker_env(machine_name):
     machine = get_machine(machine_name)
-    env_vars = {
+    return {
         'DOCKER_HOST':          machine['url'],
         'DOCKER_MACHINE_NAME':  machine_name,
         'DOCKER_TLS_VERIFY':    '1',
         'DOCKER_CERT_PATH':     os.path.join(os.path.expanduser(settings.DOCKER_MACHINE_CONFIG_PATH), 'machines', machine_name),
+        'PATH':                 os.environ.get('PATH', os.defpath),
     }
 
-    dc_bin = subprocess.check_output(['which', 'docker-compose'], env=env_vars).decode('utf-8').strip()
+
+def get_services_in_dependency_order():
+    '''
+    Returns the services ordered so that each comes after the services it
+    links to or depends on.
+    '''
+    services = get_docker_compose_data()['services']
+    ordered = []
+
+    def visit(service, path):
+        if service in ordered or service in path or service not in services:
+            return
+        properties = services[service]
+        for dependency in sorted(set([link.split(':')[0] for link in properties.get('links', [])] + list(properties.get('depends_on', [])))):
+            visit(dependency, path + [service])
+        ordered.append(service)
+
+    for service in sorted(services):
+        visit(service, [])
+    return ordered
+
+
+def which(binary, env_vars):
+    return check_output(['which', binary], env=env_vars).decode('utf-8').strip()
+
+
+def get_service_image(service):
+    image = get_docker_compose_data()['services'][service].get('image', '')
+    if image and ':' not in image.split('/')[-1] and '@' not in image:
+        image += ':latest'
+    return image
+
+
+def get_deploy_plan(machine_name):
+    '''
+    Compares what is running on a machine with the compose files and returns
+    `(service, reason)` for each service that needs recreating, because it
+    has no container, runs a different image than the one pulled for it, or
+    was created from a different configuration.
+    '''
+    env_vars = get_docker_env(machine_name)
+    dc_bin = which('docker-compose', env_vars)
+    docker_bin = which('docker', env_vars)
+    dc_cmd = [dc_bin] + get_compose_file_args()
+
+    try:
+        output = check_output(dc_cmd + ['config', '--hash=*'], env=env_vars).decode('utf-8')
+        desired_hashes = dict(line.split() for line in output.strip().split('\n') if line)
+    except subprocess.CalledProcessError:
+        # Older docker-compose can't print hashes so only images are compared
+        desired_hashes = {}
+
+    output = check_output([docker_bin, 'images', '--no-trunc', '--format', '{{.Repository}}:{{.Tag}} {{.ID}}'], env=env_vars).decode('utf-8')
+    image_ids = dict(line.split() for line in output.strip().split('\n') if line)
+
+    running = {}
+    container_ids = check_output(dc_cmd + ['ps', '-q'], env=env_vars).decode('utf-8').split()
+    if container_ids:
+        # Tab separated, as a container created outside compose has an empty
+        # config hash
+        template = '{{index .Config.Labels "com.docker.compose.service"}}\t{{.Image}}\t{{index .Config.Labels "com.docker.compose.config-hash"}}\t{{.State.Running}}'
+        output = check_output([docker_bin, 'inspect', '--format', template] + container_ids, env=env_vars).decode('utf-8')
+        for line in output.strip('\n').split('\n'):
+            service, image_id, config_hash, state = line.split('\t')
+            running[service] = {'image_id': image_id, 'config_hash': config_hash, 'running': state == 'true'}
+
+    plan = []
+    for service in get_services_in_dependency_order():
+        container = running.get(service)
+        desired_image_id = image_ids.get(get_service_image(service))
+        if not container:
+            plan.append((service, 'missing'))
+        elif not container['running']:
+            plan.append((service, 'stopped'))
+        elif desired_image_id and container['image_id'] != desired_image_id:
+            plan.append((service, 'image'))
+        elif service in desired_hashes and container['config_hash'] != desired_hashes[service]:
+            plan.append((service, 'config'))
+
+    return plan
+
+
+@traced('healthcheck', 'machine_name', 'service')
+def wait_for_healthy(machine_name, service, timeout=DEPLOY_HEALTH_TIMEOUT):
+    '''
+    Waits for a service's container to report healthy, or just to be running
+    if it has no healthcheck. A one-shot service that exited with code 0 has
+    succeeded. Raises RuntimeError if it becomes unhealthy, stops with an
+    error or takes longer than `timeout` seconds.
+    '''
+    env_vars = get_docker_env(machine_name)
+    dc_bin = which('docker-compose', env_vars)
+    docker_bin = which('docker', env_vars)
+    container_id = check_output([dc_bin] + get_compose_file_args() + ['ps', '-q', service], env=env_vars).decode('utf-8').strip()
+
+    deadline = time.time() + timeout
+    template = '{{.State.Status}} {{.State.ExitCode}} {{if .State.Health}}{{.State.Health.Status}}{{end}}'
+    while True:
+        state, exit_code, health = (check_output([docker_bin, 'inspect', '--format', template, container_id], env=env_vars).decode('utf-8').split() + [''])[:3]
+        if state == 'exited' and exit_code == '0':
+            return
+        status = health or state
+        if status in ['healthy', 'running']:
+            return
+        if status in ['unhealthy', 'exited', 'dead']:
+            raise RuntimeError('Service {} is {} after being recreated'.format(service, status))
+        if time.time() > deadline:
+            raise RuntimeError('Service {} was still {} after {} seconds'.format(service, status, timeout))
+        time.sleep(2)
+
+
+@traced('prefetch', 'machine_name', 'container')
+def prefetch_images(machine_name, container=None):
+    '''
+    Pulls the images for one container, or all of them, onto a machine ahead
+    of deploying.
+    '''
+    env_vars = get_docker_env(machine_name)
+    command = [which('docker-compose', env_vars)] + get_compose_file_args() + ['pull']
+    if container:
+        command.append(container)
+    print(' '.join(command))
+    check_output(command, env=env_vars)
+
+
+@traced('deploy', 'machine_name', 'container')
+def launch_docker_compose(machine_name, container=None, pull=True):
+    '''
+    Deploys one container, or when no container is given, recreates one at a
+    time only the services whose image or configuration changed, waiting
+    for each to become healthy before moving on. Pass `pull=False` if the
+    images were already fetched with `prefetch_images`. Returns the plan of
+    `(service, reason)` that was carried out.
+    '''
+    env_vars = get_docker_env(machine_name)
+
+    dc_bin = which('docker-compose', env_vars)
+    dc_cmd = [dc_bin] + get_compose_file_args()
+
+    if pull:
+        prefetch_images(machine_name, container)
 
     if container:
         commands = [
-            [dc_bin, 'pull', container],
-            [dc_bin, '-f', file_path, 'kill', container],
-            [dc_bin, '-f', file_path, 'rm', '-f', container],
-            [dc_bin, '-f', file_path, 'up', '--remove-orphans', '-d'],
-        ]
-    else:
-        commands = [
-            [dc_bin, 'pull'],
-            [dc_bin, '-f', file_path, 'down'],
-            [dc_bin, '-f', file_path, 'up', '--remove-orphans', '-d'],
+            dc_cmd + ['kill', container],
+            dc_cmd + ['rm', '-f', container],
+            dc_cmd + ['up', '--remove-orphans', '-d'],
         ]
+        for command in commands:
+            print(' '.join(command))
+            check_output(command, env=env_vars)
+        return [(container, 'requested')]
+
+    plan = get_deploy_plan(machine_name)
+    for service, reason in plan:
+        command = dc_cmd + ['up', '-d', '--no-deps', '--force-recreate', service]
+        print('{} ({})'.format(' '.join(command), reason))
+        check_output(command, env=env_vars)
+        wait_for_healthy(machine_name, service)
+
+    command = dc_cmd + ['up', '--remove-orphans', '-d']
+    print(' '.join(command))
+    check_output(command, env=env_vars)
+    return plan
+
 
-    for command in commands:
+@traced('deploy_services', 'machine_name', 'services')
+def launch_services(machine_name, services, pull=True):
+    '''
+    Brings up just `services`, and whatever they link to or depend on, on a
+    machine. Used to deploy a share of the compose file planned by
+    `utils.placement`.
+    '''
+    env_vars = get_docker_env(machine_name)
+    dc_cmd = [which('docker-compose', env_vars)] + get_compose_file_args()
+
+    if pull:
+        command = dc_cmd + ['pull'] + list(services)
         print(' '.join(command))
-        subprocess.check_output(command, env=env_vars)
+        check_output(command, env=env_vars)
+
+    command = dc_cmd + ['up', '-d'] + list(services)
+    print(' '.join(command))
+    check_output(command, env=env_vars)
+
+
+def stop_services(machine_name, services):
+    '''
+    Stops and removes `services` on a machine. Used to take services off the
+    machine they ran on once `utils.placement` has brought them up elsewhere.
+    '''
+    env_vars = get_docker_env(machine_name)
+    command = [which('docker-compose', env_vars)] + get_compose_file_args() + ['rm', '--stop', '--force'] + list(services)
+    print(' '.join(command))
+    check_output(command, env=env_vars)
+
+
+def rollout(machine_names, container=None, concurrency=ROLLOUT_CONCURRENCY, max_failures=ROLLOUT_MAX_FAILURES, prefetch_workers=ROLLOUT_PREFETCH_WORKERS, callback=None):
+    '''
+    Deploys to several machines. Images are first pulled onto the machines,
+    `prefetch_workers` at a time, so that download time is kept out of the
+    deploy window, then machines are deployed `concurrency` at a time.
+    `max_failures` deploys may fail, and once one more has no more deploys
+    are started. A machine that fails to prefetch is only marked failed,
+    without counting towards `max_failures` or holding up the others.
+
+    `callback(machine, stage, error)` is called as each machine finishes a
+    stage. Returns a dict per machine with its `status` ("deployed",
+    "failed" or "skipped"), `prefetch_seconds`, `deploy_seconds`, the
+    `recreated` services and any `error`.
+    '''
+    summary = OrderedDict((name, {'status': 'skipped', 'prefetch_seconds': None, 'deploy_seconds': None, 'recreated': [], 'error': None}) for name in machine_names)
+
+    def timed(stage, function, name, *args):
+        started = time.time()
+        try:
+            return function(name, *args)
+        finally:
+            summary[name]['{}_seconds'.format(stage)] = time.time() - started
+
+    def finish(name, stage, future):
+        error = future.exception()
+        if error:
+            summary[name]['status'] = 'failed'
+            summary[name]['error'] = str(error)
+        elif stage == 'deploy':
+            summary[name]['status'] = 'deployed'
+            summary[name]['recreated'] = future.result()
+        if callback:
+            callback(name, stage, error)
+
+    with ThreadPoolExecutor(max_workers=max(min(len(machine_names), prefetch_workers), 1)) as executor:
+        futures = {executor.submit(timed, 'prefetch', prefetch_images, name, container): name for name in machine_names}
+        for future in as_completed(futures):
+            finish(futures[future], 'prefetch', future)
+
+    queue = [name for name in machine_names if summary[name]['status'] != 'failed']
+    failures = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        while queue or futures:
+            while queue and len(futures) < concurrency and failures <= max_failures:
+                name = queue.pop(0)
+                futures[executor.submit(timed, 'deploy', launch_docker_compose, name, container, False)] = name
+            if not futures:
+                break
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures.pop(future)
+                finish(name, 'deploy', future)
+                if summary[name]['status'] == 'failed':
+                    failures += 1
+
+    return summary
@@ -1,9 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
+import re
 import subprocess
 
 import settings
-from utils.docker_compose import get_docker_compose_data
+from utils.build_cache import get_build_fingerprint, get_cached_digest, record_build
+from utils.docker_compose import get_compose_model, get_image_registry
+from utils.journal import describe_entry, get_entry, is_done, record_item, skip_item
+from utils.runner import get_progress_parser, run_async, run_sync
 from utils.ssh import run_command
+from utils.tracing import check_output, traced
+
+
+BUILD_PARALLELISM = getattr(settings, 'BUILD_PARALLELISM', 4)
+# Build with BuildKit, reusing layers from the image last pushed to the
+# registry and pushing cache metadata along with each image
+BUILD_REGISTRY_CACHE = getattr(settings, 'BUILD_REGISTRY_CACHE', True)
+
+BUILD_SUCCEEDED = re.compile(r'^(Successfully built |#\d+ writing image )')
+CLASSIC_STEP = re.compile(r'^Step \d+/\d+ : (\w+)')
+CLASSIC_CACHE_HIT = re.compile(r'^ ---> Using cache')
+BUILDKIT_STEP = re.compile(r'^#(\d+) \[(?:[\w-]+ )?\d+/\d+\] (\w+)')
+BUILDKIT_CACHE_HIT = re.compile(r'^#(\d+) CACHED')
 
 
 def get_private_images():
@@ -13,29 +31,303 @@ def get_private_images():
     '''
     images = set()
 
-    for item, properties in get_docker_compose_data()['services'].items():
-        if properties.get('image', '').startswith('{}/'.format(settings.REGISTRY_ADDRESS)):
-            images.add(properties['image'].replace('{}/'.format(settings.REGISTRY_ADDRESS), ''))
+    model = get_compose_model()
+    services = model['data']['services']
+    for item in model['services_by_registry'].get(get_image_registry(settings.REGISTRY_ADDRESS + '/'), []):
+        if services[item]['image'].startswith('{}/'.format(settings.REGISTRY_ADDRESS)):
+            images.add(services[item]['image'].replace('{}/'.format(settings.REGISTRY_ADDRESS), ''))
 
     return sorted(list(images))
 
 
-def build_image(image):
-    cmd = ['docker', 'build', '-t', '{}/{}'.format(settings.REGISTRY_ADDRESS, image), '{}/{}'.format(os.path.expanduser(settings.LOCAL_REPOS_PATH), image)]
+def get_image_path(image):
+    return '{}/{}'.format(os.path.expanduser(settings.LOCAL_REPOS_PATH), image)
+
+
+def get_base_images(image):
+    '''
+    Returns the images named in the `FROM` lines of an image's Dockerfile.
+    '''
+    base_images = []
+    with open(os.path.join(get_image_path(image), 'Dockerfile')) as dockerfile:
+        for line in dockerfile:
+            fields = line.split()
+            if len(fields) < 2 or fields[0].upper() != 'FROM':
+                continue
+            fields = [field for field in fields[1:] if not field.startswith('--')]
+            if fields:
+                base_images.append(fields[0])
+    return base_images
+
+
+def get_image_dependencies(images):
+    '''
+    Returns `(dependencies, errors)`. `dependencies` maps each image to the
+    set of other images in `images` that its Dockerfile builds `FROM`. Base
+    images from elsewhere are ignored. `errors` maps each image whose
+    Dockerfile couldn't be read to the exception.
+    '''
+    prefix = '{}/'.format(settings.REGISTRY_ADDRESS)
+    dependencies = {}
+    errors = {}
+
+    for image in images:
+        try:
+            base_images = get_base_images(image)
+        except OSError as e:
+            errors[image] = e
+            continue
+        dependencies[image] = set()
+        for base_image in base_images:
+            if base_image.startswith(prefix):
+                base_image = base_image[len(prefix):].split('@')[0].split(':')[0]
+                if base_image in images and base_image != image:
+                    dependencies[image].add(base_image)
+
+    return dependencies, errors
+
+
+def get_build_command(image):
+    tag = '{}/{}'.format(settings.REGISTRY_ADDRESS, image)
+    cmd = ['docker', 'build', '-t', tag]
+    if BUILD_REGISTRY_CACHE:
+        # A missing image only gives a warning, so first builds still work
+        cmd += ['--cache-from', tag, '--build-arg', 'BUILDKIT_INLINE_CACHE=1', '--progress=plain']
+    return cmd + [get_image_path(image)]
+
+
+def get_cache_parser(cache):
+    '''
+    Returns an `on_line` function that counts the build steps in `cache`,
+    both from the classic builder and BuildKit, as `steps` and those reused
+    from the layer cache as `cached`. FROM steps aren't counted.
+    '''
+    buildkit_steps = set()
+
+    def parse(line):
+        match = CLASSIC_STEP.match(line)
+        if match:
+            if match.group(1).upper() != 'FROM':
+                cache['steps'] += 1
+            return
+        if CLASSIC_CACHE_HIT.match(line):
+            cache['cached'] += 1
+            return
+        match = BUILDKIT_STEP.match(line)
+        if match:
+            if match.group(2).upper() != 'FROM' and match.group(1) not in buildkit_steps:
+                buildkit_steps.add(match.group(1))
+                cache['steps'] += 1
+            return
+        match = BUILDKIT_CACHE_HIT.match(line)
+        if match and match.group(1) in buildkit_steps:
+            cache['cached'] += 1
+    return parse
+
+
+@traced('build_image', 'image')
+async def build_image_async(image, progress=None):
+    '''
+    Builds an image, calling `progress(progress)` as the build goes through
+    its steps; see `utils.runner.get_progress_parser`. Returns how many
+    `steps` the build had and how many were `cached`.
+    '''
+    cmd = get_build_command(image)
+    env = dict(os.environ, DOCKER_BUILDKIT='1') if BUILD_REGISTRY_CACHE else None
+    built = []
+    cache = {'steps': 0, 'cached': 0}
+    parse_cache = get_cache_parser(cache)
+    parse_progress = get_progress_parser('docker-build', progress) if progress else None
+
+    def on_line(line):
+        if BUILD_SUCCEEDED.match(line):
+            built.append(line)
+        parse_cache(line)
+        if progress:
+            parse_progress(line)
+
     try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8')
+        await run_async(cmd, env=env, stderr=subprocess.STDOUT, on_line=on_line, capture=False, attributes={'image': image})
     except subprocess.CalledProcessError:
         raise RuntimeError('Error building image: {}'.format(' '.join(cmd)))
-    if 'Successfully built ' not in output:
+    if not built:
         raise RuntimeError('Error building image: {}'.format(' '.join(cmd)))
+    return cache
+
 
+def build_image(image, progress=None):
+    return run_sync(build_image_async(image, progress))
 
-def push_image(image):
+
+@traced('push_image', 'image')
+async def push_image_async(image, progress=None):
+    '''
+    Pushes an image to the registry and returns the digest it was stored as.
+    `progress(progress)` is called as layers are pushed.
+    '''
     cmd = ['docker', 'push', '{}/{}'.format(settings.REGISTRY_ADDRESS, image)]
     print(cmd)
-    subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8')
+    digests = []
+
+    def on_line(line):
+        match = re.search(r'digest: (sha256:[0-9a-f]+)', line)
+        if match:
+            digests.append(match.group(1))
+        if progress:
+            parse_progress(line)
+
+    parse_progress = get_progress_parser('docker-push', progress) if progress else None
+    await run_async(cmd, stderr=subprocess.STDOUT, on_line=on_line, capture=False)
+    if digests:
+        return digests[-1]
+
+    # Not every docker version prints the digest, but the pushed image
+    # records it among its repo digests
+    name = '{}/{}'.format(settings.REGISTRY_ADDRESS, image)
+    output = await run_async(['docker', 'image', 'inspect', '--format', '{{range .RepoDigests}}{{println .}}{{end}}', name])
+    for repo_digest in output.decode('utf-8').split():
+        if repo_digest.startswith('{}@'.format(name)):
+            return repo_digest.split('@', 1)[1]
+    raise RuntimeError('No digest for {} after pushing it'.format(image))
+
+
+def push_image(image, progress=None):
+    return run_sync(push_image_async(image, progress))
+
+
+def get_image_fingerprint(image):
+    return get_build_fingerprint(get_image_path(image), get_base_images(image))
+
+
+def get_local_image_id(image):
+    try:
+        return check_output(['docker', 'image', 'inspect', '--format', '{{.Id}}', '{}/{}'.format(settings.REGISTRY_ADDRESS, image)], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def build_image_if_changed(image, progress=None, journal=None):
+    '''
+    Builds an image unless the build cache has a pushed digest for the same
+    build context and base images. Returns `(fingerprint, cache)` where
+    `cache` is the layer cache use from `build_image`, or None if the image
+    wasn't built.
+
+    With a `journal` (see `utils.journal`), an image an earlier run built
+    but didn't push isn't built again if its build context is unchanged and
+    the local image is still the one that was built.
+    '''
+    fingerprint = get_image_fingerprint(image)
+    if get_cached_digest(image, fingerprint):
+        if journal is not None:
+            entry = get_entry(journal, image)
+            skip_item(journal, image, '{}, build context unchanged'.format(describe_entry(entry)) if entry else 'unchanged since last push')
+        return fingerprint, None
+
+    entry = get_entry(journal, image)
+    if is_done(journal, image, fingerprint, phase='built') and get_local_image_id(image) == entry['image_id']:
+        skip_item(journal, image, '{}, build context unchanged, so only pushing'.format(describe_entry(entry)))
+        return fingerprint, entry['layer_cache']
+
+    record_item(journal, image, 'building', fingerprint)
+    cache = build_image(image, progress)
+    if journal is not None:
+        record_item(journal, image, 'built', fingerprint, image_id=get_local_image_id(image), layer_cache=cache)
+    return fingerprint, cache
+
+
+def push_and_record_image(image, fingerprint, cache=None, progress=None, journal=None):
+    record_build(image, fingerprint, push_image(image, progress), cache)
+    record_item(journal, image, 'pushed', fingerprint)
+
+
+def build_and_push_images(images, parallelism=BUILD_PARALLELISM, callback=None, progress=None, journal=None):
+    '''
+    Builds and pushes `images`, building up to `parallelism` at once in an
+    order that respects their `FROM` dependencies on each other. Each image is
+    pushed as soon as it has been built, so pushes overlap with later builds.
+    An image that fails stops only the images that depend on it. Images whose
+    build context and base images match the build cache are neither built
+    nor pushed, so their dependents start once their bases have been pushed.
+
+    `callback(image, status, error)` is called as each image changes status.
+    Returns a dict mapping each image to its final status, one of "pushed",
+    "cached", "failed" or "cancelled". `progress(image, progress)` is called
+    as each build and push goes along. Progress is recorded in `journal` if
+    one is given.
+    '''
+    dependencies, errors = get_image_dependencies(images)
+    statuses = {}
+    pending = set(dependencies)
+    completed = set()
+    futures = {}
+
+    def get_progress(image):
+        if progress:
+            return lambda value: progress(image, value)
+
+    def set_status(image, status, error=None):
+        statuses[image] = status
+        if callback:
+            callback(image, status, error)
+
+    for image, error in sorted(errors.items()):
+        record_item(journal, image, 'failed', error=str(error))
+        set_status(image, 'failed', error)
+
+    with ThreadPoolExecutor(max_workers=parallelism) as build_executor, ThreadPoolExecutor(max_workers=parallelism) as push_executor:
+        while pending or futures:
+            # Cancel everything that depends, directly or not, on a failure
+            failed = set(image for image, status in statuses.items() if status in ['failed', 'cancelled'])
+            cancelled = True
+            while cancelled:
+                cancelled = False
+                for image in sorted(pending):
+                    if dependencies[image] & failed:
+                        pending.remove(image)
+                        failed.add(image)
+                        set_status(image, 'cancelled')
+                        cancelled = True
+
+            for image in sorted(pending):
+                if dependencies[image] <= completed:
+                    pending.remove(image)
+                    set_status(image, 'building')
+                    futures[build_executor.submit(build_image_if_changed, image, get_progress(image), journal)] = (image, 'build')
+
+            if not futures:
+                # Whatever is left depends on itself through a cycle
+                for image in sorted(pending):
+                    set_status(image, 'failed', RuntimeError('Circular FROM dependency for image: {}'.format(image)))
+                break
+
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                image, phase = futures.pop(future)
+                error = future.exception()
+                if error:
+                    # A failed push keeps the journal's record of the build
+                    if phase == 'build':
+                        record_item(journal, image, 'failed', error=str(error))
+                    set_status(image, 'failed', error)
+                elif phase == 'build':
+                    fingerprint, cache = future.result()
+                    if cache:
+                        set_status(image, 'pushing')
+                        futures[push_executor.submit(push_and_record_image, image, fingerprint, cache, get_progress(image), journal)] = (image, 'push')
+                    else:
+                        completed.add(image)
+                        set_status(image, 'cached')
+                else:
+                    completed.add(image)
+                    set_status(image, 'pushed')
+
+    return statuses
+
+
+def get_registry_login_command():
+    return 'docker login -u {} -p {} {}'.format(settings.REGISTRY_USER, settings.REGISTRY_PASSWORD, settings.REGISTRY_ADDRESS)
 
 
 def registry_authenticate(machine):
-    cmd = 'docker login -u {} -p {} {}'.format(settings.REGISTRY_USER, settings.REGISTRY_PASSWORD, settings.REGISTRY_ADDRESS)
-    run_command(machine, cmd, silent=True)
+    run_command(machine, get_registry_login_command(), silent=True)
@@ -1,7 +1,13 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import socket
 import subprocess
+import time
 
 import settings
+from utils.tracing import check_output, traced
 
 
 DRIVERS = {
@@ -50,54 +56,127 @@ DRIVERS = {
         }
     }
 }
+INVENTORY_CACHE_PATH = getattr(settings, 'INVENTORY_CACHE_PATH', '~/.punk-deploy/inventory.json')
+INVENTORY_CACHE_TTL = getattr(settings, 'INVENTORY_CACHE_TTL', 60)
+INVENTORY_PROBE_TIMEOUT = getattr(settings, 'INVENTORY_PROBE_TIMEOUT', 2)
+INVENTORY_PROBE_WORKERS = getattr(settings, 'INVENTORY_PROBE_WORKERS', 16)
+DOCKER_PORT = getattr(settings, 'DOCKER_PORT', 2376)
 machines = None
 
 
-def get_machines():
-    global machines
-
-    if machines:
-        # Use cached value if this function was previously called
-        return machines
-    try:
-        output = subprocess.check_output(['docker-machine', 'ls'], stderr=subprocess.STDOUT).decode('utf-8')
-        machines = {}
+def read_machine_configs():
+    '''
+    Reads name, driver and address for every machine from the config.json
+    files docker-machine keeps, without contacting any cloud provider.
+    '''
+    configs = {}
+    machines_path = os.path.join(os.path.expanduser(settings.DOCKER_MACHINE_CONFIG_PATH), 'machines')
+    if not os.path.isdir(machines_path):
+        return configs
+
+    for name in os.listdir(machines_path):
+        config_path = os.path.join(machines_path, name, 'config.json')
+        if not os.path.exists(config_path):
+            continue
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+
+        machine = {
+            'driver': config.get('DriverName', ''),
+            'ip': config.get('Driver', {}).get('IPAddress', ''),
+            'running': None,
+        }
+        machine['url'] = 'tcp://{}:{}'.format(machine['ip'], DOCKER_PORT) if machine['ip'] else ''
+        machine['active'] = bool(machine['url']) and os.environ.get('DOCKER_HOST') == machine['url']
+        configs[config.get('Name', name)] = machine
 
-        for line in output.split('\n'):
-            if not line.startswith('NAME') and not line.startswith('error '):
-                fields = line.split()
-                if len(fields) < 2:
-                    continue
+    return configs
 
-                machine = {
-                    'active': False,
-                    'running': False,
-                }
 
-                if fields[1] == '*':
-                    machine['active'] = True
+def is_machine_running(machine):
+    '''
+    Treats a machine as running if its Docker daemon accepts a connection.
+    '''
+    if not machine['ip']:
+        return False
+    try:
+        socket.create_connection((machine['ip'], DOCKER_PORT), timeout=INVENTORY_PROBE_TIMEOUT).close()
+        return True
+    except OSError:
+        return False
+
+
+def update_running_states(machines):
+    '''
+    Fills in `running` for each machine, from the on-disk cache where it is
+    younger than INVENTORY_CACHE_TTL and otherwise by probing the stale
+    machines, INVENTORY_PROBE_WORKERS at a time.
+    '''
+    cache_path = os.path.expanduser(INVENTORY_CACHE_PATH)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+
+    now = time.time()
+    stale = []
+    for name, machine in machines.items():
+        entry = cache.get(name)
+        if entry and entry['ip'] == machine['ip'] and now - entry['checked'] < INVENTORY_CACHE_TTL:
+            machine['running'] = entry['running']
+        else:
+            stale.append(name)
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=min(len(stale), INVENTORY_PROBE_WORKERS)) as executor:
+            for name, running in zip(stale, executor.map(is_machine_running, [machines[name] for name in stale])):
+                machines[name]['running'] = running
+                cache[name] = {'ip': machines[name]['ip'], 'running': running, 'checked': now}
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open('{}.tmp'.format(cache_path), 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2, sort_keys=True)
+        os.replace('{}.tmp'.format(cache_path), cache_path)
+
+
+def get_machines(check_running=True):
+    '''
+    Returns the machines docker-machine knows about. Whether each one is
+    running is only worked out when `check_running` is set, otherwise it is
+    left as None.
+    '''
+    global machines
 
-                machine['driver'] = fields[2]
-                if fields[3] == 'Running':
-                    machine['running'] = True
-                machine['url'] = fields[4]
+    # Held locally as creating or destroying a machine in another thread
+    # resets the global
+    result = machines
+    if result is None:
+        # Read the configs on the first call and keep them for later ones
+        result = machines = OrderedDict(sorted(read_machine_configs().items()))
+    if check_running and any(machine['running'] is None for machine in result.values()):
+        update_running_states(result)
 
-                if machine['url']:
-                    machine['ip'] = machine['url'].split('://')[1].split(':')[0]
+    return result
 
-                machines[fields[0]] = machine
 
-    except IndexError:
-        return get_machines()
+def reload_machines():
+    '''
+    Forgets the machines read earlier, for long running processes that need
+    to see machines created or destroyed since, and returns them afresh.
+    '''
+    global machines
 
-    return OrderedDict(sorted(machines.items()))
+    machines = None
+    return get_machines()
 
 
 def get_machine(name):
-    return get_machines()[name]
+    return get_machines(check_running=False)[name]
 
 
+@traced('create_machine', 'name', 'driver')
 def create_machine(name, driver, region=None, size=None, image=None):
+    global machines
+
     cmd = ['docker-machine', 'create', '-d', driver]
 
     driver_config = DRIVERS[driver]
@@ -118,17 +197,36 @@ def create_machine(name, driver, region=None, size=None, image=None):
 
     cmd += [name]
     print(' '.join(cmd))
-    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    check_output(cmd, stderr=subprocess.STDOUT)
+    machines = None
 
 
-def provision_machine(name):
-    # TODO: implement!
-    pass
+@traced('provision', 'name', 'ip')
+def provision_machine(name, ip, ssh_user='root', ssh_key='~/.ssh/id_rsa'):
+    '''
+    Adds an existing host to docker-machine using the generic driver, which
+    installs Docker on it over SSH.
+    '''
+    global machines
+
+    cmd = [
+        'docker-machine', 'create', '-d', 'generic',
+        '--generic-ip-address', ip,
+        '--generic-ssh-user', ssh_user,
+        '--generic-ssh-key', os.path.expanduser(ssh_key),
+        name,
+    ]
+    print(' '.join(cmd))
+    check_output(cmd, stderr=subprocess.STDOUT)
+    machines = None
 
 
 def destroy_machine(name):
+    global machines
+
     cmd = ['docker-machine', 'rm', '-y', name]
-    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    check_output(cmd, stderr=subprocess.STDOUT)
+    machines = None
 
 
 def get_drivers():
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import re
+
+import yaml
+
+import settings
+from utils.docker_machine import DRIVERS, get_machines, create_machine, provision_machine
+from utils.initialize import initialize_machine_batch
+
+
+FLEET_TEMPLATE_PATH = getattr(settings, 'FLEET_TEMPLATE_PATH', os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'fleet.yml')))
+FLEET_WORKERS = getattr(settings, 'FLEET_WORKERS', 8)
+
+
+def load_fleet_template(path=FLEET_TEMPLATE_PATH):
+    with open(os.path.expanduser(path)) as template:
+        return yaml.safe_load(template)
+
+
+def get_fleet_specs(template):
+    '''
+    Expands a fleet template into one spec per machine. Entries with a
+    `count` above one are numbered from 1, substituting `{n}` in the name or
+    appending `-N` if the name has no `{n}`.
+    '''
+    specs = []
+    for entry in template.get('machines', []):
+        driver = entry.get('driver')
+        if driver != 'existing' and driver not in DRIVERS:
+            raise ValueError('Unknown driver {} for {}'.format(driver, entry.get('name')))
+        if driver == 'existing' and entry.get('count', 1) != 1:
+            raise ValueError('Existing machine {} can only have a count of 1'.format(entry.get('name')))
+        if driver == 'existing' and not entry.get('ip'):
+            raise ValueError('Existing machine {} needs the ip of its host'.format(entry.get('name')))
+
+        count = entry.get('count', 1)
+        for n in range(1, count + 1):
+            name = entry['name']
+            if '{n}' in name:
+                name = name.replace('{n}', str(n))
+            elif count > 1:
+                name = '{}-{}'.format(name, n)
+            if not re.match(r'^[a-z0-9-]{3,20}$', name):
+                raise ValueError('Machine name {} must be 3-20 characters, lowercase with hyphens'.format(name))
+
+            specs.append({
+                'name':     name,
+                'driver':   driver,
+                'region':   entry.get('region'),
+                'size':     entry.get('size'),
+                'image':    entry.get('image'),
+                'ip':       entry.get('ip'),
+            })
+
+    names = [spec['name'] for spec in specs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError('Fleet template names machines more than once: {}'.format(', '.join(duplicates)))
+    return specs
+
+
+def provision_fleet(specs, workers=FLEET_WORKERS, callback=None):
+    '''
+    Creates the machines in `specs`, or provisions the existing hosts, up to
+    `workers` at a time. Each machine is initialized as soon as it is up
+    rather than waiting for the rest of the fleet. Machines that already
+    exist are just initialized.
+
+    `callback(name, stage, error)` is called when a machine is "created" and
+    when it is "initialized", or with the error that stopped it. Returns a
+    dict per machine with its `status` ("created" or "exists"), the
+    `initialized` step results and any `error`.
+    '''
+    existing = get_machines(check_running=False)
+    results = OrderedDict((spec['name'], {'status': None, 'initialized': None, 'error': None}) for spec in specs)
+
+    def provision(spec):
+        name = spec['name']
+        if name in existing:
+            results[name]['status'] = 'exists'
+        else:
+            if spec['driver'] == 'existing':
+                provision_machine(name, spec['ip'])
+            else:
+                create_machine(name, spec['driver'], spec['region'], spec['size'], spec['image'])
+            results[name]['status'] = 'created'
+            if callback:
+                callback(name, 'created', None)
+        results[name]['initialized'] = initialize_machine_batch(name)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(provision, spec): spec['name'] for spec in specs}
+        for future in as_completed(futures):
+            name = futures[future]
+            error = future.exception()
+            if error:
+                results[name]['error'] = str(error)
+            if callback:
+                callback(name, 'initialized', error)
+
+    return results
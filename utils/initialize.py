@@ -1,63 +1,212 @@
-import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import re
+from shlex import quote
+import threading
 
+import settings
 from utils.docker_machine import get_machine
-from utils.docker_images import registry_authenticate
-from utils.ssh import run_command, get_local_public_key, get_master_public_key
-
-
-def initialize_ssh_keys(machine_name):
-    try:
-        run_command(machine_name, 'pwd', silent=True, user_key=True)
-    except subprocess.CalledProcessError:
-        cmd = 'echo "{}" >> /root/.ssh/authorized_keys'.format(get_local_public_key())
-        run_command(machine_name, cmd)
-
-    machine = get_machine(machine_name)
-    try:
-        cmd = 'ssh root@{} pwd'.format(machine['ip'])
-        run_command('master', cmd, silent=True, user_key=True)
-    except subprocess.CalledProcessError:
-        # Authorize master to login to new machine
-        master_public_key = get_master_public_key()
-        cmd = 'echo "{}" >> /root/.ssh/authorized_keys'.format(master_public_key)
-        run_command(machine_name, cmd)
-
-        # Add host public key to master so it trusts the connection
-        cmd = 'cat /etc/ssh/ssh_host_rsa_key.pub'
-        machine_host_public_key = run_command(machine_name, cmd)
-        cmd = 'echo "{} {}" >> /root/.ssh/known_hosts'.format(machine['ip'], machine_host_public_key)
-        run_command('master', cmd)
-
-
-def initialize_swap(machine):
-    if '/swapfile' not in run_command(machine, 'cat /proc/swaps'):
-        cmd = 'dd if=/dev/zero of=/swapfile bs=1024 count=4096k &&\
-            mkswap /swapfile &&\
-            chmod 600 /swapfile &&\
-            swapon /swapfile &&\
-            echo "/swapfile swap swap defaults 0 0" >> /etc/fstab'
-        run_command(machine, cmd, silent=True)
-
-
-def initialize_automatic_updates(machine):
-    if 'Unattended-Upgrade' not in run_command(machine, 'cat /etc/apt/apt.conf.d/10periodic'):
-        cmd = 'apt-get update &&\
-            apt-get install unattended-upgrades &&\
-            echo APT::Periodic::Unattended-Upgrade "1"\; >> /etc/apt/apt.conf.d/10periodic'
-        run_command(machine, cmd)
-
-
-def initialize_default_apt_packages(machine):
-    packages = [
-        'htop',
+from utils.docker_images import get_registry_login_command
+from utils.ssh import HOST_KEY_FILE, run_command, get_local_public_key, get_master_public_key, trust_host_key
+from utils.tracing import traced
+
+
+INIT_STATE_PATH = getattr(settings, 'INIT_STATE_PATH', '~/.punk-deploy/init-state.json')
+INIT_WORKERS = getattr(settings, 'INIT_WORKERS', 8)
+REMOTE_INIT_STATE_PATH = '/var/lib/punk-deploy/init'
+FAILED_OUTPUT_BYTES = 2000
+DEFAULT_APT_PACKAGES = [
+    'htop',
+]
+SWAP_COMMAND = 'dd if=/dev/zero of=/swapfile bs=1024 count=4096k &&\
+    mkswap /swapfile &&\
+    chmod 600 /swapfile &&\
+    swapon /swapfile &&\
+    echo "/swapfile swap swap defaults 0 0" >> /etc/fstab'
+AUTOMATIC_UPDATES_COMMAND = 'apt-get update &&\
+    apt-get install unattended-upgrades &&\
+    echo APT::Periodic::Unattended-Upgrade "1"\; >> /etc/apt/apt.conf.d/10periodic'
+
+# Applies one step, saving its fingerprint if it succeeds, or sending the end
+# of its output with every line prefixed by the step's index if it fails
+ACTION_SCRIPT = '''output=$(mktemp)
+if ( {action} ) >$output 2>&1; then echo {fingerprint} > {state_file}; echo "{index}:ok"; else echo "{index}:failed"; tail -c {tail} $output | sed 's/^/{index}|/'; fi
+rm -f $output'''
+
+init_state_lock = threading.Lock()
+
+
+def get_initialize_steps():
+    '''
+    Returns `(name, check, action)` for each initialization step. `check` is a
+    shell condition that succeeds when the step has already been applied on
+    the node and `action` is the shell script that applies it.
+    '''
+    authorized_keys = '/root/.ssh/authorized_keys'
+    ssh_keys_check = ' && '.join(['grep -qF {} {}'.format(quote(key), authorized_keys) for key in [get_local_public_key(), get_master_public_key()]])
+    ssh_keys_action = ' && '.join(['(grep -qF {0} {1} || echo {0} >> {1})'.format(quote(key), authorized_keys) for key in [get_local_public_key(), get_master_public_key()]])
+
+    return [
+        ('ssh keys',        ssh_keys_check,                                     ssh_keys_action),
+        ('swap',            'grep -q /swapfile /proc/swaps',                    SWAP_COMMAND),
+        ('auto update',     'grep -q Unattended-Upgrade /etc/apt/apt.conf.d/10periodic', AUTOMATIC_UPDATES_COMMAND),
+        ('apt packages',    'dpkg -s {} >/dev/null 2>&1'.format(' '.join(DEFAULT_APT_PACKAGES)), 'apt-get install -y {}'.format(' '.join(DEFAULT_APT_PACKAGES))),
+        ('docker auth',     'false',                                            get_registry_login_command()),
+        ('volumes',         'test -d /volumes',                                 'mkdir -p /volumes'),
     ]
-    cmd = 'apt-get install -y {}'.format(' '.join(packages))
-    run_command(machine, cmd, silent=True)
 
 
-def initialize_docker_authentication(machine):
-    registry_authenticate(machine)
+def get_step_fingerprint(name, check, action):
+    '''
+    Hashes everything a step applies, so the fingerprint changes whenever its
+    keys, package list or registry credentials do.
+    '''
+    return hashlib.sha256('\0'.join([name, check, action]).encode('utf-8')).hexdigest()
+
+
+def load_init_state():
+    path = os.path.expanduser(INIT_STATE_PATH)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as state_file:
+        return json.load(state_file)
+
+
+def record_init_state(machine_name, ip, fingerprints):
+    with init_state_lock:
+        state = load_init_state()
+        if state.get(machine_name, {}).get('ip') != ip:
+            state[machine_name] = {'ip': ip, 'steps': {}}
+        state[machine_name]['steps'].update(fingerprints)
+        path = os.path.expanduser(INIT_STATE_PATH)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open('{}.tmp'.format(path), 'w') as state_file:
+            json.dump(state, state_file, indent=2, sort_keys=True)
+        os.replace('{}.tmp'.format(path), path)
+
+
+@traced('initialize', 'machine_name')
+def initialize_machine_batch(machine_name, callback=None, verify=False):
+    '''
+    Runs every initialization step against a node in at most three round
+    trips: one probe script that evaluates all the checks and reads the
+    node's host key, one script that applies only the steps that are needed
+    and one call to master that makes it trust the host key if it doesn't
+    already.
+
+    Each applied step leaves a fingerprint of its inputs on the node and in
+    INIT_STATE_PATH. Steps whose fingerprint is unchanged in the local state
+    are skipped without contacting the node or master, and the probe treats
+    a matching fingerprint on the node as done. `verify` ignores both
+    fingerprints and runs every check, so it also rechecks master's trust of
+    the node.
+
+    `callback(name, status)` is called for each step as its status becomes
+    known. Status is one of "skipped", "ok" or "failed". Returns a list of
+    `(name, status, output)` tuples in step order, where `output` is the end
+    of a failed step's output and None otherwise.
+    '''
+    steps = get_initialize_steps()
+    fingerprints = [get_step_fingerprint(name, check, action) for name, check, action in steps]
+    ip = get_machine(machine_name)['ip']
+    statuses = {}
+    outputs = {}
+    applied = {}
+
+    def set_status(name, status):
+        statuses[name] = status
+        if callback:
+            callback(name, status)
+
+    def get_state_file(name):
+        return '{}/{}'.format(REMOTE_INIT_STATE_PATH, name.replace(' ', '-'))
+
+    machine_state = load_init_state().get(machine_name, {})
+    if verify or machine_state.get('ip') != ip:
+        known = {}
+    else:
+        known = machine_state.get('steps', {})
+
+    remaining = []
+    for i, (name, check, action) in enumerate(steps):
+        if known.get(name) == fingerprints[i]:
+            set_status(name, 'skipped')
+        else:
+            remaining.append(i)
+    if not remaining:
+        return [(name, statuses[name], None) for name, check, action in steps]
+
+    probe = ['echo "host-key:$(cat {})"'.format(HOST_KEY_FILE), 'mkdir -p {}'.format(REMOTE_INIT_STATE_PATH)]
+    for i in remaining:
+        name, check, action = steps[i]
+        state_file = get_state_file(name)
+        if not verify:
+            check = '[ "$(cat {} 2>/dev/null)" = "{}" ] || {}'.format(state_file, fingerprints[i], check)
+        probe.append('if {}; then echo {} > {}; echo "{}:done"; else echo "{}:todo"; fi'.format(check, fingerprints[i], state_file, i, i))
+    output = run_command(machine_name, '\n'.join(probe), silent=True)
+
+    needed = set()
+    host_key = None
+    for line in output.strip().split('\n'):
+        if line.startswith('host-key:'):
+            host_key = line[len('host-key:'):].strip()
+            continue
+        match = re.match(r'^(\d+):(done|todo)$', line)
+        if not match:
+            continue
+        i = int(match.group(1))
+        if match.group(2) == 'todo':
+            needed.add(i)
+        else:
+            set_status(steps[i][0], 'skipped')
+            applied[steps[i][0]] = fingerprints[i]
+
+    if needed:
+        script = []
+        for i, (name, check, action) in enumerate(steps):
+            if i in needed:
+                script.append(ACTION_SCRIPT.format(action=action, fingerprint=fingerprints[i], state_file=get_state_file(name), index=i, tail=FAILED_OUTPUT_BYTES))
+        output = run_command(machine_name, '\n'.join(script), silent=True)
+        failed_lines = {}
+        for line in output.strip().split('\n'):
+            match = re.match(r'^(\d+)([:|])(.*)$', line)
+            if not match:
+                continue
+            name = steps[int(match.group(1))][0]
+            if match.group(2) == '|':
+                failed_lines.setdefault(name, []).append(match.group(3))
+                continue
+            set_status(name, match.group(3))
+            if match.group(3) == 'ok':
+                applied[name] = fingerprints[int(match.group(1))]
+        for name, lines in failed_lines.items():
+            outputs[name] = '\n'.join(lines)
+
+    if host_key:
+        # Master may not know the key even though the node was set up before,
+        # e.g. if the IP was reused or master was rebuilt
+        trust_host_key('master', ip, host_key)
+
+    record_init_state(machine_name, ip, applied)
+    return [(name, statuses[name], outputs.get(name)) for name, check, action in steps]
 
 
-def initialize_volumes(machine):
-    run_command(machine, 'mkdir -p /volumes')
+def initialize_machines(machine_names, verify=False, workers=INIT_WORKERS, callback=None):
+    '''
+    Initializes several machines at once, `workers` at a time.
+    `callback(machine, results, error)` is called as each machine finishes.
+    Returns a dict mapping each machine to its list of
+    `(name, status, output)` results, or to the exception that stopped it.
+    '''
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(initialize_machine_batch, name, None, verify): name for name in machine_names}
+        for future in as_completed(futures):
+            name = futures[future]
+            error = future.exception()
+            results[name] = error or future.result()
+            if callback:
+                callback(name, None if error else results[name], error)
+    return results
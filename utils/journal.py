@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+import time
+
+import settings
+
+
+JOURNAL_PATH = getattr(settings, 'JOURNAL_PATH', '~/.punk-deploy/journals')
+
+journal_lock = threading.Lock()
+
+
+def open_journal(operation, *keys, resume=True):
+    '''
+    Returns the journal of a multi-item operation, such as syncing volumes
+    from one machine to another, picking up the one left by an earlier run
+    that didn't finish. Each item's `phase`, `checksum` and time are saved
+    as it goes, so a rerun can skip what was already done. What is skipped,
+    and why, is collected in `skipped`. Pass `resume=False` to start over.
+    '''
+    name = '-'.join([operation] + [str(key) for key in keys])
+    path = os.path.join(os.path.expanduser(JOURNAL_PATH), '{}.json'.format(name))
+    items = {}
+    if resume and os.path.exists(path):
+        with open(path) as journal_file:
+            items = json.load(journal_file)['items']
+    return {'name': name, 'path': path, 'items': items, 'resumed': bool(items), 'skipped': {}}
+
+
+def save_journal(journal):
+    os.makedirs(os.path.dirname(journal['path']), exist_ok=True)
+    with open('{}.tmp'.format(journal['path']), 'w') as journal_file:
+        json.dump({'operation': journal['name'], 'items': journal['items']}, journal_file, indent=2, sort_keys=True)
+    os.replace('{}.tmp'.format(journal['path']), journal['path'])
+
+
+def get_entry(journal, item):
+    '''
+    Returns what the journal knows about an item, or None. Works with no
+    journal too.
+    '''
+    if journal is None:
+        return None
+    with journal_lock:
+        return journal['items'].get(item)
+
+
+def is_done(journal, item, checksum, phase='done'):
+    '''
+    Returns whether an earlier run finished `phase` of an item with the same
+    checksum, so it can be skipped.
+    '''
+    entry = get_entry(journal, item)
+    return bool(entry) and entry['phase'] == phase and entry['checksum'] == checksum
+
+
+def record_item(journal, item, phase, checksum=None, **details):
+    '''
+    Saves that an item reached `phase`, e.g. "started", "done" or "failed",
+    along with its checksum and any other details. Does nothing without a
+    journal.
+    '''
+    if journal is None:
+        return
+    with journal_lock:
+        journal['items'][item] = dict(details, phase=phase, checksum=checksum, time=time.time())
+        save_journal(journal)
+
+
+def skip_item(journal, item, reason):
+    with journal_lock:
+        journal['skipped'][item] = reason
+
+
+def describe_entry(entry):
+    return '{} {}'.format(entry['phase'], time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['time'])))
+
+
+def close_journal(journal, complete):
+    '''
+    Removes the journal once the whole operation has succeeded, so the next
+    run starts afresh. Otherwise it's kept for the rerun to resume from.
+    '''
+    with journal_lock:
+        if complete and os.path.exists(journal['path']):
+            os.remove(journal['path'])
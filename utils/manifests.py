@@ -0,0 +1,127 @@
+import hashlib
+import os
+
+import settings
+from utils.ssh import run_command
+
+
+MANIFEST_CACHE_PATH = getattr(settings, 'MANIFEST_CACHE_PATH', '~/.punk-deploy/manifests')
+REMOTE_MANIFEST_PATH = '/var/lib/punk-deploy/manifests'
+
+# Lists the volume as NUL-terminated "size<tab>mtime<tab>path" records, so
+# any path is safe, then sends either the difference from the listing saved
+# by the previous run (when our copy of it is current) or the whole listing
+MANIFEST_SCRIPT = '''
+mkdir -p {manifest_dir}
+manifest={manifest_dir}/{volume}.0
+(cd {path} 2>/dev/null && find . -type f -printf '%s\\t%T@\\t%P\\0') | LC_ALL=C sort -z > $manifest.new
+if [ -f $manifest ] && [ "$(md5sum < $manifest | cut -c1-32)" = "{known}" ]; then
+    echo delta
+    LC_ALL=C comm -z -3 $manifest $manifest.new
+else
+    echo full
+    cat $manifest.new
+fi
+mv $manifest.new $manifest
+'''
+
+
+def get_cache_path(machine_name, volume):
+    return os.path.join(os.path.expanduser(MANIFEST_CACHE_PATH), machine_name, '{}.0'.format(volume))
+
+
+def read_cached_manifest(machine_name, volume):
+    path = get_cache_path(machine_name, volume)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as manifest_file:
+        return manifest_file.read()
+
+
+def write_cached_manifest(machine_name, volume, data):
+    path = get_cache_path(machine_name, volume)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open('{}.tmp'.format(path), 'wb') as manifest_file:
+        manifest_file.write(data)
+    os.replace('{}.tmp'.format(path), path)
+
+
+def parse_manifest(data):
+    '''
+    Returns a dict mapping each file's path to its `(size, mtime)`. mtimes are
+    truncated to whole seconds as that is all rsync guarantees to preserve.
+    '''
+    manifest = {}
+    for record in data.split(b'\0'):
+        fields = record.split(b'\t', 2)
+        if len(fields) == 3:
+            manifest[fields[2].decode('utf-8', 'surrogateescape')] = (int(fields[0]), int(float(fields[1])))
+    return manifest
+
+
+def get_local_manifest(path):
+    manifest = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            stat = os.lstat(file_path)
+            manifest[os.path.relpath(file_path, path)] = (stat.st_size, int(stat.st_mtime))
+    return manifest
+
+
+def update_manifest(machine_name, volume, path):
+    '''
+    Refreshes the manifest of a volume on a machine and returns it parsed.
+
+    The machine keeps the listing from its previous run and we keep a copy of
+    it locally, so normally only the lines that changed since then cross the
+    network. If the copies have diverged the whole listing is sent instead.
+    Either way the machine still walks and stats every file in the volume,
+    so this doesn't make the scan itself any cheaper: directory mtimes don't
+    change when a file is rewritten in place, and `find -newer` has to stat
+    each file to tell, so there's no cheaper way to find what changed
+    without a watcher on the machine. What it saves is rsync's own walk and
+    file list exchange over the network.
+    '''
+    if machine_name == 'local':
+        return get_local_manifest(path)
+
+    cached = read_cached_manifest(machine_name, volume)
+    known = hashlib.md5(cached).hexdigest() if cached is not None else ''
+    script = MANIFEST_SCRIPT.format(manifest_dir=REMOTE_MANIFEST_PATH, volume=volume, path=path, known=known)
+    output = run_command(machine_name, script, silent=True, raw=True)
+    mode, changes = output.split(b'\n', 1)
+
+    if mode == b'delta':
+        records = set(cached.split(b'\0'))
+        for record in changes.split(b'\0'):
+            if record.startswith(b'\t'):
+                records.add(record[1:])
+            else:
+                records.discard(record)
+        records.discard(b'')
+        data = b''.join(record + b'\0' for record in sorted(records))
+    else:
+        data = changes
+
+    write_cached_manifest(machine_name, volume, data)
+    return parse_manifest(data)
+
+
+def get_changed_files(src_manifest, dst_manifest):
+    '''
+    Returns the paths that are missing from, or differ in size or mtime in,
+    the destination.
+    '''
+    return sorted([path for path, entry in src_manifest.items() if dst_manifest.get(path) != entry])
+
+
+def get_manifest_checksum(manifest):
+    '''
+    Hashes a parsed manifest, so a volume's contents can be compared with
+    what they were when it was last synced.
+    '''
+    digest = hashlib.md5()
+    for path, (size, mtime) in sorted(manifest.items()):
+        digest.update('{}\t{}\t{}\0'.format(size, mtime, path).encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
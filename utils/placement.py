@@ -0,0 +1,330 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+
+import settings
+from utils.docker_compose import get_compose_model, get_services_in_dependency_order, launch_services, stop_services
+from utils.docker_machine import get_machines
+from utils.ssh import run_command
+from utils.stats import STATS_TIMEOUT, STATS_WORKERS, get_fleet_stats, get_machine_sample
+
+
+# Fraction of each machine's memory and CPUs left free by a plan
+PLACEMENT_HEADROOM = getattr(settings, 'PLACEMENT_HEADROOM', 0.2)
+# Footprint of a service with nothing declared that isn't running anywhere
+PLACEMENT_DEFAULT_MEMORY = getattr(settings, 'PLACEMENT_DEFAULT_MEMORY', 128 * 1024 * 1024)
+PLACEMENT_DEFAULT_CPUS = getattr(settings, 'PLACEMENT_DEFAULT_CPUS', 0.1)
+# "spread" leaves each machine as much room as it can, "pack" fills machines
+# up before using the next
+PLACEMENT_STRATEGY = getattr(settings, 'PLACEMENT_STRATEGY', 'spread')
+PLACEMENT_WORKERS = getattr(settings, 'PLACEMENT_WORKERS', 4)
+
+MEMORY_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+# The compose service of each running container, then each container's usage
+USAGE_SCRIPT = '''docker ps --format '{{.ID}} {{.Label "com.docker.compose.service"}}'
+echo ---
+docker stats --no-stream --format '{{.ID}} {{.CPUPerc}} {{.MemUsage}}'
+'''
+
+
+def parse_memory(value):
+    '''
+    Converts memory sizes as compose files and `docker stats` write them,
+    like 512m, 1.5GiB or a number of bytes, into bytes.
+    '''
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r'^([\d.]+)\s*([kmgt]?)(i?b)?$', str(value).strip().lower())
+    if not match:
+        raise ValueError('Unknown memory size: {}'.format(value))
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def get_declared_footprint(properties):
+    '''
+    Returns the memory and CPUs a service reserves in its compose
+    definition, falling back to its limits. Either can be None.
+    '''
+    resources = properties.get('deploy', {}).get('resources', {})
+    reservations = resources.get('reservations', {})
+    limits = resources.get('limits', {})
+    memory = reservations.get('memory') or properties.get('mem_reservation') or limits.get('memory') or properties.get('mem_limit')
+    cpus = reservations.get('cpus') or limits.get('cpus') or properties.get('cpus')
+    return {
+        'memory':   parse_memory(memory) if memory else None,
+        'cpus':     float(cpus) if cpus else None,
+    }
+
+
+def get_container_usage(machine_name, timeout=None):
+    '''
+    Returns the memory and CPUs each compose service's containers are using
+    on a machine right now, from `docker stats`.
+    '''
+    output = run_command(machine_name, USAGE_SCRIPT, silent=True, timeout=timeout)
+    containers, stats = output.split('---\n', 1) if '---\n' in output else (output, '')
+    services = dict(line.split(None, 1) for line in containers.strip().split('\n') if len(line.split()) == 2)
+
+    usage = {}
+    for line in stats.strip().split('\n'):
+        fields = line.split()
+        if len(fields) < 3 or fields[0] not in services:
+            continue
+        service_usage = usage.setdefault(services[fields[0]], {'memory': 0, 'cpus': 0.0})
+        service_usage['memory'] += parse_memory(fields[2])
+        service_usage['cpus'] += float(fields[1].rstrip('%')) / 100
+    return usage
+
+
+def get_machine_usage(machine_name, timeout=None):
+    '''
+    Samples a machine's capacity along with what its containers use.
+    '''
+    return {
+        'sample':       get_machine_sample(machine_name, timeout),
+        'containers':   get_container_usage(machine_name, timeout),
+    }
+
+
+def get_service_groups(services):
+    '''
+    Returns the services split into groups that have to share a machine,
+    because they are linked, depend on each other or share volumes or
+    network namespaces.
+    '''
+    groups = {service: {service} for service in services}
+
+    def join(service, other):
+        other = other.split(':')[0]
+        if other in groups and groups[other] is not groups[service]:
+            merged = groups[service] | groups[other]
+            for member in merged:
+                groups[member] = merged
+
+    for service, properties in services.items():
+        for link in properties.get('links', []):
+            join(service, link)
+        for dependency in properties.get('depends_on', []):
+            join(service, dependency)
+        for volume_from in properties.get('volumes_from', []):
+            join(service, volume_from[len('container:'):] if volume_from.startswith('container:') else volume_from)
+        if properties.get('network_mode', '').startswith('service:'):
+            join(service, properties['network_mode'][len('service:'):])
+
+    unique = []
+    for group in groups.values():
+        if group not in unique:
+            unique.append(group)
+    return sorted(sorted(group) for group in unique)
+
+
+def get_service_footprints(services, usage):
+    '''
+    Returns the memory and CPUs to plan for each service, along with where
+    each figure came from: what the compose file declares, otherwise the
+    most its containers use on any machine in `usage`, otherwise the
+    defaults.
+    '''
+    observed = {}
+    for machine_usage in usage.values():
+        for service, service_usage in machine_usage['containers'].items():
+            service_observed = observed.setdefault(service, {'memory': 0, 'cpus': 0.0})
+            service_observed['memory'] = max(service_observed['memory'], service_usage['memory'])
+            service_observed['cpus'] = max(service_observed['cpus'], service_usage['cpus'])
+
+    defaults = {'memory': PLACEMENT_DEFAULT_MEMORY, 'cpus': PLACEMENT_DEFAULT_CPUS}
+    footprints = {}
+    for service, properties in services.items():
+        declared = get_declared_footprint(properties)
+        footprint = {}
+        for resource in ['memory', 'cpus']:
+            if declared[resource]:
+                footprint[resource] = declared[resource]
+                footprint['{}_source'.format(resource)] = 'declared'
+            elif service in observed:
+                footprint[resource] = observed[service][resource]
+                footprint['{}_source'.format(resource)] = 'observed'
+            else:
+                footprint[resource] = defaults[resource]
+                footprint['{}_source'.format(resource)] = 'default'
+        footprints[service] = footprint
+    return footprints
+
+
+def get_machine_capacities(usage, headroom=PLACEMENT_HEADROOM):
+    '''
+    Returns the memory and CPUs each machine can give compose services.
+    Whatever the machine is using besides its compose containers, worked out
+    from its memory use and load average, is taken off along with the
+    `headroom` fraction.
+    '''
+    capacities = {}
+    for name, machine_usage in usage.items():
+        sample = machine_usage['sample']
+        containers = machine_usage['containers'].values()
+        memory_used = sample['memory_total'] * sample['memory'] / 100
+        other_memory = max(0, memory_used - sum(container['memory'] for container in containers))
+        other_cpus = max(0.0, sample['load'] - sum(container['cpus'] for container in containers))
+        capacities[name] = {
+            'memory_total': sample['memory_total'],
+            'cpus_total':   sample['cpus'],
+            'memory':       sample['memory_total'] * (1 - headroom) - other_memory,
+            'cpus':         sample['cpus'] * (1 - headroom) - other_cpus,
+        }
+    return capacities
+
+
+def plan_placement(groups, footprints, capacities, strategy=PLACEMENT_STRATEGY):
+    '''
+    Bin-packs groups of services onto machines, biggest groups first. Each
+    group goes on the machine that will have the most room left relative
+    to its size with "spread", or the least with "pack", among those it
+    fits on.
+
+    Returns `(machines, unplaced)`: the services, memory and CPUs planned
+    for each machine out of its capacity, and the reason each service that
+    fits nowhere couldn't be placed.
+    '''
+    machines = {
+        name: {'services': [], 'memory': 0, 'cpus': 0.0, 'memory_capacity': capacity['memory'], 'cpus_capacity': capacity['cpus']}
+        for name, capacity in capacities.items()
+    }
+    unplaced = {}
+    largest_memory = max([capacity['memory'] for capacity in capacities.values()] + [1])
+    largest_cpus = max([capacity['cpus'] for capacity in capacities.values()] + [1])
+
+    def get_need(group):
+        return {resource: sum(footprints[service][resource] for service in group) for resource in ['memory', 'cpus']}
+
+    def get_room_left(name, need):
+        machine = machines[name]
+        return min(
+            (machine['memory_capacity'] - machine['memory'] - need['memory']) / max(machine['memory_capacity'], 1),
+            (machine['cpus_capacity'] - machine['cpus'] - need['cpus']) / max(machine['cpus_capacity'], 0.01),
+        )
+
+    def get_size(group):
+        need = get_need(group)
+        return max(need['memory'] / largest_memory, need['cpus'] / largest_cpus)
+
+    for group in sorted(groups, key=lambda group: (-get_size(group), group)):
+        need = get_need(group)
+        candidates = [name for name in sorted(machines) if get_room_left(name, need) >= 0]
+        if not candidates:
+            reason = 'Needs {:.0f}MB and {:.2f} CPUs together with {}'.format(need['memory'] / 1024 ** 2, need['cpus'], ', '.join(group))
+            for service in group:
+                unplaced[service] = reason
+            continue
+
+        if strategy == 'pack':
+            name = min(candidates, key=lambda name: get_room_left(name, need))
+        else:
+            name = max(candidates, key=lambda name: get_room_left(name, need))
+        machines[name]['services'] += group
+        machines[name]['memory'] += need['memory']
+        machines[name]['cpus'] += need['cpus']
+
+    for machine in machines.values():
+        machine['services'].sort()
+    return machines, unplaced
+
+
+def get_placement_plan(machine_names=None, strategy=PLACEMENT_STRATEGY, workers=STATS_WORKERS, timeout=STATS_TIMEOUT):
+    '''
+    Plans where to run every service in the compose files across the running
+    machines, or just `machine_names`, using their live capacity. Returns
+    the `machines` plans, each with the services `running` there now, the
+    `unplaced` services, the `footprints` planned for and the `unreachable`
+    machines that were left out.
+    '''
+    if machine_names is None:
+        machine_names = sorted(name for name, properties in get_machines().items() if properties['running'])
+    services = get_compose_model()['data']['services']
+
+    usage = {}
+    unreachable = []
+    for name, machine_usage in get_fleet_stats(machine_names, workers, timeout, function=get_machine_usage):
+        if machine_usage:
+            usage[name] = machine_usage
+        else:
+            unreachable.append(name)
+
+    footprints = get_service_footprints(services, usage)
+    machines, unplaced = plan_placement(get_service_groups(services), footprints, get_machine_capacities(usage), strategy)
+    for name, machine in machines.items():
+        machine['running'] = sorted(usage[name]['containers'])
+    return {
+        'machines':     machines,
+        'unplaced':     unplaced,
+        'footprints':   footprints,
+        'unreachable':  sorted(unreachable),
+    }
+
+
+def deploy_placement(plan, workers=PLACEMENT_WORKERS, callback=None):
+    '''
+    Deploys each machine's share of a placement plan, `workers` machines at
+    a time, starting services in dependency order. Once a service is up on
+    its planned machine it is stopped on any machine it was running on
+    before, since capacity was planned as if it had moved. Services that
+    couldn't be placed, or whose new machine failed, are left running.
+
+    Services that keep data in volumes are never moved, as their data would
+    stay behind. A group with such a service running on another machine is
+    left where it is, neither started on its planned machine nor stopped.
+    Machines that were unreachable when planning can't be checked for
+    services moved off them, so each one is reported as an error.
+
+    `callback(machine, stage, error)` is called as each machine finishes a
+    stage, "deployed" or "stopped". Returns `(errors, kept)`: a dict mapping
+    each failed machine to its exception and one giving the reason each
+    service was left where it is.
+    '''
+    model = get_compose_model()
+    order = get_services_in_dependency_order()
+    errors = {}
+    for name in plan['unreachable']:
+        errors[name] = RuntimeError('Could not reach {} to stop any services moved off it'.format(name))
+
+    running = {}
+    for name, machine in plan['machines'].items():
+        for service in machine.get('running', []):
+            running.setdefault(service, set()).add(name)
+    groups = get_service_groups(model['data']['services'])
+    kept = {}
+    for name, machine in plan['machines'].items():
+        for group in groups:
+            if not set(group) & set(machine['services']):
+                continue
+            stateful = [service for service in group if model['volumes_by_service'].get(service) and running.get(service, set()) - {name}]
+            if stateful:
+                reason = '{} keeps its data in volumes on {}'.format(stateful[0], ', '.join(sorted(running[stateful[0]] - {name})))
+                for service in group:
+                    kept[service] = reason
+
+    def run_stage(stage, function, jobs):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(function, name, services): name for name, services in jobs.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                error = future.exception()
+                if error:
+                    errors.setdefault(name, error)
+                if callback:
+                    callback(name, stage, error)
+
+    launches = {}
+    for name, machine in plan['machines'].items():
+        services = [service for service in machine['services'] if service not in kept]
+        if services:
+            launches[name] = sorted(services, key=order.index)
+    run_stage('deployed', launch_services, launches)
+
+    placed = {service: name for name, services in launches.items() if name not in errors for service in services}
+    moved = {}
+    for name, machine in plan['machines'].items():
+        services = [service for service in machine.get('running', []) if service in placed and placed[service] != name]
+        if services:
+            moved[name] = services
+    run_stage('stopped', stop_services, moved)
+    return errors, kept
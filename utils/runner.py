@@ -0,0 +1,260 @@
+import asyncio
+from collections import deque
+import contextvars
+import re
+import subprocess
+import threading
+import time
+
+import settings
+from utils.tracing import redact, span
+
+
+# Output kept from commands whose output is streamed rather than captured
+RUNNER_TAIL_BYTES = getattr(settings, 'RUNNER_TAIL_BYTES', 65536)
+READ_SIZE = 65536
+LINE_ENDINGS = re.compile(rb'[\r\n]')
+
+loop = None
+loop_thread = None
+loop_lock = threading.Lock()
+
+RSYNC_PROGRESS = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+(\S+)/s\s+(\d+):(\d+):(\d+)')
+DOCKER_LAYER_PROGRESS = re.compile(r'^(\w+): (?:Pushing|Downloading|Extracting)\s+\[[^\]]*\]\s+([\d.]+\s*[kMGT]?B)/([\d.]+\s*[kMGT]?B)')
+DOCKER_LAYER_DONE = re.compile(r'^(\w+): (?:Pushed|Layer already exists|Pull complete|Already exists)')
+DOCKER_LAYER_STARTED = re.compile(r'^(\w+): (?:Preparing|Waiting|Pulling fs layer)')
+DOCKER_BUILD_CONTEXT = re.compile(r'^Sending build context to Docker daemon\s+([\d.]+\s*[kMGT]?B)')
+DOCKER_BUILD_STEP = re.compile(r'^(?:Step (\d+)/(\d+) :|#\d+ \[(?:[\w-]+ )?(\d+)/(\d+)\])')
+SIZE_UNITS = {'B': 1, 'kB': 1000, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4}
+
+
+def get_loop():
+    '''
+    Returns the event loop shared by every command run through this module,
+    starting it in a background thread the first time.
+    '''
+    global loop, loop_thread
+
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=loop.run_forever, name='runner', daemon=True)
+            loop_thread.start()
+        return loop
+
+
+def run_sync(coroutine):
+    '''
+    Runs a coroutine on the shared loop and waits for its result, for callers
+    that aren't async themselves. The caller's open trace spans carry over.
+    Can't be used from a coroutine running on the loop.
+    '''
+    if threading.current_thread() is loop_thread:
+        raise RuntimeError('run_sync would block the event loop, await the coroutine instead')
+    context = contextvars.copy_context()
+
+    async def in_context():
+        for variable, value in context.items():
+            variable.set(value)
+        return await coroutine
+
+    return asyncio.run_coroutine_threadsafe(in_context(), get_loop()).result()
+
+
+async def run_in_thread(function, *args):
+    '''
+    Runs a blocking function in the loop's default thread pool, keeping the
+    caller's open trace spans.
+    '''
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(None, context.run, function, *args)
+
+
+async def read_stream(stream, on_line, output, capture):
+    '''
+    Reads a stream as it arrives, calling `on_line(line)` for each line ended
+    by a newline or a carriage return, which progress meters use to redraw.
+    Everything read goes into the `output` deque, which only keeps around
+    the last RUNNER_TAIL_BYTES unless `capture` is set.
+    '''
+    pending = b''
+    size = 0
+    while True:
+        data = await stream.read(READ_SIZE)
+        if not data:
+            break
+        output.append(data)
+        size += len(data)
+        while not capture and size - len(output[0]) >= RUNNER_TAIL_BYTES:
+            size -= len(output.popleft())
+
+        if on_line:
+            lines = LINE_ENDINGS.split(pending + data)
+            pending = lines.pop()
+            if len(pending) > READ_SIZE:
+                lines.append(pending)
+                pending = b''
+            for line in lines:
+                if line:
+                    on_line(line.decode('utf-8', 'replace'))
+    if on_line and pending:
+        on_line(pending.decode('utf-8', 'replace'))
+
+
+async def run_async(cmd, input=None, env=None, timeout=None, stderr=None, on_line=None, capture=True, attributes=None):
+    '''
+    Runs a command without blocking the loop, passing each line of its output
+    to `on_line` as it arrives. Returns the whole output, or with
+    `capture=False` just its last RUNNER_TAIL_BYTES so memory stays bounded
+    however much the command prints. Pass `stderr=subprocess.STDOUT` to
+    stream both. Raises CalledProcessError or TimeoutExpired like
+    `subprocess.check_output`.
+    '''
+    attributes = dict(attributes or {})
+    attributes['command'] = redact(' '.join(cmd))
+    if input is not None:
+        attributes['bytes_in'] = len(input)
+
+    with span('command', **attributes) as record:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.PIPE if input is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            env=env,
+        )
+        output = deque()
+
+        async def write_input():
+            try:
+                process.stdin.write(input)
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # The command exited without reading all of it, which
+                # `subprocess.communicate` ignores too
+                pass
+            process.stdin.close()
+
+        async def communicate():
+            # Input is written while the output is read, as a command can
+            # fill its output pipe before it has read all its input
+            readers = [read_stream(process.stdout, on_line, output, capture)]
+            if input is not None:
+                readers.append(write_input())
+            await asyncio.gather(*readers)
+            return await process.wait()
+
+        try:
+            returncode = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise subprocess.TimeoutExpired(cmd, timeout, b''.join(output))
+
+        output = b''.join(output)
+        record['exit_code'] = returncode
+        record['bytes_out'] = len(output)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, output)
+        return output
+
+
+def run(cmd, **kwargs):
+    '''
+    Blocking version of `run_async`.
+    '''
+    return run_sync(run_async(cmd, **kwargs))
+
+
+def parse_size(size):
+    '''
+    Converts sizes as docker and rsync print them, like "12.3MB", into bytes.
+    '''
+    match = re.match(r'^([\d.,]+)\s*([kKMGT]?B?)$', size.strip())
+    if not match:
+        return None
+    unit = match.group(2) or 'B'
+    if not unit.endswith('B'):
+        unit += 'B'
+    return int(float(match.group(1).replace(',', '')) * SIZE_UNITS.get(unit, 1))
+
+
+def get_progress_parser(kind, callback):
+    '''
+    Returns an `on_line` function that follows the progress output of "rsync"
+    (run with `--info=progress2`), "docker-push" or "docker-build" and calls
+    `callback(progress)` whenever it changes. `progress` has the `bytes`
+    done, `total` bytes, `percent` and `rate` in bytes per second, and the
+    `eta` in seconds. Any of these can be None when the output doesn't
+    say. Docker only prints byte counts to a terminal, so otherwise its
+    progress is counted in layers or build steps.
+    '''
+    started = time.time()
+    layers = {}
+
+    def report(done, total, percent=None, eta=None, rate=None):
+        elapsed = time.time() - started
+        if percent is None and total:
+            percent = 100.0 * done / total
+        if rate is None and done is not None and elapsed > 0:
+            rate = done / elapsed
+        if eta is None and percent and elapsed > 0:
+            eta = elapsed * (100 - percent) / percent
+        callback({'bytes': done, 'total': total, 'percent': percent, 'rate': rate, 'eta': eta})
+
+    def parse_rsync(line):
+        match = RSYNC_PROGRESS.match(line)
+        if match:
+            done = int(match.group(1).replace(',', ''))
+            percent = int(match.group(2))
+            eta = int(match.group(4)) * 3600 + int(match.group(5)) * 60 + int(match.group(6))
+            report(done, done * 100 // percent if percent else None, percent, eta, parse_size(match.group(3)))
+
+    def parse_docker_layers(line):
+        match = DOCKER_LAYER_PROGRESS.match(line)
+        if match:
+            layers[match.group(1)] = [parse_size(match.group(2)), parse_size(match.group(3))]
+        elif DOCKER_LAYER_DONE.match(line):
+            layer = layers.setdefault(DOCKER_LAYER_DONE.match(line).group(1), [None, None])
+            layer[0] = layer[1]
+            layer.append('done')
+        elif DOCKER_LAYER_STARTED.match(line):
+            layers.setdefault(DOCKER_LAYER_STARTED.match(line).group(1), [None, None])
+        else:
+            return
+        sizes = [layer[:2] for layer in layers.values()]
+        if all(total is not None for done, total in sizes):
+            report(sum(done or 0 for done, total in sizes), sum(total for done, total in sizes))
+        else:
+            finished = len([layer for layer in layers.values() if len(layer) > 2])
+            report(None, None, 100.0 * finished / len(layers))
+
+    def parse_docker_build(line):
+        match = DOCKER_BUILD_CONTEXT.match(line)
+        if match:
+            report(parse_size(match.group(1)), None, 0.0)
+            return
+        match = DOCKER_BUILD_STEP.match(line)
+        if match:
+            step, steps = [int(value) for value in match.groups() if value]
+            report(None, None, 100.0 * (step - 1) / steps)
+
+    return {
+        'rsync':        parse_rsync,
+        'docker-push':  parse_docker_layers,
+        'docker-pull':  parse_docker_layers,
+        'docker-build': parse_docker_build,
+    }[kind]
+
+
+def format_progress(progress):
+    parts = []
+    if progress['percent'] is not None:
+        parts.append('{:.0f}%'.format(progress['percent']))
+    if progress['bytes'] is not None:
+        parts.append('{:.1f}MB'.format(progress['bytes'] / 1000000.0))
+    if progress['rate']:
+        parts.append('{:.1f}MB/s'.format(progress['rate'] / 1000000.0))
+    if progress['eta'] is not None:
+        parts.append('ETA {}:{:02d}'.format(int(progress['eta']) // 60, int(progress['eta']) % 60))
+    return ' '.join(parts)
@@ -1,27 +1,167 @@
+import atexit
+import hashlib
 import os
+from shlex import quote
+import shutil
 import subprocess
+import tempfile
+import threading
 
 import settings
 from utils.docker_machine import get_machine
+from utils.runner import run_async, run_sync
+from utils.tracing import check_output
 
 
 FNULL = open(os.devnull, 'w')
+SSH_CONTROL_PERSIST = getattr(settings, 'SSH_CONTROL_PERSIST', 300)
+HOST_KEY_FILE = '/etc/ssh/ssh_host_rsa_key.pub'
+KNOWN_HOSTS_FILE = '/root/.ssh/known_hosts'
 
+control_dir = None
+control_connections = {}
+control_lock = threading.Lock()
+pinned_host_keys = set()
+pinned_host_keys_lock = threading.Lock()
 
-def run_command(machine_name, command, silent=False, user_key=False):
-    stderr = FNULL if silent else None
 
-    address = settings.MASTER_ADDRESS
-    if machine_name not in ['master', 'local']:
-        address = get_machine(machine_name)['ip']
+def get_control_path(machine_name, address, key_file=None, forward_agent=False):
+    '''
+    Returns the ControlMaster socket path shared by every SSH call to the same
+    machine with the same key. The first call opens the master connection and
+    later calls are multiplexed over it until it has been idle for
+    SSH_CONTROL_PERSIST seconds.
+
+    Calls that forward the agent get a master of their own, as OpenSSH only
+    forwards it over a shared connection that was opened with it.
+    '''
+    global control_dir
+
+    with control_lock:
+        if not control_dir:
+            # Kept short as unix socket paths are limited to ~100 characters
+            control_dir = tempfile.mkdtemp(prefix='punk-ssh-')
+        key = (machine_name, key_file, forward_agent)
+        if key not in control_connections:
+            name = hashlib.md5('{}:{}:{}'.format(machine_name, key_file, forward_agent).encode('utf-8')).hexdigest()[:12]
+            control_connections[key] = (os.path.join(control_dir, name), address)
+        return control_connections[key][0]
+
+
+def get_ssh_command(machine_name, address, key_file=None, forward_agent=False):
+    control_path = get_control_path(machine_name, address, key_file, forward_agent)
+    cmd = [
+        'ssh',
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath={}'.format(control_path),
+        '-o', 'ControlPersist={}'.format(SSH_CONTROL_PERSIST),
+    ]
+    if key_file:
+        cmd += ['-i', key_file]
+    if forward_agent:
+        cmd += ['-A']
+    return cmd + ['root@{}'.format(address)]
+
 
-    if machine_name == 'master' or user_key:
-        return subprocess.check_output(['ssh', 'root@{}'.format(address), command], stderr=stderr).decode('utf-8')
+def close_connections():
+    '''
+    Shuts down any master connections that are still open and removes their
+    sockets. Registered to run at exit.
+    '''
+    global control_dir
+
+    with control_lock:
+        for control_path, address in control_connections.values():
+            if os.path.exists(control_path):
+                subprocess.call(['ssh', '-o', 'ControlPath={}'.format(control_path), '-O', 'exit', 'root@{}'.format(address)], stdout=FNULL, stderr=FNULL)
+        control_connections.clear()
+        if control_dir:
+            shutil.rmtree(control_dir, ignore_errors=True)
+            control_dir = None
+
+
+atexit.register(close_connections)
+
+
+def get_command(machine_name, command, user_key=False, forward_agent=False):
+    '''
+    Returns the argument list that runs `command` on a machine.
+    '''
     if machine_name == 'local':
-        return subprocess.check_output(command.split(' '), stderr=stderr).decode('utf-8')
-    else:
-        key_file = os.path.join(os.path.expanduser(settings.DOCKER_MACHINE_CONFIG_PATH), 'machines', machine_name, 'id_rsa')
-        return subprocess.check_output(['ssh', '-i', key_file, 'root@{}'.format(address), command], stderr=stderr).decode('utf-8')
+        return command.split(' ')
+    if machine_name == 'master':
+        return get_ssh_command(machine_name, settings.MASTER_ADDRESS, forward_agent=forward_agent) + [command]
+
+    address = get_machine(machine_name)['ip']
+    if user_key:
+        return get_ssh_command(machine_name, address, forward_agent=forward_agent) + [command]
+    key_file = os.path.join(os.path.expanduser(settings.DOCKER_MACHINE_CONFIG_PATH), 'machines', machine_name, 'id_rsa')
+    return get_ssh_command(machine_name, address, key_file, forward_agent) + [command]
+
+
+def run_command(machine_name, command, silent=False, user_key=False, timeout=None, forward_agent=False, input=None, on_line=None, raw=False):
+    '''
+    Runs a command on a machine and returns its output. With `on_line`, each
+    line is passed to it as it arrives and only the tail of the output is
+    returned; see `utils.runner.run_async`. With `raw`, the output is
+    returned as bytes, for output such as file names that may not be UTF-8.
+    '''
+    if on_line:
+        return run_sync(run_command_async(machine_name, command, silent, user_key, timeout, forward_agent, input, on_line, raw))
+
+    stderr = FNULL if silent else None
+    if input is not None:
+        input = input.encode('utf-8', 'surrogateescape')
+    cmd = get_command(machine_name, command, user_key, forward_agent)
+    output = check_output(cmd, stderr=stderr, timeout=timeout, input=input, attributes={'machine': machine_name})
+    return output if raw else output.decode('utf-8')
+
+
+async def run_command_async(machine_name, command, silent=False, user_key=False, timeout=None, forward_agent=False, input=None, on_line=None, raw=False):
+    '''
+    Version of `run_command` for coroutines on the runner's event loop.
+    '''
+    stderr = subprocess.DEVNULL if silent else None
+    if input is not None:
+        # File names that aren't UTF-8 come from os.walk and the manifests
+        # with surrogates standing in for their bytes
+        input = input.encode('utf-8', 'surrogateescape')
+    cmd = get_command(machine_name, command, user_key, forward_agent)
+    output = await run_async(cmd, input=input, stderr=stderr, timeout=timeout, on_line=on_line, capture=on_line is None, attributes={'machine': machine_name})
+    return output if raw else output.decode('utf-8', 'replace')
+
+
+def get_address(machine_name):
+    if machine_name == 'master':
+        return settings.MASTER_ADDRESS
+    return get_machine(machine_name)['ip']
+
+
+def trust_host_key(machine_name, address, host_key):
+    '''
+    Adds `address` with its host key to a machine's known_hosts, replacing
+    any other key recorded for that address, e.g. from a machine that had
+    the IP before.
+    '''
+    known_host = quote('{} {}'.format(address, host_key))
+    cmd = 'mkdir -p {0} && touch {1} && (grep -qxF {2} {1} || (ssh-keygen -R {3} -f {1} >/dev/null 2>&1; echo {2} >> {1}))'.format(
+        os.path.dirname(KNOWN_HOSTS_FILE), KNOWN_HOSTS_FILE, known_host, quote(address))
+    run_command(machine_name, cmd, silent=True)
+
+
+def pin_host_key(machine_name, host_name):
+    '''
+    Makes a node trust another machine's host key, read over our own trusted
+    connection to that machine, so the node can connect to it with strict
+    host key checking. Done once per pair of machines per run.
+    '''
+    with pinned_host_keys_lock:
+        if (machine_name, host_name) in pinned_host_keys:
+            return
+    host_key = run_command(host_name, 'cat {}'.format(HOST_KEY_FILE), silent=True).strip()
+    trust_host_key(machine_name, get_address(host_name), host_key)
+    with pinned_host_keys_lock:
+        pinned_host_keys.add((machine_name, host_name))
 
 
 def get_local_public_key():
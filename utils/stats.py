@@ -1,18 +1,328 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import math
+import os
+import time
+
+import settings
+from utils.docker_machine import reload_machines
 from utils.ssh import run_command
+from utils.tracing import traced
+
+
+STATS_WORKERS = getattr(settings, 'STATS_WORKERS', 8)
+STATS_TIMEOUT = getattr(settings, 'STATS_TIMEOUT', 10)
+STATS_INTERVAL = getattr(settings, 'STATS_INTERVAL', 60)
+STATS_HISTORY_SIZE = getattr(settings, 'STATS_HISTORY_SIZE', 1440)
+STATS_HISTORY_PATH = getattr(settings, 'STATS_HISTORY_PATH', '~/.punk-deploy/stats')
+STATS_WINDOWS = {'hour': 3600, 'day': 86400}
+TREND_SYMBOLS = {'up': '↑', 'down': '↓', 'steady': '→'}
+
+# Raw kernel numbers, so nothing depends on how a tool formats its output.
+# `stat -f` reports the root filesystem's statvfs block counts.
+SAMPLE_SCRIPT = '''cat /proc/uptime /proc/loadavg
+grep -E '^(MemTotal|MemAvailable):' /proc/meminfo
+head -n 1 /proc/stat
+stat -f -c 'statvfs %b %a %S' /
+echo "cpus $(nproc)"
+'''
+
+# Values kept for each sample. Memory and disk are percentages used.
+HISTORY_FIELDS = ['time', 'uptime', 'load', 'cpu', 'memory', 'memory_total', 'disk', 'disk_total']
+# Stored ahead of the fields: size, next position, count and the previous
+# CPU counters, which are needed to turn the next sample into a percentage
+HISTORY_HEADER = ['size', 'position', 'count', 'cpu_total', 'cpu_idle']
+
 
+@traced('stats', 'machine_name')
+def get_machine_sample(machine_name, timeout=None):
+    '''
+    Reads uptime, load, memory, CPU counters, root disk usage and the number
+    of CPUs from /proc and statvfs with a single SSH round trip. Returns
+    numbers rather than display strings, with `cpu_total` and `cpu_idle` as
+    the raw jiffy counters since boot.
+    '''
+    output = run_command(machine_name, SAMPLE_SCRIPT, silent=True, timeout=timeout)
+    lines = output.strip().split('\n')
+    sample = {'time': time.time(), 'cpus': 1}
 
-def get_machine_stats(machine_name):
-    stats = {}
+    sample['uptime'] = float(lines[0].split()[0])
+    sample['load'], sample['load5'], sample['load15'] = [float(value) for value in lines[1].split()[:3]]
 
-    output = run_command(machine_name, 'uptime')
-    stats['uptime'] = output.strip().split('up ')[1].split(',')[0]
-    stats['load'] = output.strip().split('load average: ')[1]
+    memory = {}
+    for line in lines:
+        fields = line.split() or ['']
+        if fields[0] in ['MemTotal:', 'MemAvailable:']:
+            memory[fields[0]] = int(fields[1]) * 1024
+        elif fields[0] == 'cpu':
+            counters = [int(value) for value in fields[1:]]
+            sample['cpu_total'] = sum(counters)
+            # idle and iowait
+            sample['cpu_idle'] = sum(counters[3:5])
+        elif fields[0] == 'statvfs':
+            blocks, available, block_size = [int(value) for value in fields[1:4]]
+            sample['disk_total'] = blocks * block_size
+            sample['disk'] = 100.0 * (blocks - available) / blocks if blocks else 0.0
+        elif fields[0] == 'cpus':
+            sample['cpus'] = int(fields[1])
+    sample['memory_total'] = memory['MemTotal:']
+    sample['memory'] = 100.0 * (memory['MemTotal:'] - memory['MemAvailable:']) / memory['MemTotal:']
 
-    output = run_command(machine_name, 'df -h')
-    for row in output.split('\n')[1:]:
-        cols = row.split()
-        if cols[5] == '/':
-            stats['disk'] = '{} of {} ({})'.format(cols[2], cols[1], cols[4])
+    return sample
+
+
+def format_bytes(value):
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if value < 1024 or unit == 'T':
             break
+        value /= 1024.0
+    return '{:.0f}{}'.format(value, unit) if value >= 10 or unit == 'B' else '{:.1f}{}'.format(value, unit)
+
+
+def format_uptime(seconds):
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    if days:
+        return '{} day{}, {}:{:02d}'.format(days, '' if days == 1 else 's', hours, seconds // 60)
+    return '{}:{:02d}'.format(hours, seconds // 60)
+
+
+def get_machine_stats(machine_name, timeout=None):
+    '''
+    Samples a machine and returns its uptime, load, memory and root disk
+    usage as display strings.
+    '''
+    sample = get_machine_sample(machine_name, timeout)
+    return {
+        'uptime':   format_uptime(sample['uptime']),
+        'load':     '{:.2f}, {:.2f}, {:.2f}'.format(sample['load'], sample['load5'], sample['load15']),
+        'memory':   '{:.0f}% of {}'.format(sample['memory'], format_bytes(sample['memory_total'])),
+        'disk':     '{:.0f}% of {}'.format(sample['disk'], format_bytes(sample['disk_total'])),
+    }
+
+
+def get_fleet_stats(machine_names, workers=STATS_WORKERS, timeout=STATS_TIMEOUT, function=get_machine_stats):
+    '''
+    Gathers stats from many machines in parallel, yielding `(name, stats)`
+    tuples in the order they complete. A machine that fails or does not
+    answer within `timeout` seconds yields `None` for its stats so it can't
+    hold up the others. Pass `function=get_machine_sample` for numbers
+    instead of display strings.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(function, name, timeout): name for name in machine_names}
+        for future in as_completed(futures):
+            try:
+                stats = future.result()
+            except Exception:
+                stats = None
+            yield futures[future], stats
+
+
+def get_history_path(machine_name):
+    return os.path.join(os.path.expanduser(STATS_HISTORY_PATH), '{}.bin'.format(machine_name))
+
+
+def new_history(size=STATS_HISTORY_SIZE):
+    '''
+    Returns an empty ring buffer of `size` samples, held as one array of
+    doubles per field.
+    '''
+    return {
+        'size':         size,
+        'position':     0,
+        'count':        0,
+        'cpu_total':    math.nan,
+        'cpu_idle':     math.nan,
+        'fields':       {field: array('d', [math.nan]) * size for field in HISTORY_FIELDS},
+    }
+
+
+def load_history(machine_name, size=STATS_HISTORY_SIZE):
+    '''
+    Reads a machine's ring buffer from disk. The file is the header followed
+    by each field's array, all as native doubles. A missing file, or one
+    written with a different size, gives an empty buffer.
+    '''
+    path = get_history_path(machine_name)
+    history = new_history(size)
+    if not os.path.exists(path):
+        return history
+
+    data = array('d')
+    with open(path, 'rb') as history_file:
+        data.frombytes(history_file.read())
+    if len(data) != len(HISTORY_HEADER) + size * len(HISTORY_FIELDS) or int(data[0]) != size:
+        return history
+
+    for i, key in enumerate(HISTORY_HEADER[1:], 1):
+        history[key] = data[i] if key.startswith('cpu_') else int(data[i])
+    offset = len(HISTORY_HEADER)
+    for field in HISTORY_FIELDS:
+        history['fields'][field] = data[offset:offset + size]
+        offset += size
+    return history
+
+
+def save_history(machine_name, history):
+    path = get_history_path(machine_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = array('d', [history[key] for key in HISTORY_HEADER])
+    for field in HISTORY_FIELDS:
+        data.extend(history['fields'][field])
+    with open('{}.tmp'.format(path), 'wb') as history_file:
+        data.tofile(history_file)
+    os.replace('{}.tmp'.format(path), path)
+
+
+def record_sample(history, sample):
+    '''
+    Writes a sample into the ring buffer over the oldest one. CPU usage is
+    worked out from the change in counters since the previous sample, so the
+    first sample, and the first after a reboot, have none.
+    '''
+    cpu = math.nan
+    total = sample['cpu_total'] - history['cpu_total']
+    idle = sample['cpu_idle'] - history['cpu_idle']
+    if total > 0 and idle >= 0:
+        cpu = 100.0 * (total - idle) / total
+    history['cpu_total'] = sample['cpu_total']
+    history['cpu_idle'] = sample['cpu_idle']
+
+    position = history['position']
+    for field in HISTORY_FIELDS:
+        history['fields'][field][position] = cpu if field == 'cpu' else sample[field]
+    history['position'] = (position + 1) % history['size']
+    history['count'] = min(history['count'] + 1, history['size'])
+
+
+def get_trend(times, values):
+    '''
+    Returns "up", "down" or "steady" depending on whether a least squares fit
+    of `values` rises or falls by more than a tenth of their average over the
+    period.
+    '''
+    if len(values) < 2:
+        return 'steady'
+    mean_time = sum(times) / len(times)
+    mean_value = sum(values) / len(values)
+    variance = sum((t - mean_time) ** 2 for t in times)
+    if not variance:
+        return 'steady'
+    slope = sum((t - mean_time) * (v - mean_value) for t, v in zip(times, values)) / variance
+    change = slope * (times[-1] - times[0])
+    threshold = max(abs(mean_value) * 0.1, 0.01)
+    if change > threshold:
+        return 'up'
+    if change < -threshold:
+        return 'down'
+    return 'steady'
+
+
+def summarize_history(history, window=STATS_WINDOWS['hour'], now=None):
+    '''
+    Returns the latest sample's time, uptime and totals along with the
+    `current`, `min`, `avg` and `max` value and `trend` of load, CPU, memory
+    and disk over the last `window` seconds. Returns None if there are no
+    samples in the window.
+    '''
+    now = now or time.time()
+    fields = history['fields']
+    size = history['size']
+    indexes = [(history['position'] - history['count'] + i) % size for i in range(history['count'])]
+    indexes = [i for i in indexes if fields['time'][i] >= now - window]
+    if not indexes:
+        return None
+
+    latest = indexes[-1]
+    summary = {
+        'time':         fields['time'][latest],
+        'uptime':       fields['uptime'][latest],
+        'memory_total': fields['memory_total'][latest],
+        'disk_total':   fields['disk_total'][latest],
+    }
+    for field in ['load', 'cpu', 'memory', 'disk']:
+        points = [(fields['time'][i], fields[field][i]) for i in indexes if not math.isnan(fields[field][i])]
+        if not points:
+            summary[field] = None
+            continue
+        times = [t for t, value in points]
+        values = [value for t, value in points]
+        summary[field] = {
+            'current':  values[-1],
+            'min':      min(values),
+            'avg':      sum(values) / len(values),
+            'max':      max(values),
+            'trend':    get_trend(times, values),
+        }
+    return summary
+
+
+def format_metric(metric, template='{:.0f}%'):
+    if not metric:
+        return '-'
+    return '{} {} ({}-{}, avg {})'.format(
+        template.format(metric['current']),
+        TREND_SYMBOLS[metric['trend']],
+        template.format(metric['min']),
+        template.format(metric['max']),
+        template.format(metric['avg']),
+    )
+
+
+def format_summary(summary):
+    '''
+    Turns a history summary into display strings like those from
+    `get_machine_stats`, plus CPU.
+    '''
+    return {
+        'uptime':   format_uptime(summary['uptime']),
+        'load':     format_metric(summary['load'], '{:.2f}'),
+        'cpu':      format_metric(summary['cpu']),
+        'memory':   format_metric(summary['memory']),
+        'disk':     format_metric(summary['disk']),
+    }
+
+
+def get_fleet_history(machine_names, window=STATS_WINDOWS['hour'], max_age=None):
+    '''
+    Summarizes each machine's stored history without contacting it. Machines
+    with no sample in the last `max_age` seconds (by default three polling
+    intervals) map to None.
+    '''
+    max_age = max_age or STATS_INTERVAL * 3
+    now = time.time()
+    summaries = {}
+    for name in machine_names:
+        summary = summarize_history(load_history(name), window, now)
+        summaries[name] = summary if summary and now - summary['time'] <= max_age else None
+    return summaries
+
+
+def poll_stats(interval=STATS_INTERVAL, workers=STATS_WORKERS, timeout=STATS_TIMEOUT, iterations=None, callback=None):
+    '''
+    Samples every running machine each `interval` seconds and appends the
+    samples to their ring buffers on disk, until `iterations` rounds have run
+    or forever if it is None. The list of machines is reloaded each round so
+    new machines are picked up. SSH connections stay open between rounds as
+    long as `interval` is shorter than SSH_CONTROL_PERSIST.
+
+    `callback(machine, sample)` is called for each machine sampled, with None
+    if it could not be reached.
+    '''
+    started = time.time()
+    rounds = 0
+    while iterations is None or rounds < iterations:
+        machines = reload_machines()
+        names = [name for name, properties in machines.items() if properties['running']]
+        for name, sample in get_fleet_stats(names, workers, min(timeout, interval), function=get_machine_sample):
+            if sample:
+                history = load_history(name)
+                record_sample(history, sample)
+                save_history(name, history)
+            if callback:
+                callback(name, sample)
 
-    return stats
+        rounds += 1
+        if iterations is None or rounds < iterations:
+            time.sleep(max(0, started + rounds * interval - time.time()))
@@ -0,0 +1,165 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import json
+import os
+import subprocess
+import threading
+import time
+
+import settings
+
+
+TRACE_PATH = getattr(settings, 'TRACE_PATH', None)
+CHROME_TRACE_PATH = getattr(settings, 'CHROME_TRACE_PATH', None)
+SECRET_SETTING_SUFFIXES = ['_PASSWORD', '_TOKEN', '_ACCESS_KEY']
+
+spans = []
+spans_lock = threading.Lock()
+# The spans open in the current thread or asyncio task, innermost last
+open_spans = ContextVar('open_spans', default=())
+
+
+def get_secrets():
+    secrets = []
+    for name in dir(settings):
+        value = getattr(settings, name)
+        if any(name.endswith(suffix) for suffix in SECRET_SETTING_SUFFIXES) and isinstance(value, str) and value:
+            secrets.append(value)
+    return secrets
+
+
+def redact(text):
+    for secret in get_secrets():
+        text = text.replace(secret, '***')
+    return text
+
+
+@contextmanager
+def span(name, **attributes):
+    '''
+    Records how long the block takes along with `attributes`, such as the
+    machine, image, volume or database being worked on. The attributes dict
+    is yielded so the block can add to it, and any exception is recorded
+    before being re-raised.
+    '''
+    stack = open_spans.get()
+    record = {
+        'name':         name,
+        'start':        time.time(),
+        'thread':       threading.get_ident(),
+        'parent':       stack[-1]['name'] if stack else None,
+        'attributes':   attributes,
+    }
+    token = open_spans.set(stack + (record,))
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes['error'] = redact(str(e))
+        raise
+    finally:
+        open_spans.reset(token)
+        record['duration'] = time.time() - record['start']
+        with spans_lock:
+            spans.append(record)
+
+
+def traced(name, *argument_names):
+    '''
+    Decorates a function or coroutine function so each call is recorded as a
+    span, with the named arguments as its attributes.
+    '''
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        def get_attributes(args, kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            return {argument: arguments.get(argument) for argument in argument_names}
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with span(name, **get_attributes(args, kwargs)):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(name, **get_attributes(args, kwargs)):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def check_output(cmd, attributes=None, **kwargs):
+    '''
+    Wraps `subprocess.check_output` in a span recording the redacted command,
+    bytes in and out and the exit code.
+    '''
+    attributes = dict(attributes or {})
+    attributes['command'] = redact(' '.join(cmd))
+    if kwargs.get('input') is not None:
+        attributes['bytes_in'] = len(kwargs['input'])
+
+    with span('command', **attributes) as record:
+        try:
+            output = subprocess.check_output(cmd, **kwargs)
+        except subprocess.CalledProcessError as e:
+            record['exit_code'] = e.returncode
+            raise
+        record['exit_code'] = 0
+        record['bytes_out'] = len(output)
+        return output
+
+
+def get_spans():
+    with spans_lock:
+        return sorted(spans, key=lambda record: record['start'])
+
+
+def export_json(path):
+    with open(os.path.expanduser(path), 'w') as trace_file:
+        json.dump(get_spans(), trace_file, indent=2)
+
+
+def export_chrome_trace(path):
+    '''
+    Writes the spans as complete ("X") events in Chrome's trace event format,
+    which chrome://tracing and Perfetto can open.
+    '''
+    records = get_spans()
+    threads = {}
+    origin = records[0]['start'] if records else 0
+    events = []
+    for record in records:
+        tid = threads.setdefault(record['thread'], len(threads) + 1)
+        events.append({
+            'name': record['name'],
+            'cat':  record['name'],
+            'ph':   'X',
+            'ts':   int((record['start'] - origin) * 1000000),
+            'dur':  int(record['duration'] * 1000000),
+            'pid':  1,
+            'tid':  tid,
+            'args': record['attributes'],
+        })
+    with open(os.path.expanduser(path), 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+def get_summary(limit=10):
+    '''
+    Returns lines of a table of the slowest spans.
+    '''
+    lines = ['{:>9}  {:<12}  {}'.format('Seconds', 'Span', 'Details')]
+    for record in sorted(get_spans(), key=lambda record: record['duration'], reverse=True)[:limit]:
+        details = ' '.join('{}={}'.format(key, value) for key, value in sorted(record['attributes'].items()))
+        lines.append('{:>9.3f}  {:<12}  {}'.format(record['duration'], record['name'][:12], details[:100]))
+    return lines
+
+
+def export_traces(trace_path=TRACE_PATH, chrome_trace_path=CHROME_TRACE_PATH):
+    if trace_path:
+        export_json(trace_path)
+    if chrome_trace_path:
+        export_chrome_trace(chrome_trace_path)
@@ -1,9 +1,19 @@
+import asyncio
 import os
 
 import settings
-from utils.docker_compose import get_docker_compose_data
+from utils.docker_compose import get_compose_model
 from utils.docker_machine import get_machines
-from utils.ssh import run_command
+from utils.journal import describe_entry, get_entry, is_done, record_item, skip_item
+from utils.manifests import get_changed_files, get_manifest_checksum, update_manifest
+from utils.runner import get_progress_parser, run_in_thread, run_sync
+from utils.ssh import pin_host_key, run_command_async
+from utils.tracing import traced
+
+
+VOLUME_SYNC_WORKERS = getattr(settings, 'VOLUME_SYNC_WORKERS', 4)
+# Nodes only connect to machines whose host keys `pin_host_key` gave them
+NODE_RSYNC_SHELL = 'ssh -o StrictHostKeyChecking=yes'
 
 
 def get_volumes(show_un_backed_up=False):
@@ -13,33 +23,142 @@ def get_volumes(show_un_backed_up=False):
     '''
     volumes = set()
 
-    for item, properties in get_docker_compose_data()['services'].items():
-        if 'volumes' in properties:
-            for volume_str in properties['volumes']:
-                volume = volume_str.split(':')[0]
-                volume = volume.replace('/volumes/', '')
-                volume = volume.split('/')[0]
-                if show_un_backed_up or volume not in settings.NON_BACKED_UP_VOLUMES:
-                    volumes.add(volume)
+    for item, service_volumes in get_compose_model()['volumes_by_service'].items():
+        for volume in service_volumes:
+            if show_un_backed_up or volume not in settings.NON_BACKED_UP_VOLUMES:
+                volumes.add(volume)
 
     return sorted(list(volumes))
 
 
-def sync_volume(volume, src, dst):
-    machines = get_machines()
+def get_volume_path(machine_name, volume):
+    if machine_name == 'master':
+        return '{}/{}'.format(settings.MASTER_VOLUMES_PATH, volume)
+    if machine_name == 'local':
+        return '{}/{}'.format(os.path.expanduser(settings.LOCAL_VOLUMES_PATH), volume)
+    return '/volumes/{}'.format(volume)
+
+
+def get_sync_command(volume, src, dst, options='-avz', src_path=None):
+    '''
+    Returns `(machine, command)` where `command` is the rsync to run on
+    `machine` to copy a volume straight from `src` to `dst`. The source
+    pushes to the destination, apart from syncs to local which pull.
+    `src_path` copies from that directory on `src` instead of the volume's.
+    '''
+    src_path = src_path or get_volume_path(src, volume)
+    machines = get_machines(check_running=False)
 
     if src not in machines and src not in ['master']:
         raise KeyError('No source machine called {}'.format(src))
     if dst not in machines and dst not in ['master', 'local']:
         raise KeyError('No destination machine called {}'.format(dst))
+    if src == dst:
+        raise ValueError('Source and destination are both {}'.format(src))
+
+    def get_address(machine_name):
+        if machine_name == 'master':
+            return settings.MASTER_ADDRESS
+        return machines[machine_name]['ip']
+
+    if dst == 'local':
+        cmd = 'rsync {} root@{}:{}/ {}/'.format(options, get_address(src), src_path, get_volume_path(dst, volume))
+        return 'local', cmd
+
+    cmd = 'rsync {} {}/ root@{}:{}/'.format(options, src_path, get_address(dst), get_volume_path(dst, volume))
+    if src != 'master':
+        # Nodes log in to other machines with the forwarded agent
+        cmd = 'rsync -e "{}" {}'.format(NODE_RSYNC_SHELL, cmd[len('rsync '):])
+    return src, cmd
+
+
+@traced('sync_volume', 'volume', 'src', 'dst')
+async def sync_volume_async(volume, src, dst, verify=False, progress=None, journal=None, src_path=None):
+    '''
+    Copies the files that differ between the two sides' manifests, fetching
+    both manifests at once. With `verify`, rsync rescans and checksums both
+    whole trees instead. `progress(progress)` is called as rsync reports
+    the bytes sent; see `utils.runner.get_progress_parser`.
+
+    With a `journal` (see `utils.journal`), a volume an earlier run already
+    synced is skipped if its source manifest hasn't changed since, without
+    looking at the destination. `verify` never skips, since it is meant to
+    catch differences the manifests miss. Returns whether the volume was
+    synced.
 
-    if src == 'master':
-        dst_machine = machines[dst]
-        cmd = 'rsync -avz {}/{}/ root@{}:/volumes/{}/'.format(settings.MASTER_VOLUMES_PATH, volume, dst_machine['ip'], volume)
-        run_command('master', cmd)
-    elif dst == 'local':
-        src_machine = machines[src]
-        cmd = 'rsync -avz root@{}:/volumes/{}/ {}/{}/'.format(src_machine['ip'], volume, os.path.expanduser(settings.LOCAL_VOLUMES_PATH), volume)
-        run_command('local', cmd)
+    `src_path` syncs from another directory on `src` than the volume's own.
+    It needs `verify`, as manifests are only kept for the volumes' own
+    directories.
+    '''
+    if src_path and not verify:
+        raise ValueError('Syncing {} from {} needs verify'.format(volume, src_path))
+    options = '-avzc' if verify else '-avz --from0 --files-from=-'
+    on_line = None
+    if progress:
+        options += ' --info=progress2'
+        on_line = get_progress_parser('rsync', progress)
+    machine, cmd = get_sync_command(volume, src, dst, options=options, src_path=src_path)
+    forward_agent = machine not in ['master', 'local']
+    if forward_agent:
+        await run_in_thread(pin_host_key, src, dst)
+
+    src_manifest = None
+    entry = get_entry(journal, volume)
+    if entry or (journal is not None and verify):
+        src_manifest = await run_in_thread(update_manifest, src, volume, get_volume_path(src, volume))
+        if not verify and is_done(journal, volume, get_manifest_checksum(src_manifest)):
+            skip_item(journal, volume, '{}, unchanged on {} since'.format(describe_entry(entry), src))
+            return False
+    record_item(journal, volume, 'started')
+
+    if verify:
+        await run_command_async(machine, cmd, forward_agent=forward_agent, on_line=on_line)
     else:
-        raise NotImplementedError()
+        if src_manifest is None:
+            src_manifest, dst_manifest = await asyncio.gather(
+                run_in_thread(update_manifest, src, volume, get_volume_path(src, volume)),
+                run_in_thread(update_manifest, dst, volume, get_volume_path(dst, volume)),
+            )
+        else:
+            dst_manifest = await run_in_thread(update_manifest, dst, volume, get_volume_path(dst, volume))
+        changed_files = get_changed_files(src_manifest, dst_manifest)
+        if changed_files:
+            await run_command_async(machine, cmd, forward_agent=forward_agent, input=''.join(path + '\0' for path in changed_files), on_line=on_line)
+
+    record_item(journal, volume, 'done', get_manifest_checksum(src_manifest) if src_manifest is not None else None)
+    return True
+
+
+def sync_volume(volume, src, dst, verify=False, progress=None, src_path=None):
+    return run_sync(sync_volume_async(volume, src, dst, verify, progress, src_path=src_path))
+
+
+def sync_volumes_concurrently(volumes, src, dst, workers=VOLUME_SYNC_WORKERS, callback=None, verify=False, progress=None, journal=None):
+    '''
+    Syncs several volumes from `src` to `dst` at once, `workers` at a time,
+    as tasks on the runner's event loop. `callback(volume, error)` is called
+    as each volume finishes and `progress(volume, progress)` as rsync
+    reports on each. Both are called from the loop's thread. Progress is
+    recorded in `journal` if one is given. Returns a dict mapping each
+    failed volume to its exception.
+    '''
+    errors = {}
+
+    async def sync(volume, semaphore):
+        volume_progress = (lambda value: progress(volume, value)) if progress else None
+        async with semaphore:
+            try:
+                await sync_volume_async(volume, src, dst, verify, volume_progress, journal)
+                error = None
+            except Exception as e:
+                error = errors[volume] = e
+                record_item(journal, volume, 'failed', error=str(e))
+        if callback:
+            callback(volume, error)
+
+    async def sync_all():
+        semaphore = asyncio.Semaphore(workers)
+        await asyncio.gather(*[sync(volume, semaphore) for volume in volumes])
+
+    run_sync(sync_all())
+    return errors